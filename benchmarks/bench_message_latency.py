@@ -0,0 +1,96 @@
+###################################################################################
+# ocr_translate - a django app to perform OCR and translation of images.          #
+# Copyright (C) 2023-present Davide Grassano                                      #
+#                                                                                 #
+# This program is free software: you can redistribute it and/or modify            #
+# it under the terms of the GNU General Public License as published by            #
+# the Free Software Foundation, either version 3 of the License.                  #
+#                                                                                 #
+# This program is distributed in the hope that it will be useful,                 #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of                  #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                   #
+# GNU General Public License for more details.                                    #
+#                                                                                 #
+# You should have received a copy of the GNU General Public License               #
+# along with this program.  If not, see {http://www.gnu.org/licenses/}.           #
+#                                                                                 #
+# Home: https://github.com/Crivella/ocr_translate                                 #
+###################################################################################
+"""Benchmark the latency added by waiting on messages through the box -> ocr -> tsl stages.
+
+Compares the event driven `Message.response` against the old 0.2s sleep-polling loop.
+
+Usage:
+    python benchmarks/bench_message_latency.py [--repeat N] [--poll SECONDS]
+"""
+import argparse
+import statistics
+import time
+
+from ocr_translate.messaging import WorkerMessageQueue
+
+
+def poll_response(msg, poll: float):
+    """Reproduce the old sleep-polling `Message.response` behavior."""
+    while not msg.is_resolved:
+        time.sleep(poll)
+    return msg.response()
+
+def make_pipeline(queues: dict[str, WorkerMessageQueue], wait, timings: dict[str, list[float]]):
+    """Create a pipeline handler that mimics `ocr_tsl_pipeline_work` with no-op stages."""
+    counter = iter(range(10**9))
+
+    def stage(name: str):
+        start = time.perf_counter()
+        msg = queues[name].put(id_=next(counter), msg={'args': (name,)}, handler=lambda x: x)
+        wait(msg)
+        timings[name].append(time.perf_counter() - start)
+
+    def pipeline():
+        stage('box')
+        stage('ocr')
+        stage('tsl')
+        return True
+
+    return pipeline
+
+def run(mode: str, repeat: int, poll: float) -> dict[str, list[float]]:
+    """Run the benchmark for a given waiting mode."""
+    if mode == 'event':
+        wait = lambda msg: msg.response()
+    else:
+        wait = lambda msg: poll_response(msg, poll)
+
+    queues = {name: WorkerMessageQueue(reuse_msg=False) for name in ['main', 'box', 'ocr', 'tsl']}
+    for queue in queues.values():
+        queue.start_workers()
+
+    timings = {name: [] for name in queues}
+    pipeline = make_pipeline(queues, wait, timings)
+    for i in range(repeat):
+        start = time.perf_counter()
+        msg = queues['main'].put(id_=i, msg={}, handler=pipeline)
+        wait(msg)
+        timings['main'].append(time.perf_counter() - start)
+
+    for queue in queues.values():
+        queue.stop_workers()
+    return timings
+
+def main():
+    """Run the benchmark and print the results."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=10, help='Number of pipeline runs per mode.')
+    parser.add_argument('--poll', type=float, default=0.2, help='Polling interval of the old implementation.')
+    args = parser.parse_args()
+
+    results = {mode: run(mode, args.repeat, args.poll) for mode in ['poll', 'event']}
+
+    print(f'{"stage":>8s} {"poll [ms]":>12s} {"event [ms]":>12s} {"saved [ms]":>12s}')
+    for stage in ['box', 'ocr', 'tsl', 'main']:
+        old = statistics.mean(results['poll'][stage]) * 1000
+        new = statistics.mean(results['event'][stage]) * 1000
+        print(f'{stage:>8s} {old:12.2f} {new:12.2f} {old - new:12.2f}')
+
+if __name__ == '__main__':
+    main()
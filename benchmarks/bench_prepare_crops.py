@@ -0,0 +1,102 @@
+###################################################################################
+# ocr_translate - a django app to perform OCR and translation of images.          #
+# Copyright (C) 2023-present Davide Grassano                                      #
+#                                                                                 #
+# This program is free software: you can redistribute it and/or modify            #
+# it under the terms of the GNU General Public License as published by            #
+# the Free Software Foundation, either version 3 of the License.                  #
+#                                                                                 #
+# This program is distributed in the hope that it will be useful,                 #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of                  #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                   #
+# GNU General Public License for more details.                                    #
+#                                                                                 #
+# You should have received a copy of the GNU General Public License               #
+# along with this program.  If not, see {http://www.gnu.org/licenses/}.           #
+#                                                                                 #
+# Home: https://github.com/Crivella/ocr_translate                                 #
+###################################################################################
+"""Benchmark preparing the OCR crops of a page with many boxes.
+
+Compares the old behavior (full decode into a numpy copy to load the image, then converting the whole page to RGB
+for every box before cropping) against loading once and converting once to a shared RGB page (crop then convert).
+
+Usage:
+    python benchmarks/bench_prepare_crops.py [--width W] [--height H] [--boxes N] [--mode MODE] [--repeat N]
+"""
+import argparse
+import io
+import os
+import random
+import statistics
+import time
+
+import django
+import numpy as np
+from PIL import Image
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ocr_translate.app.settings')
+django.setup()
+
+# pylint: disable=wrong-import-position
+from ocr_translate.models import OCRModel
+from ocr_translate.ocr_tsl.full import _shared_rgb
+
+
+def make_page(width: int, height: int, mode: str) -> bytes:
+    """Encode a random page as PNG."""
+    arr = np.random.default_rng(0).integers(0, 255, (height, width, 4), dtype=np.uint8)
+    img = Image.fromarray(arr, 'RGBA').convert(mode)
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+def make_boxes(width: int, height: int, num: int) -> list[tuple[int, int, int, int]]:
+    """Random text-like boxes in lbrt format."""
+    rnd = random.Random(0)
+    res = []
+    for _ in range(num):
+        l, b = rnd.randrange(width - 200), rnd.randrange(height - 100)
+        res.append((l, b, l + rnd.randint(40, 200), b + rnd.randint(20, 100)))
+    return res
+
+def old(binary: bytes, boxes: list[tuple[int, int, int, int]]) -> list[Image.Image]:
+    """Reproduce the old `_load_image` + `prepare_image` behavior."""
+    img = Image.open(io.BytesIO(binary))
+    np.array(img)
+    return [img.convert('RGB').crop(box) for box in boxes]
+
+def new(binary: bytes, boxes: list[tuple[int, int, int, int]]) -> list[Image.Image]:
+    """Current `_load_image` + pipeline + `prepare_image` behavior."""
+    img = Image.open(io.BytesIO(binary))
+    img.load()
+    img = _shared_rgb(img)
+    model = OCRModel(name='bench')
+    return [model.prepare_image(img, box) for box in boxes]
+
+def main():
+    """Run the benchmark and print the results."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--width', type=int, default=1600, help='Width of the page.')
+    parser.add_argument('--height', type=int, default=2400, help='Height of the page.')
+    parser.add_argument('--boxes', type=int, default=100, help='Number of boxes on the page.')
+    parser.add_argument('--mode', default='P', help='Mode of the encoded page (e.g. P, RGBA, RGB, L).')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs per implementation.')
+    args = parser.parse_args()
+
+    binary = make_page(args.width, args.height, args.mode)
+    boxes = make_boxes(args.width, args.height, args.boxes)
+    assert all(a.tobytes() == b.tobytes() for a, b in zip(old(binary, boxes), new(binary, boxes)))
+
+    print(f'{args.width}x{args.height} {args.mode} page, {args.boxes} boxes')
+    print(f'{"impl":>8s} {"time [ms]":>12s}')
+    for name, func in [('old', old), ('new', new)]:
+        times = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            func(binary, boxes)
+            times.append(time.perf_counter() - start)
+        print(f'{name:>8s} {statistics.mean(times) * 1000:12.2f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+###################################################################################
+# ocr_translate - a django app to perform OCR and translation of images.          #
+# Copyright (C) 2023-present Davide Grassano                                      #
+#                                                                                 #
+# This program is free software: you can redistribute it and/or modify            #
+# it under the terms of the GNU General Public License as published by            #
+# the Free Software Foundation, either version 3 of the License.                  #
+#                                                                                 #
+# This program is distributed in the hope that it will be useful,                 #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of                  #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                   #
+# GNU General Public License for more details.                                    #
+#                                                                                 #
+# You should have received a copy of the GNU General Public License               #
+# along with this program.  If not, see {http://www.gnu.org/licenses/}.           #
+#                                                                                 #
+# Home: https://github.com/Crivella/ocr_translate                                 #
+###################################################################################
+"""Benchmark the run lookups (box, OCR and translation caches) as the run tables grow.
+
+Fills the `OCRBoxRun`, `OCRRun` and `TranslationRun` tables of a throwaway database up to `--runs` rows each (every
+image/box/text has `--variants` runs with different options, as with many option sets or model changes), and
+measures the lookups done by the pipeline at every checkpoint. With the composite lookup indexes the cost should stay
+flat; run with `--without-indexes` to compare against the schema before them.
+
+Usage:
+    python benchmarks/bench_run_lookup.py [--db PATH] [--runs N] [--checkpoints N,...] [--variants N] [--lookups N]
+                                          [--without-indexes]
+"""
+import argparse
+import hashlib
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import django
+from django.db.models import Max
+
+BATCH_SIZE = 50000
+TABLES = ('box', 'ocr', 'tsl')
+
+
+def insert(cursor, model, rows: list[tuple], fields: list[str]):
+    """Insert rows with raw SQL (much faster than the ORM for millions of rows)."""
+    columns = ', '.join(model._meta.get_field(_).column for _ in fields)  # pylint: disable=protected-access
+    placeholders = ', '.join(['%s'] * len(fields))
+    table = model._meta.db_table  # pylint: disable=protected-access
+    for i in range(0, len(rows), BATCH_SIZE):
+        cursor.executemany(f'INSERT INTO {table} ({columns}) VALUES ({placeholders})', rows[i:i + BATCH_SIZE])
+
+class Filler():  # pylint: disable=too-few-public-methods
+    """Grow the run tables, with `variants` runs (one per option set) for every image/box/text."""
+    def __init__(self, m, objs: dict, variants: int):
+        self.m = m
+        self.objs = objs
+        self.variants = variants
+        self.keys = {_: [] for _ in TABLES}
+        # Explicit ids (to avoid reading them back), after the existing rows if the database is reused
+        self.next_id = {
+            name: (model.objects.aggregate(res=Max('id'))['res'] or 0) + 1
+            for name, model in (('image', m.Image), ('bbox', m.BBox), ('text', m.Text))
+            }
+
+    def _ids(self, name: str, num: int) -> list[int]:
+        start = self.next_id[name]
+        self.next_id[name] += num
+        return list(range(start, start + num))
+
+    def grow(self, table: str, runs: int):
+        """Add `runs` runs to a table."""
+        from django.db import connection  # pylint: disable=import-outside-toplevel
+        m, objs = self.m, self.objs
+        num = runs // self.variants
+        options = [_.id for _ in objs['options']]
+        lang = objs['lang'].id
+        with connection.cursor() as cursor:
+            if table in ('box', 'ocr'):
+                images = self._ids('image', num)
+                insert(cursor, m.Image, [(_, f'bench{_:027x}') for _ in images], ['id', 'md5'])
+            if table == 'box':
+                rows = [(i, objs['box'].id, o, lang) for i in images for o in options]
+                insert(cursor, m.OCRBoxRun, rows, ['image', 'model', 'options', 'lang_src'])
+                self.keys['box'].extend(images)
+            elif table == 'ocr':
+                bboxes = self._ids('bbox', num)
+                insert(cursor, m.BBox, [(b, i, 0, 0, 1, 1) for b, i in zip(bboxes, images)],
+                       ['id', 'image', 'l', 'b', 'r', 't'])
+                rows = [(b, objs['ocr'].id, lang, o) for b in bboxes for o in options]
+                insert(cursor, m.OCRRun, rows, ['bbox', 'model', 'lang_src', 'options'])
+                self.keys['ocr'].extend(bboxes)
+            else:
+                texts = self._ids('text', num)
+                insert(cursor, m.Text, [
+                    (t, str(t), hashlib.md5(str(t).encode('utf-8')).hexdigest()) for t in texts
+                    ], ['id', 'text', 'digest'])
+                rows = [(t, objs['tsl'].id, lang, lang, o, t) for t in texts for o in options]
+                insert(cursor, m.TranslationRun, rows, ['text', 'model', 'lang_src', 'lang_dst', 'options', 'result'])
+                self.keys['tsl'].extend(texts)
+
+    def queryset(self, table: str, key: int):
+        """Same query as the cache lookup of the pipeline."""
+        m, objs = self.m, self.objs
+        lang, options = objs['lang'], objs['options'][-1]
+        if table == 'box':
+            return m.OCRBoxRun.objects.filter(image_id=key, model=objs['box'], options=options, lang_src=lang)
+        if table == 'ocr':
+            return m.OCRRun.objects.filter(bbox_id=key, model=objs['ocr'], lang_src=lang, options=options)
+        return m.TranslationRun.objects.filter(
+            text_id=key, model=objs['tsl'], lang_src=lang, lang_dst=lang, options=options
+            )
+
+def setup(m, variants: int) -> dict:
+    """Create the language, models and option sets used by the runs."""
+    lang, _ = m.Language.objects.get_or_create(
+        name='Benchmark', iso1='bch', iso2b='bch', iso2t='bch', iso3='bch'
+        )
+    return {
+        'lang': lang,
+        'box': m.OCRBoxModel.objects.get_or_create(name='bench_box')[0],
+        'ocr': m.OCRModel.objects.get_or_create(name='bench_ocr')[0],
+        'tsl': m.TSLModel.objects.get_or_create(name='bench_tsl')[0],
+        'options': [m.OptionDict.objects.get_or_create(options={'bench': i})[0] for i in range(variants)],
+    }
+
+def main():
+    """Run the benchmark and print the results."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default=None, help='Path of the SQLite database (default: temporary file).')
+    parser.add_argument('--runs', type=int, default=10_000_000, help='Final number of runs per table.')
+    parser.add_argument(
+        '--checkpoints', default='10000,100000,1000000',
+        help='Comma separated table sizes at which to measure (the final size is always measured).'
+        )
+    parser.add_argument('--variants', type=int, default=8, help='Runs (option sets) per image/box/text.')
+    parser.add_argument('--lookups', type=int, default=2000, help='Number of lookups per measure.')
+    parser.add_argument(
+        '--without-indexes', action='store_true', help='Use the schema before the composite lookup indexes.'
+        )
+    args = parser.parse_args()
+
+    # Other backends can be used through the DATABASE_* environment variables (the database is filled, not cleared)
+    if 'DATABASE_ENGINE' not in os.environ:
+        os.environ['DATABASE_NAME'] = args.db or os.path.join(tempfile.mkdtemp(), 'bench.sqlite3')
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ocr_translate.app.settings')
+    django.setup()
+    # pylint: disable=import-outside-toplevel
+    from django.core.management import call_command
+
+    from ocr_translate import models as m
+    call_command('migrate', verbosity=0)
+    if args.without_indexes:
+        call_command('migrate', 'ocr_translate', '0024', verbosity=0)
+
+    filler = Filler(m, setup(m, args.variants), args.variants)
+    sizes = sorted({int(_) for _ in args.checkpoints.split(',') if 0 < int(_) < args.runs} | {args.runs})
+    rnd = random.Random(0)
+
+    print(f'{"composite indexes" if not args.without_indexes else "no composite indexes"}, {args.variants} variants')
+    print(f'{"runs":>10s} ' + ' '.join(f'{_ + " [us]":>10s}' for _ in TABLES))
+    current = 0
+    for size in sizes:
+        for table in TABLES:
+            filler.grow(table, size - current)
+        current = size
+        times = []
+        for table in TABLES:
+            keys = filler.keys[table]
+            samples = [rnd.choice(keys) for _ in range(args.lookups)]
+            start = time.perf_counter()
+            for key in samples:
+                assert filler.queryset(table, key).first() is not None
+            times.append((time.perf_counter() - start) / args.lookups)
+        print(f'{size:10d} ' + ' '.join(f'{_ * 1e6:10.1f}' for _ in times))
+
+    for table in TABLES:
+        print(f'\n{table} query plan:\n{filler.queryset(table, filler.keys[table][0]).explain()}')
+
+if __name__ == '__main__':
+    main()
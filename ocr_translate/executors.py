@@ -0,0 +1,296 @@
+###################################################################################
+# ocr_translate - a django app to perform OCR and translation of images.          #
+# Copyright (C) 2023-present Davide Grassano                                      #
+#                                                                                 #
+# This program is free software: you can redistribute it and/or modify            #
+# it under the terms of the GNU General Public License as published by            #
+# the Free Software Foundation, either version 3 of the License.                  #
+#                                                                                 #
+# This program is distributed in the hope that it will be useful,                 #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of                  #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                   #
+# GNU General Public License for more details.                                    #
+#                                                                                 #
+# You should have received a copy of the GNU General Public License               #
+# along with this program.  If not, see {http://www.gnu.org/licenses/}.           #
+#                                                                                 #
+# Home: https://github.com/Crivella/ocr_translate                                 #
+###################################################################################
+"""Execution backends used by the workers of a WorkerMessageQueue to run the message handlers."""
+import importlib
+import logging
+import multiprocessing as mp
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Callable
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger('ocr.worker')
+
+# Set in the child processes of a ProcessExecutor
+CHILD_ENV = 'OCT_EXECUTOR_CHILD'
+
+class ThreadExecutor():
+    """Run the handlers directly in the worker thread (default behavior)."""
+    def call(self, handler: Callable, args: tuple, kwargs: dict) -> Any:
+        """Call the handler with the given args and kwargs."""
+        return handler(*args, **kwargs)
+
+    def resize(self, num_procs: int):
+        """Nothing to resize for the thread executor (the workers are the threads)."""
+
+    def shutdown(self):
+        """Nothing to release for the thread executor."""
+
+@dataclass(frozen=True)
+class SharedImage():
+    """Reference to an image stored in a shared memory block."""
+    name: str
+    shape: tuple[int, ...]
+    dtype: str
+
+    @classmethod
+    def from_image(cls, img: Image.Image) -> tuple['SharedImage', SharedMemory]:
+        """Copy a Pillow image into a new shared memory block.
+
+        Returns:
+            tuple[SharedImage, SharedMemory]: The reference to send to the child process and the shared memory block
+                that must be closed and unlinked by the caller once done.
+        """
+        if img.mode == 'P':
+            img = img.convert('RGBA')
+        arr = np.asarray(img)
+        shm = SharedMemory(create=True, size=max(arr.nbytes, 1))
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+        return cls(shm.name, arr.shape, arr.dtype.str), shm
+
+    def to_image(self) -> Image.Image:
+        """Rebuild the Pillow image from the shared memory block (to be called in the child process)."""
+        try:
+            shm = SharedMemory(name=self.name, track=False)
+        except TypeError:
+            # python < 3.13: avoid the child resource tracker unlinking the block owned by the parent
+            shm = SharedMemory(name=self.name)
+            resource_tracker.unregister(shm._name, 'shared_memory')  # pylint: disable=protected-access
+        try:
+            # Copy so that the block can be released independently of the lifetime of the image
+            arr = np.ndarray(self.shape, dtype=np.dtype(self.dtype), buffer=shm.buf).copy()
+        finally:
+            shm.close()
+        return Image.fromarray(arr)
+
+def _share(value: Any, blocks: list[SharedMemory]) -> Any:
+    """Replace Pillow images (also inside lists/tuples, e.g. batched args) with SharedImage references."""
+    if isinstance(value, Image.Image):
+        ref, shm = SharedImage.from_image(value)
+        blocks.append(shm)
+        return ref
+    if isinstance(value, (list, tuple)):
+        return type(value)(_share(_, blocks) for _ in value)
+    return value
+
+def _unshare(value: Any) -> Any:
+    """Inverse of `_share`."""
+    if isinstance(value, SharedImage):
+        return value.to_image()
+    if isinstance(value, (list, tuple)):
+        return type(value)(_unshare(_) for _ in value)
+    return value
+
+def _get_target(handler: Callable) -> tuple:
+    """Get a lightweight picklable reference to the handler.
+    Handlers bound to a django model instance are sent as (module, class, pk, method) so that the (possibly huge)
+    loaded model attached to the instance is never pickled."""
+    obj = getattr(handler, '__self__', None)
+    if obj is not None and hasattr(obj, '_meta') and getattr(obj, 'pk', None) is not None:
+        cls = type(obj)
+        return ('model', cls.__module__, cls.__qualname__, obj.pk, handler.__name__)
+    return ('callable', handler)
+
+# Model replicas loaded in the child process. Only one replica per model class is kept.
+_REPLICAS: dict[type, Any] = {}
+
+def _get_replica(module: str, qualname: str, pk: Any) -> Any:
+    """Get (loading it if needed) the replica of a model in the child process."""
+    cls = getattr(importlib.import_module(module), qualname)
+    obj = _REPLICAS.get(cls)
+    if obj is not None and obj.pk == pk:
+        return obj
+    if obj is not None:
+        logger.info(f'Unloading replica of {obj} in child process {os.getpid()}')
+        obj.unload()
+    obj = cls.objects.get(pk=pk)
+    # Avoid logging a load event for every replica
+    obj.DISABLE_LOAD_EVENTS = True
+    logger.info(f'Loading replica of {obj} in child process {os.getpid()}')
+    obj.load()
+    _REPLICAS[cls] = obj
+    return obj
+
+def _child_init(setup_django: bool):
+    """Initializer of the child processes."""
+    os.environ[CHILD_ENV] = '1'
+    if setup_django:
+        import django  # pylint: disable=import-outside-toplevel
+        os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ocr_translate.app.settings')
+        django.setup()
+
+def _child_call(target: tuple, args: tuple, kwargs: dict) -> Any:
+    """Run a handler in the child process."""
+    if target[0] == 'model':
+        _, module, qualname, pk, method = target
+        func = getattr(_get_replica(module, qualname, pk), method)
+    else:
+        func = target[1]
+    return func(*_unshare(args), **{k: _unshare(v) for k, v in kwargs.items()})
+
+class ProcessExecutor():
+    """Run the handlers in child processes.
+    Handlers bound to a model are run on a replica of the model loaded in each child process (so N processes hold
+    N replicas), while images are passed through shared memory instead of being pickled.
+    The workers of the queue keep pulling/batching the messages and block on the result of the child process.
+    Every child process is its own single process pool, so that the processes can be added or removed one by one
+    (following the number of workers of the queue) while the others keep their replicas loaded.
+    """
+    def __init__(self, num_procs: int = 1, setup_django: bool = True):
+        """Create a new ProcessExecutor.
+
+        Args:
+            num_procs (int, optional): Number of child processes. Defaults to 1.
+            setup_django (bool, optional): Whether to setup django in the child processes (needed to load model
+                replicas). Defaults to True.
+        """
+        self.num_procs = 0
+        self.setup_django = setup_django
+        self._cond = threading.Condition()
+        # Every live pool, and the ones not running a call (most recently used last)
+        self._pools: list[ProcessPoolExecutor] = []
+        self._idle: list[ProcessPoolExecutor] = []
+        # Number of busy pools to shut down once their call is done (after shrinking)
+        self._excess = 0
+        self.resize(num_procs)
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        """Create a pool with a single child process (must be called with the condition acquired)."""
+        pool = ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=mp.get_context('spawn'),
+            initializer=_child_init,
+            initargs=(self.setup_django,),
+            )
+        self._pools.append(pool)
+        return pool
+
+    def resize(self, num_procs: int):
+        """Change the number of child processes.
+        Growing adds new processes (the model replicas are loaded by their first call). Shrinking shuts down the least
+        recently used idle processes first, while busy ones are shut down once their current call is done.
+        """
+        retired = []
+        with self._cond:
+            if num_procs == self.num_procs:
+                return
+            logger.info(f'Resizing process pool from {self.num_procs} to {num_procs} processes')
+            if num_procs > self.num_procs:
+                grow = num_procs - self.num_procs
+                # Keep the busy processes that were going to be shut down first
+                keep = min(grow, self._excess)
+                self._excess -= keep
+                for _ in range(grow - keep):
+                    self._idle.insert(0, self._new_pool())
+                self._cond.notify_all()
+            else:
+                shrink = self.num_procs - num_procs
+                retired, self._idle = self._idle[:shrink], self._idle[shrink:]
+                for pool in retired:
+                    self._pools.remove(pool)
+                self._excess += shrink - len(retired)
+            self.num_procs = num_procs
+        for pool in retired:
+            pool.shutdown(wait=False)
+
+    def _acquire(self) -> ProcessPoolExecutor:
+        """Wait for an idle process."""
+        with self._cond:
+            while not self._idle:
+                self._cond.wait()
+            return self._idle.pop()
+
+    def _release(self, pool: ProcessPoolExecutor, broken: bool = False):
+        """Give back a process after a call, shutting it down if the executor was shrunk in the meantime.
+        A process that died during the call is replaced by a new one."""
+        with self._cond:
+            if pool not in self._pools:
+                # The executor was shut down
+                return
+            if self._excess:
+                self._excess -= 1
+                retire = True
+            else:
+                retire = broken
+                self._idle.append(self._new_pool() if broken else pool)
+                self._cond.notify()
+            if retire:
+                self._pools.remove(pool)
+        if retire:
+            pool.shutdown(wait=False)
+
+    def call(self, handler: Callable, args: tuple, kwargs: dict) -> Any:
+        """Call the handler in a child process with the given args and kwargs."""
+        blocks = []
+        pool = self._acquire()
+        broken = False
+        try:
+            args = _share(tuple(args), blocks)
+            kwargs = {k: _share(v, blocks) for k, v in kwargs.items()}
+            future = pool.submit(_child_call, _get_target(handler), args, kwargs)
+            return future.result()
+        except BrokenProcessPool:
+            broken = True
+            raise
+        finally:
+            self._release(pool, broken=broken)
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+
+    def shutdown(self):
+        """Shutdown the child processes."""
+        with self._cond:
+            pools, self._pools, self._idle = self._pools, [], []
+            self.num_procs = 0
+            self._excess = 0
+        for pool in pools:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+EXECUTORS = {
+    'thread': ThreadExecutor,
+    'process': ProcessExecutor,
+}
+
+def get_executor(name: str, num_procs: int = 1) -> ThreadExecutor | ProcessExecutor:
+    """Create an executor by name.
+
+    Args:
+        name (str): Name of the executor (`thread` or `process`).
+        num_procs (int, optional): Number of child processes for the process executor. Defaults to 1.
+
+    Raises:
+        ValueError: If the name is not a known executor.
+    """
+    name = name.lower()
+    if name not in EXECUTORS:
+        raise ValueError(f'Unknown executor `{name}`. Allowed: {", ".join(EXECUTORS)}')
+    if name == 'process':
+        if os.environ.get(CHILD_ENV):
+            # Never spawn processes from inside a child process
+            return ThreadExecutor()
+        return ProcessExecutor(num_procs=num_procs)
+    return ThreadExecutor()
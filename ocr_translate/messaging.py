@@ -17,26 +17,126 @@
 # Home: https://github.com/Crivella/ocr_translate                                 #
 ###################################################################################
 """Messaging and worker+queue system for ocr_translate."""
+import itertools
 import logging
 import queue
 import threading
 import time
+from collections import OrderedDict, deque
 from collections.abc import Hashable, Iterable
+from contextlib import contextmanager
+from enum import IntEnum
 from typing import Callable, Union
 
+from .executors import ThreadExecutor, get_executor
+
 logger = logging.getLogger('ocr.worker')
 
+class Priority(IntEnum):
+    """Priority classes of messages. Lower values are served first."""
+    INTERACTIVE = 0
+    BULK = 1
+    PREFETCH = 2
+
+_context = threading.local()
+
+def get_current_priority() -> Priority:
+    """Return the priority class of the current context.
+    Inside a worker this is the priority of the message being resolved, so that messages generated while resolving
+    it (e.g. the box/ocr/tsl messages of a full pipeline) inherit its priority (read live, as the message is promoted
+    when a request with a higher priority reuses it)."""
+    priority = getattr(_context, 'priority', Priority.INTERACTIVE)
+    if isinstance(priority, Message):
+        return priority.priority
+    return priority
+
+@contextmanager
+def priority_context(priority: Union[Priority, 'Message']):
+    """Context manager setting the default priority class for messages put in any queue from the current thread.
+    If a message is given, its (current) priority is used."""
+    old = getattr(_context, 'priority', Priority.INTERACTIVE)
+    _context.priority = priority if isinstance(priority, Message) else Priority(priority)
+    try:
+        yield
+    finally:
+        _context.priority = old
+
+def get_current_deadline() -> float:
+    """Return the deadline (time.monotonic) of the current context, or None if there is no deadline.
+    Inside a worker this is the deadline of the message being resolved, read live as it is extended when another
+    request reuses the message."""
+    deadline = getattr(_context, 'deadline', None)
+    if isinstance(deadline, Message):
+        return deadline.deadline
+    return deadline
+
+@contextmanager
+def deadline_context(deadline: Union[float, 'Message']):
+    """Context manager setting the default deadline (time.monotonic) for messages put in any queue from the current
+    thread. If a message is given, its (current) deadline is used."""
+    old = getattr(_context, 'deadline', None)
+    _context.deadline = deadline
+    try:
+        yield
+    finally:
+        _context.deadline = old
+
+def get_current_message() -> 'Message':
+    """Return the message being resolved by the current worker thread (None outside of a worker)."""
+    return getattr(_context, 'message', None)
+
+@contextmanager
+def message_context(msg: 'Message'):
+    """Context manager used by the workers while resolving a message.
+    Messages put from inside the context inherit its priority and deadline and are registered as its children."""
+    old = get_current_message()
+    _context.message = msg
+    try:
+        with priority_context(msg), deadline_context(msg):
+            yield
+    finally:
+        _context.message = old
+
+def _direct_call(handler: Callable, args: tuple, kwargs: dict):
+    """Call the handler in the current thread."""
+    return handler(*args, **kwargs)
+
+class QueueFullError(Exception):
+    """Raised when a message is rejected because the queue reached its max depth or max number of in-flight
+    messages."""
+    def __init__(self, message: str, retry_after: float):
+        """Create a new QueueFullError.
+
+        Args:
+            message (str): Error message.
+            retry_after (float): Estimated time in seconds after which the queue should be able to accept the message.
+        """
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class MessageCancelledError(Exception):
+    """Response of a message cancelled before being resolved."""
+
+class MessageExpiredError(MessageCancelledError):
+    """Response of a message whose deadline expired before it could be resolved."""
+
+# Responses that depend on the load/deadline of the request and must not be reused by the message cache
+TRANSIENT_ERRORS = (QueueFullError, MessageCancelledError, TimeoutError)
 
 class NotHandled():
     """Dummy object to be used as default response of an unresolved message."""
 
 class Message():
     """Message object to be used in WorkerMessageQueue. This class is used to send a message in the queue, but
-    also allow the sending function to wait for the response of the message."""
+    also allow the sending function to wait for the response of the message.
+    Completion is signaled through an event, so waiters are woken up as soon as a response is set, and through
+    optional done-callbacks."""
     NotHandled = NotHandled
     def __init__(
             self, id_: Hashable, msg: dict, handler: Callable,
-            batch_args: tuple = (), batch_kwargs: Iterable = ()
+            batch_args: tuple = (), batch_kwargs: Iterable = (),
+            priority: Priority = Priority.INTERACTIVE,
+            deadline: float = None,
             ):
         """Message object to be used in WorkerMessageQueue.
 
@@ -46,37 +146,67 @@ class Message():
             handler (Callable): Handler function to be called with the message.
             batch_args (tuple, optional): Indexes of the args to be batched. Defaults to ().
             batch_kwargs (Iterable, optional): Keys of the kwargs to be batched. Defaults to ().
+            priority (Priority, optional): Priority class of the message. Defaults to Priority.INTERACTIVE.
+            deadline (float, optional): Time (time.monotonic) after which the message is not worth resolving anymore.
+                Expired messages are skipped by the workers. Defaults to None (no deadline).
         """
         self.id_ = id_
         self.msg = msg
         self.handler = handler
         self.batch_args = batch_args
         self.batch_kwargs = batch_kwargs
+        self.priority = Priority(priority)
+        self.deadline = deadline
+        # MessageQueue in which the message was put (used to move it when promoted)
+        self.queue = None
+        self.enqueued_at = None
+        self.dequeued = False
+        self.batch_id = None
+        self.cancelled = False
         self._response = NotHandled
+        self._done = threading.Event()
+        self._callbacks_lock = threading.Lock()
+        self._callbacks = []
+        self._children = []
+        self._refs = 0
 
-    def resolve(self):
+    def resolve(self, call: Callable = None):
         """Resolve the message by calling the handler with the message.
-        This operation is synchronous and will block the exection until the handler is done."""
+        This operation is synchronous and will block the exection until the handler is done.
+
+        Args:
+            call (Callable, optional): Function used to call the handler as `call(handler, args, kwargs)`
+                (e.g. an executor running it in another process). Defaults to None (call the handler directly).
+        """
+        call = call or _direct_call
         try:
-            self._response = self.handler(*self.msg.get('args', ()), **self.msg.get('kwargs', {}))
+            response = call(self.handler, self.msg.get('args', ()), self.msg.get('kwargs', {}))
         except Exception as exc:
             logger.error(f'Error resolving message {self.msg}', exc_info=True)
-            self._response = exc
+            response = exc
             # Avoid killing the worker thread
             # raise
         else:
-            logger.debug(f'MSG Resolved {self.msg} -> {self._response}')
+            logger.debug(f'MSG Resolved {self.msg} -> {response}')
 
         # Make sure to dereference the message to avoid keeping raw images in memory
         # since i am gonna keep the message in the queue after it is resolved (for msg caching)
         del self.msg
+        self.set_response(response)
 
-    def batch_resolve(self, others: Iterable['Message']):
+    def batch_resolve(self, others: Iterable['Message'], call: Callable = None):
         """Resolve multiple messages with one call to the handler.
         The handler must be able to handle the specified batched args and kwargs,
         as either the expected type or a list of the expected type.
         The handler must return a list of the same length as the number of messages to be resolved, with the same order.
+
+        Args:
+            others (Iterable[Message]): Other messages to be resolved together with this one.
+            call (Callable, optional): Function used to call the handler as `call(handler, args, kwargs)`.
+                Defaults to None (call the handler directly).
         """
+        call = call or _direct_call
+        msgs = [self, *others]
         logger.debug(f'MSG Batch Resolving {self.msg} with {len(others)} other messages')
         # Check if these checks are necessary (maybe just let the handler fail)
         # Main problem would be running messages with different non batched args that produce worng results
@@ -100,53 +230,210 @@ class Message():
             for k in self.batch_kwargs:
                 kwargs[k].append(msg.msg['kwargs'][k])
 
-        respones = self.handler(*args, **kwargs)
-        for msg, r in zip([self, *others], respones):
+        try:
+            responses = list(call(self.handler, args, kwargs))
+            if len(responses) != len(msgs):
+                raise ValueError(f'Batched handler returned {len(responses)} results for {len(msgs)} messages')
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            logger.error(f'Error batch resolving message {self.msg}', exc_info=True)
+            # Avoid killing the worker thread (and leaving the messages unresolved)
+            responses = [exc] * len(msgs)
+
+        for msg, r in zip(msgs, responses):
             logger.debug(f'MSG Batch Resolved {msg.msg} -> {r}')
-            msg.set_response(r)
 
             # Make sure to dereference the message to avoid keeping raw images in memory
             # since i am gonna keep the message in the queue after it is resolved (for msg caching)
             del msg.msg
+            msg.set_response(r)
 
     @property
     def is_resolved(self) -> bool:
         """Whether the message has been resolved or not."""
         return self._response is not NotHandled
 
+    @property
+    def expired(self) -> bool:
+        """Whether the deadline of the message has passed."""
+        return self.deadline is not None and time.monotonic() > self.deadline
+
+    def _complete(self, response, cancelled: bool = False) -> Union[list['Message'], None]:
+        """Atomically set the response (only the first call has effect), wake up the waiters and run the
+        done-callbacks.
+
+        Returns:
+            Union[list[Message], None]: The children of the message if the response was set, else None.
+        """
+        with self._callbacks_lock:
+            if self._done.is_set():
+                return None
+            self._response = response
+            self.cancelled = cancelled
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+            children, self._children = self._children, []
+        for callback in callbacks:
+            self._run_callback(callback)
+        return children
+
     def set_response(self, response):
-        """Set the response of the message."""
-        self._response = response
+        """Set the response of the message, wake up all the waiters and run the done-callbacks.
+        Does nothing if the message was already resolved or cancelled."""
+        if self._complete(response) is None:
+            logger.debug(f'Ignoring response of already completed message {self.id_}')
+
+    def cancel(self, error: MessageCancelledError = None) -> bool:
+        """Cancel the message if it is not resolved yet. Waiters are woken up (`response` raises the error) and the
+        cancellation is cascaded to the children messages (that are cancelled only if nobody else is waiting for
+        them, see `release`). A message already being resolved will run to completion, but its result is discarded.
+
+        Args:
+            error (MessageCancelledError, optional): Error used as response. Defaults to None (MessageCancelledError).
+
+        Returns:
+            bool: Whether the message was cancelled.
+        """
+        error = error or MessageCancelledError(f'Message {self.id_} cancelled')
+        children = self._complete(error, cancelled=True)
+        if children is None:
+            return False
+        logger.info(f'Cancelled message {self.id_}: {error}')
+        for child in children:
+            child.release()
+        return True
+
+    def promote(self, priority: Priority):
+        """Raise the priority class of the message (moving it ahead in its queue if still pending) for a new party
+        waiting for it. The promotion is cascaded to the children, as a message already being resolved waits for them
+        (e.g. the stage messages of a running prefetch pipeline reused by an interactive request).
+        Does nothing if the message is completed or already has an equal or higher priority."""
+        priority = Priority(priority)
+        with self._callbacks_lock:
+            if self._done.is_set() or priority >= self.priority:
+                return
+            children = list(self._children)
+        if self.queue is None:
+            self.priority = priority
+        else:
+            self.queue.promote(self, priority)
+        for child in children:
+            child.promote(priority)
+
+    def extend_deadline(self, deadline: float):
+        """Extend the deadline of the message for a new party waiting for it (None removes the deadline).
+        The extension is cascaded to the children, as a message already being resolved waits for them.
+        Does nothing if the new deadline is not later than the current one."""
+        with self._callbacks_lock:
+            if self.deadline is None or (deadline is not None and deadline <= self.deadline):
+                return
+            self.deadline = deadline
+            children = list(self._children)
+        for child in children:
+            child.extend_deadline(deadline)
+
+    def retain(self):
+        """Register one more party (request or parent message) waiting for the message."""
+        with self._callbacks_lock:
+            self._refs += 1
+
+    def release(self) -> bool:
+        """Unregister one party waiting for the message. The message is cancelled once nobody is waiting for it.
+
+        Returns:
+            bool: Whether the message was cancelled.
+        """
+        with self._callbacks_lock:
+            self._refs -= 1
+            if self._refs > 0:
+                return False
+        return self.cancel()
+
+    def add_child(self, child: 'Message'):
+        """Register a message put while resolving this one. Children are released if this message is cancelled."""
+        with self._callbacks_lock:
+            if not self._done.is_set():
+                self._children.append(child)
+                return
+            cancelled = self.cancelled
+        if cancelled:
+            child.release()
+
+    def drop_payload(self):
+        """Dereference the message content (e.g. raw images) once it is not going to be resolved."""
+        if hasattr(self, 'msg'):
+            del self.msg
+
+    def add_done_callback(self, callback: Callable[['Message'], None]):
+        """Register a function to be called with the message as argument once it is resolved.
+        If the message is already resolved, the callback is run immediately in the calling thread, otherwise it
+        will run in the thread that resolves the message.
+
+        Args:
+            callback (Callable[[Message], None]): Function to be called.
+        """
+        with self._callbacks_lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        self._run_callback(callback)
+
+    def _run_callback(self, callback: Callable[['Message'], None]):
+        """Run a done-callback making sure it does not break the resolving thread."""
+        try:
+            callback(self)
+        except Exception:
+            logger.error(f'Error running done-callback {callback} for {self}', exc_info=True)
+
+    def wait(self, timeout: float = None) -> bool:
+        """Block until the message is resolved.
+
+        Args:
+            timeout (float, optional): Timeout in seconds. Defaults to None (wait forever).
+
+        Returns:
+            bool: Whether the message was resolved.
+        """
+        return self._done.wait(timeout)
 
-    def response(self, timeout: float = 0, poll: float = 0.2):
+    def response(self, timeout: float = 0, poll: float = None):
         """Get the response of the message.
 
         Args:
             timeout (float, optional): Timeout in seconds to wait for the message to be resolved.
-                Defaults to 0 (no timeout).
-            poll (float, optional): Polling interval in seconds. Defaults to 0.2.
+                Defaults to 0 (wait until the deadline of the current context if any, see `deadline_context`,
+                else forever). The deadline of the context is followed if it is extended while waiting.
+            poll (float, optional): Ignored. Kept for backward compatibility since the waiting is now
+                event driven.
 
         Raises:
             TimeoutError: If the message is not resolved after the timeout.
+            MessageCancelledError: If the message was cancelled (or expired) instead of being resolved.
 
         Returns:
             Any: The response of the message (return value of the handler called on the msg content).
         """
-        start = time.time()
-
-        while not self.is_resolved:
-
-            if time.time() - start > timeout > 0:
+        if poll is not None:
+            logger.debug('Message.response: `poll` is deprecated and ignored')
+        if timeout > 0:
+            if not self.wait(timeout):
                 raise TimeoutError('Message resolution timed out')
-            time.sleep(poll)
+        else:
+            while True:
+                deadline = get_current_deadline()
+                if self.wait(None if deadline is None else max(deadline - time.monotonic(), 0)):
+                    break
+                if get_current_deadline() == deadline:
+                    raise TimeoutError('Message resolution timed out')
 
+        if self.cancelled:
+            raise type(self._response)(*self._response.args)
         return self._response
 
     def __repr__(self):
-        return f'Message({self.msg}), Handler: {self.handler.__name__}'
+        return f'Message({getattr(self, "msg", None)}), Handler: {self.handler.__name__}'
 
     def __str__(self):
-        return f'Message({self.msg}), Handler: {self.handler.__name__}'
+        return f'Message({getattr(self, "msg", None)}), Handler: {self.handler.__name__}'
 
     def __eq__(self, __value: object) -> bool:
         if not isinstance(__value, Message):
@@ -162,118 +449,569 @@ class Message():
         """Return a copy of the message. Used for tests."""
         return Message(
             self.id_, dict(self.msg), self.handler,
-            batch_args=self.batch_args, batch_kwargs=self.batch_kwargs
+            batch_args=self.batch_args, batch_kwargs=self.batch_kwargs,
+            priority=self.priority, deadline=self.deadline
             )
 
-class MessageQueue(queue.SimpleQueue):
-    """Message queue with worker threads to resolve messages. This class extends queue.SimpleQueue, by adding:
+class MessageCache():
+    """Bounded cache of messages used by MessageQueue for message reuse.
+    Messages are kept in LRU order and evicted when either the max number of entries is exceeded or they have not been
+    accessed for more than the max age (the age of an entry is the time since its last access, both on lookup and on
+    eviction, so that hot entries are kept).
+    Unresolved messages are never evicted, as other requests might still attach to them.
+    """
+    def __init__(self, max_len: int = 0, max_age: float = 0):
+        """Create a new MessageCache.
+
+        Args:
+            max_len (int, optional): Max number of messages in the cache. Defaults to 0 (no limit).
+            max_age (float, optional): Max time in seconds since the last access of a message in the cache.
+                Defaults to 0 (no limit).
+        """
+        self.max_len = max_len
+        self.max_age = max_age
+        # id_ -> [message, creation_time, last_access_time]
+        self._data: OrderedDict[Hashable, list] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, id_: Hashable) -> bool:
+        return id_ in self._data
+
+    def _is_expired(self, last_access: float, now: float) -> bool:
+        """Whether an entry last accessed at `last_access` is older than max_age."""
+        return self.max_age > 0 and now - last_access > self.max_age
+
+    def _pop(self, id_: Hashable):
+        """Remove an entry from the cache and count it as an eviction."""
+        del self._data[id_]
+        self.evictions += 1
+        logger.debug(f'Evicted message {id_} from cache')
+
+    def get(self, id_: Hashable, default: 'Message' = None) -> 'Message':
+        """Get a message from the cache, updating the hit/miss counters and the LRU order.
+
+        Args:
+            id_ (Hashable): Id of the message.
+            default (Message, optional): Value to return if the message is not in the cache. Defaults to None.
+
+        Returns:
+            Message: The cached message or `default`.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(id_)
+            if entry is not None and entry[0].is_resolved and self._is_expired(entry[2], now):
+                self._pop(id_)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            entry[2] = now
+            self._data.move_to_end(id_)
+            return entry[0]
+
+    def peek(self, id_: Hashable, default: 'Message' = None) -> 'Message':
+        """Get a message from the cache without affecting counters or LRU order."""
+        with self._lock:
+            entry = self._data.get(id_)
+        return default if entry is None else entry[0]
+
+    def add(self, msg: 'Message'):
+        """Add a message to the cache and evict old resolved messages if needed."""
+        now = time.monotonic()
+        with self._lock:
+            self._data[msg.id_] = [msg, now, now]
+            self._data.move_to_end(msg.id_)
+            self._evict(now)
+
+    def remove(self, id_: Hashable):
+        """Remove a message from the cache (does nothing if not present)."""
+        with self._lock:
+            self._data.pop(id_, None)
+
+    def _evict(self, now: float):
+        """Evict resolved messages that are too old or exceed the max number of entries (least recently used first).
+        Must be called with the lock acquired."""
+        excess = len(self._data) - self.max_len if self.max_len > 0 else 0
+        evict = []
+        for id_, (msg, _, last_access) in self._data.items():
+            # Entries are in LRU order: once there is no excess and the entries are recently accessed
+            # there is nothing left to evict
+            if excess <= len(evict) and not self._is_expired(last_access, now):
+                break
+            if msg.is_resolved:
+                evict.append(id_)
+        for id_ in evict:
+            self._pop(id_)
+
+    def stats(self) -> dict[str, int]:
+        """Return the cache counters."""
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+class AdaptiveBatcher():
+    """Decide how long a batch pool should wait for incoming messages before being flushed.
+    The pool is flushed when either:
+        - it reaches `max_size` messages
+        - `max_wait` seconds have passed since the first message was taken from the queue
+        - no new message arrived for an idle window that adapts to the observed arrival rate:
+          with a dense stream of messages the window is about twice the average time between arrivals, while with
+          sparse messages (no benefit expected from waiting) it shrinks down to `min_wait`.
+    """
+    def __init__(self, max_size: int = 0, max_wait: float = 0.5, min_wait: float = 0.01, smoothing: float = 0.3):
+        """Create a new AdaptiveBatcher.
+
+        Args:
+            max_size (int, optional): Max (and target) size of a batch. Defaults to 0 (no limit).
+            max_wait (float, optional): Max time in seconds to wait for a batch to fill. Defaults to 0.5.
+            min_wait (float, optional): Min idle window in seconds. Defaults to 0.01.
+            smoothing (float, optional): Smoothing factor for the exponential moving average of the time between
+                arrivals. Defaults to 0.3.
+        """
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.min_wait = min_wait
+        self.smoothing = smoothing
+        self.interarrival = None
+        self._last_arrival = None
+
+    def record_arrival(self, now: float = None):
+        """Update the estimate of the time between arrivals with a new message."""
+        now = time.monotonic() if now is None else now
+        if self._last_arrival is not None:
+            # Cap the gaps between bursts to avoid them dominating the estimate
+            delta = min(now - self._last_arrival, self.max_wait)
+            if self.interarrival is None:
+                self.interarrival = delta
+            else:
+                self.interarrival += self.smoothing * (delta - self.interarrival)
+        self._last_arrival = now
+
+    def idle_window(self) -> float:
+        """Time to wait for the next message before flushing the pool."""
+        if self.interarrival is None:
+            return self.min_wait
+        window = 2 * self.interarrival
+        if window > self.max_wait:
+            return self.min_wait
+        return max(window, self.min_wait)
+
+    def is_full(self, size: int) -> bool:
+        """Whether a pool of the given size should be flushed immediately."""
+        return self.max_size > 0 and size >= self.max_size
+
+class BatchPool():
+    """Messages of the same batch id waiting to be claimed together, in arrival order.
+    All operations are O(1) (per message)."""
+    def __init__(self):
+        self._messages: dict[int, Message] = {}
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def __contains__(self, msg: Message) -> bool:
+        return id(msg) in self._messages
+
+    def __iter__(self):
+        return iter(self._messages.values())
+
+    def add(self, msg: Message):
+        """Add a message to the pool."""
+        self._messages[id(msg)] = msg
+
+    def discard(self, msg: Message):
+        """Remove a message from the pool (does nothing if not present)."""
+        self._messages.pop(id(msg), None)
+
+    def take(self, num: int) -> list[Message]:
+        """Remove and return the (up to) `num` oldest messages of the pool."""
+        res = list(itertools.islice(self._messages.values(), num))
+        for msg in res:
+            del self._messages[id(msg)]
+        return res
+
+class MessageQueue():
+    """Message queue with worker threads to resolve messages. This class works as a queue.SimpleQueue, adding:
+        - Priority classes (see Priority) with aging, so that low priority messages are never starved
         - Message caching/reuse (When a new message with the same id is put in the queue, the old one is returned)
         - Message batching (Messages with the same batch_id are grouped together and resolved with one handler call)
     """
     def __init__(
             self,
-            *args,
             reuse_msg: bool = True,
-            # max_len: int = 0,
+            max_len: int = 0,
+            max_age: float = 0,
             allow_batching: bool = False,
             batch_timeout: float = 0.5,
+            batch_size: int = 0,
+            batch_min_wait: float = 0.01,
             batch_args: tuple = (), batch_kwargs: Iterable = (),
-            **kwargs
+            aging_time: float = 10,
+            max_depth: int = 0,
+            max_inflight: int = 0,
             ):
         """Create a new WorkerMessageQueue.
 
         Args:
             reuse_msg (bool, optional): Whether to reuse messages with the same id. Defaults to True.
             max_len (int, optional): Max number of messages in cache before starting to remove solved messages
-                from cache. Defaults to 0 (no limit).
+                from cache (least recently used first). Defaults to 0 (no limit).
+            max_age (float, optional): Max age in seconds of a solved message in cache. Defaults to 0 (no limit).
             allow_batching (bool, optional): Whether to allow batching of messages. Defaults to False.
-            batch_timeout (float, optional): Timeout for batching. When get is called, wait `timeout` seconds for other
-                incoming messages. Defaults to 0.5.
+            batch_timeout (float, optional): Max wait for batching. When get is called, wait at most `timeout`
+                seconds for other incoming messages (see AdaptiveBatcher). Defaults to 0.5.
+            batch_size (int, optional): Max size of a batch. The batch is flushed early once this size is reached.
+                Defaults to 0 (no limit).
+            batch_min_wait (float, optional): Min idle window to wait for new messages. Defaults to 0.01.
             batch_args (tuple, optional): Indexes of the args to be batched. Defaults to ().
             batch_kwargs (Iterable, optional): Keys of the kwargs to be batched. Defaults to ().
+            aging_time (float, optional): Time in seconds after which a waiting message is considered as one
+                priority class higher. Defaults to 10.
+            max_depth (int, optional): Max number of messages waiting to be consumed. New messages are rejected with
+                a QueueFullError once reached. Defaults to 0 (no limit).
+            max_inflight (int, optional): Max number of messages accepted and not yet resolved (waiting or being
+                resolved). New messages are rejected with a QueueFullError once reached. Defaults to 0 (no limit).
         """
-        super().__init__(*args, **kwargs)
-        self.registered = {}
-        self.batch_pools = {}
-        self.msg_to_batch_pool = {}
-        self.batch_resolve_flagged = []
+        self._queues: dict[Priority, deque[Message]] = {priority: deque() for priority in Priority}
+        # Single lock shared by the queue and the batch pools, so that a message can never be both dequeued and
+        # claimed in a batch by different workers
+        self._lock = threading.RLock()
+        self._not_empty = threading.Condition(self._lock)
+        self.aging_time = aging_time
+        self.max_depth = max_depth
+        self.max_inflight = max_inflight
+        self.num_consumers = 1
+        self.service_time = None
+        self.default_service_time = 1.0
+        self.service_smoothing = 0.3
+        self._pending = 0
+        self._inflight = 0
+        self.rejected = 0
+        self.registered = MessageCache(max_len=max_len, max_age=max_age)
+        self.batch_pools: dict[Hashable, BatchPool] = {}
         self.reuse_msg = reuse_msg
-        # self.max_len = max_len
         if allow_batching:
             if len(batch_args) == 0 and len(batch_kwargs) == 0:
                 raise ValueError('At least one batch arg or kwarg must be specified with batching enabled.')
         self.allow_batching = allow_batching
         self.batch_timeout = batch_timeout
+        self.batcher = AdaptiveBatcher(max_size=batch_size, max_wait=batch_timeout, min_wait=batch_min_wait)
+        self._batch_cond = threading.Condition(self._lock)
         self.batch_args = batch_args
         self.batch_kwargs = batch_kwargs
 
-    def put(self, id_: Hashable, msg: dict, handler: Callable, batch_id: Hashable = None) -> Message:
+    def qsize(self) -> int:
+        """Return the approximate number of messages in the queue."""
+        return sum(len(_) for _ in self._queues.values())
+
+    def empty(self) -> bool:
+        """Return True if the queue is empty."""
+        return self.qsize() == 0
+
+    @property
+    def depth(self) -> int:
+        """Number of messages waiting to be consumed."""
+        return self._pending
+
+    @property
+    def inflight(self) -> int:
+        """Number of messages accepted and not yet resolved."""
+        return self._inflight
+
+    def record_service(self, elapsed: float, count: int = 1):
+        """Update the moving average of the time needed to resolve one message.
+
+        Args:
+            elapsed (float): Time in seconds spent resolving the messages.
+            count (int, optional): Number of messages resolved together (batch). Defaults to 1.
+        """
+        sample = elapsed / max(count, 1)
+        with self._not_empty:
+            if self.service_time is None:
+                self.service_time = sample
+            else:
+                self.service_time += self.service_smoothing * (sample - self.service_time)
+
+    def estimate_wait(self) -> float:
+        """Estimate the time in seconds before a new message would be picked up, from the current depth and the
+        measured service time."""
+        service_time = self.service_time if self.service_time is not None else self.default_service_time
+        return (self._pending + 1) * service_time / max(self.num_consumers, 1)
+
+    def _admit(self):
+        """Check the depth and in-flight limits before accepting a new message and reserve its slots.
+        Must be called with the lock acquired.
+
+        Raises:
+            QueueFullError: If any of the limits is reached.
+        """
+        reason = None
+        if self.max_depth > 0 and self._pending >= self.max_depth:
+            reason = f'max depth ({self.max_depth})'
+        elif self.max_inflight > 0 and self._inflight >= self.max_inflight:
+            reason = f'max in-flight messages ({self.max_inflight})'
+        if reason is not None:
+            self.rejected += 1
+            retry_after = self.estimate_wait()
+            logger.warning(f'Queue full: reached {reason}. Retry after {retry_after:.1f}s')
+            raise QueueFullError(f'Queue full: reached {reason}', retry_after=retry_after)
+        # Reserve the slots here so that concurrent puts can not exceed the limits
+        self._pending += 1
+        self._inflight += 1
+
+    def reserve(self) -> Callable[[], None]:
+        """Reserve an in-flight slot, subject to the admission control, for work run outside of the queue (e.g. a
+        pipeline streamed from the request thread), so that it is counted against `max_inflight`.
+
+        Returns:
+            Callable[[], None]: Function releasing the slot (can be called more than once).
+
+        Raises:
+            QueueFullError: If any of the limits is reached.
+        """
+        with self._not_empty:
+            self._admit()
+            # Never waiting to be consumed
+            self._pending -= 1
+        once = threading.Lock()
+        def release():
+            if not once.acquire(blocking=False):
+                return
+            with self._not_empty:
+                self._inflight -= 1
+        return release
+
+    def _on_done(self, msg: Message):
+        """Done-callback releasing the in-flight slot of a message."""
+        with self._not_empty:
+            self._inflight -= 1
+        if self.reuse_msg and (msg.cancelled or isinstance(msg.response(), TRANSIENT_ERRORS)):
+            # Do not serve a cancellation or a transient failure (e.g. a rejection or a timeout from a downstream
+            # queue) to later requests
+            if self.registered.peek(msg.id_) is msg:
+                self.registered.remove(msg.id_)
+
+    def _mark_dequeued(self, msg: Message):
+        """Flag a message as taken from the queue (and from its batch pool). Must be called with the lock acquired."""
+        msg.dequeued = True
+        self._pending -= 1
+        if msg.batch_id is not None:
+            pool = self.batch_pools.get(msg.batch_id)
+            if pool is not None:
+                pool.discard(msg)
+                if not pool:
+                    del self.batch_pools[msg.batch_id]
+
+    def _enqueue(self, msg: Message):
+        """Add a message to the deque of its priority class."""
+        with self._not_empty:
+            msg.enqueued_at = time.monotonic()
+            self._queues[msg.priority].append(msg)
+            self._not_empty.notify()
+
+    def _select(self) -> tuple[Priority, Message]:
+        """Pop the next message to be served. Must be called with the lock acquired on a non empty queue.
+        The head of every priority class is scored by its priority minus the number of `aging_time` intervals it has
+        been waiting for, and the lowest score is served (ties go to the higher priority class).
+
+        Returns:
+            tuple[Priority, Message]: The priority class the message was taken from and the message.
+        """
+        now = time.monotonic()
+        best = None
+        for priority, ptr in self._queues.items():
+            if not ptr:
+                continue
+            score = priority - (now - ptr[0].enqueued_at) / self.aging_time
+            if best is None or score < best[0]:
+                best = (score, priority)
+        return best[1], self._queues[best[1]].popleft()
+
+    def _dequeue(self, block: bool = True, timeout: float = None) -> Message:
+        """Get the next message with the same semantic of queue.SimpleQueue.get."""
+        with self._not_empty:
+            while True:
+                if self.empty():
+                    if not block:
+                        raise queue.Empty
+                    if not self._not_empty.wait_for(lambda: not self.empty(), timeout=timeout):
+                        raise queue.Empty
+                priority, msg = self._select()
+                # Skip stale entries of messages that have been promoted to a higher priority class
+                if msg.priority == priority and not msg.dequeued:
+                    self._mark_dequeued(msg)
+                    return msg
+
+    def promote(self, msg: Message, priority: Priority):
+        """Move a message of this queue to a higher priority class, ahead of the lower priority ones if it is still
+        pending (does nothing if it has an equal or higher priority). Use `Message.promote` to also promote its
+        children."""
+        priority = Priority(priority)
+        with self._not_empty:
+            if msg.is_resolved or priority >= msg.priority:
+                return
+            logger.debug(f'Promoting message {msg.id_} from {msg.priority.name} to {priority.name}')
+            msg.priority = priority
+            if msg.dequeued:
+                # Being resolved: only the messages it puts from now on inherit the new priority
+                return
+            self._queues[priority].append(msg)
+            self._not_empty.notify()
+
+    def put(
+            self, id_: Hashable, msg: dict, handler: Callable, batch_id: Hashable = None,
+            priority: Priority = None, deadline: float = None,
+            ) -> Message:
         """Put a new message in the queue.
+        When called while resolving another message (e.g. from a full pipeline) the new message is registered as
+        its child, so that cancelling the parent also cancels it.
 
         Args:
             id_ (Hashable): Id of the message. Used to identify messages with the same id.
             msg (dict): Message to be passed to the handler.
             handler (Callable): Handler function to be called with the message.
             batch_id (Hashable, optional): Id of the batch to which the message belongs. Defaults to None.
+            priority (Priority, optional): Priority class of the message. Defaults to None (use the priority of the
+                current context, see `priority_context`). If a message with the same id and lower priority is
+                reused, it is promoted to this priority together with its children (see `Message.promote`).
+            deadline (float, optional): Time (time.monotonic) after which the message is skipped by the workers.
+                Defaults to None (use the deadline of the current context, see `deadline_context`).
+                If a message with the same id is reused, its deadline is extended to this one (also if it is already
+                being resolved: the extension is cascaded to its children, see `Message.extend_deadline`).
 
         Raises:
-            NotImplementedError: If the max_len is reached.
+            ValueError: If batching is requested but not allowed.
+            QueueFullError: If the message is new and the queue reached its max depth or in-flight messages.
+                Reused messages are never rejected.
+            MessageCancelledError: If called while resolving a message that has been cancelled.
 
         Returns:
             Message: The message object.
         """
         if batch_id is not None and not self.allow_batching:
             raise ValueError('Batching is not allowed')
+        if priority is None:
+            priority = get_current_priority()
+        if deadline is None:
+            deadline = get_current_deadline()
+        parent = get_current_message()
+        if parent is not None and parent.cancelled:
+            # Stop a cancelled pipeline from generating more work
+            raise MessageCancelledError(f'Parent message {parent.id_} cancelled')
 
-        if self.reuse_msg and id_ in self.registered:
-            logger.debug(f'Reusing message {id_}')
-            return self.registered[id_]
-        # if self.max_len > 0 and self.qsize() > self.max_len:
-        #     # Remove solved messages from cache
-        #     # Only 1by1 or all?
-        #     raise NotImplementedError('Max len reached')
-
-        res = Message(id_, msg, handler, batch_args=self.batch_args, batch_kwargs=self.batch_kwargs)
-        if self.allow_batching and batch_id is not None:
-            self.msg_to_batch_pool[id_] = batch_id
-            ptr = self.batch_pools.setdefault(batch_id, [])
-            ptr.append(res)
+        if self.reuse_msg:
+            cached = self.registered.get(id_)
+            if cached is not None and not cached.cancelled:
+                logger.debug(f'Reusing message {id_}')
+                cached.promote(priority)
+                cached.extend_deadline(deadline)
+                cached.retain()
+                if parent is not None:
+                    parent.add_child(cached)
+                return cached
 
+        with self._not_empty:
+            self._admit()
+        res = Message(
+            id_, msg, handler, batch_args=self.batch_args, batch_kwargs=self.batch_kwargs, priority=priority,
+            deadline=deadline,
+            )
+        res.queue = self
+        res.add_done_callback(self._on_done)
+        res.retain()
+        if parent is not None:
+            parent.add_child(res)
         if self.reuse_msg:
-            self.registered[id_] = res
+            self.registered.add(res)
 
-        super().put(res)
+        with self._lock:
+            if self.allow_batching and batch_id is not None:
+                res.batch_id = batch_id
+                self.batch_pools.setdefault(batch_id, BatchPool()).add(res)
+                self.batcher.record_arrival()
+                self._batch_cond.notify_all()
+            self._enqueue(res)
 
         return res
 
-    def get(self, *args, **kwargs) -> Union[Message, list[Message]]:
+    def get(self, block: bool = True, timeout: float = None) -> Union[Message, list[Message]]:
         """Get a message or list of messages from the queue.
 
+        Args:
+            block (bool, optional): Whether to block until a message is available. Defaults to True.
+            timeout (float, optional): Max time to block. Defaults to None (no timeout).
+
+        Raises:
+            queue.Empty: If no message is available.
+
         Returns:
             Union[Message, list[Message]]: A message or a list of messages, depending on whether batching is enabled.
         """
-        msg = super().get(*args, **kwargs)
-        while msg.id_ in self.batch_resolve_flagged:
-            self.batch_resolve_flagged.remove(msg.id_)
-            msg = super().get(*args, **kwargs)
-
-        if self.allow_batching and msg.id_ in self.msg_to_batch_pool:
-            # Wait for more messages to come
-            logger.debug(f'Batching message {msg.id_}')
-            time.sleep(self.batch_timeout)
-
-            logger.debug(f'Batching message {msg.id_} done')
-            pool_id = self.msg_to_batch_pool[msg.id_]
-            logger.debug(f'Batching message {msg.id_} pool id {pool_id}')
-            pool = self.batch_pools.pop(pool_id)
-            logger.debug(f'Batching message {msg.id_} pool {pool}')
-            for msg in pool:
-                self.msg_to_batch_pool.pop(msg.id_)
-                self.batch_resolve_flagged.append(msg.id_)
-            return pool
+        msg = self._dequeue(block=block, timeout=timeout)
+        while self._skip(msg):
+            msg = self._dequeue(block=block, timeout=timeout)
+
+        if msg.batch_id is not None:
+            return self._collect_batch(msg)
 
         return msg
 
+    @staticmethod
+    def _skip(msg: Message) -> bool:
+        """Check if a message taken from the queue should not be resolved (cancelled or expired while waiting)."""
+        if msg.expired:
+            msg.cancel(MessageExpiredError(f'Message {msg.id_} expired before being resolved'))
+        if msg.is_resolved:
+            logger.debug(f'Skipping message {msg.id_} cancelled while waiting')
+            msg.drop_payload()
+            return True
+        return False
+
+    def _collect_batch(self, first: Message) -> list[Message]:
+        """Wait for the batch pool of `first` to fill up (as decided by the batcher) and claim it.
+        Messages exceeding the max batch size are left in the pool to be collected by the next `get`.
+        Several workers can collect different pools (or the same pool) concurrently: claiming is atomic."""
+        batcher = self.batcher
+        pool_id = first.batch_id
+        logger.debug(f'Batching message {first.id_} pool id {pool_id}')
+
+        def pool_size():
+            # `first` has already been removed from the pool when dequeued
+            return len(self.batch_pools.get(pool_id, ())) + 1
+
+        with self._batch_cond:
+            now = time.monotonic()
+            deadline = now + batcher.max_wait
+            idle_deadline = now + batcher.idle_window()
+            size = pool_size()
+            while not batcher.is_full(size) and now < min(deadline, idle_deadline):
+                self._batch_cond.wait(min(deadline, idle_deadline) - now)
+                now = time.monotonic()
+                new_size = pool_size()
+                if new_size != size:
+                    size = new_size
+                    idle_deadline = now + batcher.idle_window()
+
+            others = []
+            pool = self.batch_pools.get(pool_id)
+            if pool is not None:
+                others = pool.take(batcher.max_size - 1 if batcher.max_size > 0 else len(pool))
+                for msg in others:
+                    self._mark_dequeued(msg)
+            logger.debug(f'Batching message {first.id_} done: {len(others) + 1} messages')
+        return [first] + [msg for msg in others if not self._skip(msg)]
+
     def get_msg(self, msg_id: str):
         """Get a message from the cache. If the message is not in the cache, return None.
 
@@ -286,14 +1024,29 @@ class MessageQueue(queue.SimpleQueue):
         if not self.reuse_msg:
             raise ValueError('Message caching is disabled')
 
-        return self.registered.get(msg_id, None)
+        return self.registered.peek(msg_id, None)
+
+    def cache_stats(self) -> dict[str, int]:
+        """Return the size and hit/miss/eviction counters of the message cache."""
+        return self.registered.stats()
 
 class Worker():
     """Worker object to be used in WorkerMessageQueue."""
-    def __init__(self, attached_queue: MessageQueue, poll_interval: float = .2):
+    def __init__(self, attached_queue: MessageQueue, poll_interval: float = .2, executor: ThreadExecutor = None):
+        """Create a new Worker.
+
+        Args:
+            attached_queue (MessageQueue): Queue from which to consume messages.
+            poll_interval (float, optional): Max time to block on the queue before checking if the worker has been
+                stopped. Defaults to .2.
+            executor (ThreadExecutor | ProcessExecutor, optional): Executor used to run the handlers.
+                Defaults to None (run in the worker thread).
+        """
         self.queue = attached_queue
+        self.executor = executor or ThreadExecutor()
         self.kill = False
         self.running = False
+        self.busy = False
         self.thread = None
         self.poll_interval = poll_interval
 
@@ -306,13 +1059,28 @@ class Worker():
             except queue.Empty:
                 continue
             logger.debug(f'Worker consuming {msg}')
-            if isinstance(msg, list):
-                if len(msg) == 1:
-                    msg[0].resolve()
+            self.busy = True
+            start = time.monotonic()
+            try:
+                if isinstance(msg, list):
+                    deadlines = [_.deadline for _ in msg]
+                    deadline = None if None in deadlines else max(deadlines)
+                    with priority_context(min(_.priority for _ in msg)), deadline_context(deadline):
+                        if len(msg) == 1:
+                            msg[0].resolve(call=self.executor.call)
+                        else:
+                            msg[0].batch_resolve(msg[1:], call=self.executor.call)
                 else:
-                    msg[0].batch_resolve(msg[1:])
-            else:
-                msg.resolve()
+                    with message_context(msg):
+                        msg.resolve(call=self.executor.call)
+            except Exception as exc:  # pylint: disable=broad-exception-caught
+                # Errors of the handlers are already the responses: this is a batch that could not be run at all
+                logger.error(f'Worker failed to resolve {msg}', exc_info=True)
+                for unresolved in (msg if isinstance(msg, list) else [msg]):
+                    unresolved.set_response(exc)
+            finally:
+                self.queue.record_service(time.monotonic() - start, len(msg) if isinstance(msg, list) else 1)
+                self.busy = False
 
         self.running = False
 
@@ -322,25 +1090,91 @@ class Worker():
         self.thread = threading.Thread(target=self._worker, daemon=True)
         self.thread.start()
 
-    def stop(self):
-        """Stop the worker thread."""
+    def stop(self, wait: bool = True):
+        """Stop the worker thread.
+
+        Args:
+            wait (bool, optional): Whether to wait for the thread to finish (the message being resolved, if any,
+                is always completed). Defaults to True.
+        """
         self.kill = True
-        self.thread.join()
+        if wait:
+            self.thread.join()
 
 class WorkerMessageQueue():
-    """Bundle together the queue and its workers."""
-    def __init__(self, *args, num_workers: int = 1, **kwargs):
+    """Bundle together the queue and its workers.
+    The number of workers is adjusted between `min_workers` and `max_workers` by an autoscaler thread based on the
+    backlog of the queue and the utilisation of the workers."""
+    def __init__(
+            self, num_workers: int = 1, executor: str = 'thread',
+            min_workers: int = None, max_workers: int = None,
+            scale_interval: float = 1.0, scale_down_delay: float = 30.0,
+            **kwargs
+            ):
         """Create a new WorkerMessageQueue.
 
         Args:
             num_workers (int, optional): Number of workers to spawn. Defaults to 1.
+            executor (str, optional): Where the handlers are run. `thread` runs them in the worker threads,
+                `process` in one child process per worker (each with its own replica of the model), added and removed
+                together with the workers. Defaults to 'thread'.
+            min_workers (int, optional): Min number of workers kept by the autoscaler.
+                Defaults to None (same as `num_workers`).
+            max_workers (int, optional): Max number of workers spawned by the autoscaler.
+                Defaults to None (same as `num_workers`, no autoscaling).
+            scale_interval (float, optional): Seconds between two autoscaler checks. Defaults to 1.0.
+            scale_down_delay (float, optional): Seconds for which workers must be idle before one is removed.
+                Defaults to 30.0.
+            **kwargs: Arguments passed to MessageQueue (e.g. `max_depth` and `max_inflight` for admission control).
         """
-        self.msg_queue = MessageQueue(*args, **kwargs)
-        self.workers = [Worker(self.msg_queue) for _ in range(num_workers)]
+        self.min_workers = num_workers if min_workers is None else min_workers
+        self.max_workers = max(num_workers if max_workers is None else max_workers, self.min_workers)
+        num_workers = min(max(num_workers, self.min_workers), self.max_workers)
+        self.scale_interval = scale_interval
+        self.scale_down_delay = scale_down_delay
+        self.msg_queue = MessageQueue(**kwargs)
+        self.msg_queue.num_consumers = num_workers
+        self.executor = get_executor(executor, num_procs=num_workers)
+        self.workers = [Worker(self.msg_queue, executor=self.executor) for _ in range(num_workers)]
+        self.running = False
+        self._scale_lock = threading.RLock()
+        self._stop_scaling = threading.Event()
+        self._autoscaler = None
+        self._idle_since = None
+        self._reserved = 0
 
-    def put(self, id_: Hashable, msg: dict, handler: Callable, batch_id: Hashable = None) -> Message:
+    def put(
+            self, id_: Hashable, msg: dict, handler: Callable, batch_id: Hashable = None,
+            priority: Priority = None, deadline: float = None,
+            ) -> Message:
         """Call the put method of the queue."""
-        return self.msg_queue.put(id_, msg, handler, batch_id=batch_id)
+        return self.msg_queue.put(id_, msg, handler, batch_id=batch_id, priority=priority, deadline=deadline)
+
+    def reserve(self) -> Callable[[], None]:
+        """Reserve a slot for work run outside of the workers (see `MessageQueue.reserve`).
+        At most `max_workers` slots can be reserved at the same time, to keep the same concurrency bound as the
+        messages resolved by the workers.
+
+        Raises:
+            QueueFullError: If the admission limits of the queue or the number of reserved slots are reached.
+        """
+        with self._scale_lock:
+            if self._reserved >= self.max_workers:
+                self.msg_queue.rejected += 1
+                raise QueueFullError(
+                    f'Queue full: reached max concurrent external runs ({self.max_workers})',
+                    retry_after=self.msg_queue.estimate_wait(),
+                    )
+            release_slot = self.msg_queue.reserve()
+            self._reserved += 1
+        once = threading.Lock()
+        def release():
+            if not once.acquire(blocking=False):
+                return
+            release_slot()
+            with self._scale_lock:
+                self._reserved -= 1
+        return release
 
     def get(self, *args, **kwargs) -> Union[Message, list[Message]]:
         """Call the get method of the queue."""
@@ -350,12 +1184,288 @@ class WorkerMessageQueue():
         """Call the get_msg method of the queue."""
         return self.msg_queue.get_msg(msg_id)
 
+    def cache_stats(self) -> dict[str, int]:
+        """Call the cache_stats method of the queue."""
+        return self.msg_queue.cache_stats()
+
+    def stats(self) -> dict:
+        """Return the current state of the queue and of its worker pool."""
+        with self._scale_lock:
+            return {
+                'workers': len(self.workers),
+                'busy_workers': sum(worker.busy for worker in self.workers),
+                'min_workers': self.min_workers,
+                'max_workers': self.max_workers,
+                'depth': self.msg_queue.depth,
+                'inflight': self.msg_queue.inflight,
+                'rejected': self.msg_queue.rejected,
+                'service_time': self.msg_queue.service_time,
+                'cache': self.cache_stats(),
+            }
+
+    def scale_to(self, num_workers: int) -> int:
+        """Add or remove workers to reach `num_workers` (clamped between `min_workers` and `max_workers`).
+        Idle workers are removed first. Removed workers complete the message they are resolving, if any.
+
+        Returns:
+            int: The new number of workers.
+        """
+        with self._scale_lock:
+            num_workers = min(max(num_workers, self.min_workers), self.max_workers)
+            current = len(self.workers)
+            if num_workers > current:
+                logger.info(f'Scaling up queue workers {current} -> {num_workers}')
+                for _ in range(num_workers - current):
+                    worker = Worker(self.msg_queue, executor=self.executor)
+                    if self.running:
+                        worker.start()
+                    self.workers.append(worker)
+            elif num_workers < current:
+                logger.info(f'Scaling down queue workers {current} -> {num_workers}')
+                # Stable sort: idle workers first, newest first
+                ordered = sorted(reversed(self.workers), key=lambda worker: worker.busy)
+                removed, kept = ordered[:current - num_workers], ordered[current - num_workers:]
+                self.workers = [worker for worker in self.workers if worker in kept]
+                for worker in removed:
+                    if worker.thread is not None:
+                        worker.stop(wait=False)
+            self.msg_queue.num_consumers = len(self.workers)
+            # One child process per worker with the process executor (replicas are only paid for the workers in use)
+            self.executor.resize(len(self.workers))
+            return len(self.workers)
+
+    def set_bounds(self, min_workers: int = None, max_workers: int = None) -> int:
+        """Change the bounds of the worker pool at runtime and rescale the pool to fit within them.
+
+        Args:
+            min_workers (int, optional): New min number of workers. Defaults to None (unchanged).
+            max_workers (int, optional): New max number of workers. Defaults to None (unchanged).
+
+        Raises:
+            ValueError: If the bounds are not valid.
+
+        Returns:
+            int: The new number of workers.
+        """
+        with self._scale_lock:
+            min_workers = self.min_workers if min_workers is None else int(min_workers)
+            max_workers = self.max_workers if max_workers is None else int(max_workers)
+            if min_workers < 1:
+                raise ValueError('min_workers must be at least 1')
+            if max_workers < min_workers:
+                raise ValueError('max_workers must be greater or equal to min_workers')
+            self.min_workers = min_workers
+            self.max_workers = max_workers
+            return self.scale_to(len(self.workers))
+
+    def autoscale(self, now: float = None) -> int:
+        """Run one autoscaler step.
+        Scale up immediately to cover the backlog (busy workers + waiting messages), scale down by one worker
+        after some workers have been idle with an empty queue for `scale_down_delay` seconds.
+
+        Args:
+            now (float, optional): Current time (time.monotonic). Defaults to None (use the current time).
+
+        Returns:
+            int: The new number of workers.
+        """
+        now = time.monotonic() if now is None else now
+        with self._scale_lock:
+            current = len(self.workers)
+            busy = sum(worker.busy for worker in self.workers)
+            depth = self.msg_queue.depth
+            if busy + depth > current:
+                self._idle_since = None
+                return self.scale_to(busy + depth)
+            if depth == 0 and busy < current and current > self.min_workers:
+                if self._idle_since is None:
+                    self._idle_since = now
+                elif now - self._idle_since >= self.scale_down_delay:
+                    self._idle_since = now
+                    return self.scale_to(current - 1)
+            else:
+                self._idle_since = None
+            return current
+
+    def _autoscaler_loop(self):
+        """Periodically run the autoscaler until the workers are stopped."""
+        while not self._stop_scaling.wait(self.scale_interval):
+            try:
+                self.autoscale()
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.error('Error while autoscaling queue workers', exc_info=True)
+
     def start_workers(self):
-        """Start all the worker threads registered to this queue."""
-        for worker in self.workers:
-            worker.start()
+        """Start all the worker threads registered to this queue and the autoscaler."""
+        with self._scale_lock:
+            self.running = True
+            for worker in self.workers:
+                worker.start()
+        self._stop_scaling.clear()
+        self._autoscaler = threading.Thread(target=self._autoscaler_loop, daemon=True)
+        self._autoscaler.start()
 
     def stop_workers(self):
-        """Stop all the worker threads registered to this queue."""
-        for worker in self.workers:
-            worker.stop()
+        """Stop the autoscaler and all the worker threads registered to this queue."""
+        self._stop_scaling.set()
+        if self._autoscaler is not None:
+            self._autoscaler.join()
+        with self._scale_lock:
+            self.running = False
+            for worker in self.workers:
+                worker.stop()
+        self.executor.shutdown()
+
+class PrefetchQueue():
+    """Hold speculative work (e.g. upcoming pages) and feed it to a WorkerMessageQueue at PREFETCH priority only
+    while its workers are idle, so that it never delays the requests being served.
+    Entries are deduplicated by id against each other and against the messages registered in the target queue.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+
+    def __init__(self, target: WorkerMessageQueue, max_pending: int = 0, poll_interval: float = .2):
+        """Create a new PrefetchQueue.
+
+        Args:
+            target (WorkerMessageQueue): Queue the messages are fed to.
+            max_pending (int, optional): Max number of entries waiting to be fed. Defaults to 0 (no limit).
+            poll_interval (float, optional): Seconds between two checks of the state of the target queue.
+                Defaults to .2.
+        """
+        self.target = target
+        self.max_pending = max_pending
+        self.poll_interval = poll_interval
+        self.pending: OrderedDict[Hashable, tuple[dict, Callable]] = OrderedDict()
+        self.submitted: dict[Hashable, Message] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def _running(self, id_: Hashable) -> Union[Message, None]:
+        """Return the message with the given id being resolved (or waiting) in the target queue, if any."""
+        msg = self.submitted.get(id_) or self.target.msg_queue.registered.peek(id_)
+        if msg is None or msg.cancelled or msg.is_resolved:
+            return None
+        return msg
+
+    def put(self, id_: Hashable, msg: dict, handler: Callable) -> str:
+        """Register a new entry to be fed to the target queue once it is idle.
+
+        Args:
+            id_ (Hashable): Id of the message in the target queue.
+            msg (dict): Message to be passed to the handler.
+            handler (Callable): Handler function to be called with the message.
+
+        Raises:
+            QueueFullError: If `max_pending` entries are already waiting.
+
+        Returns:
+            str: `running` if a message with the same id is already in the target queue, else `queued`.
+        """
+        with self._lock:
+            if id_ in self.pending:
+                return self.QUEUED
+            if self._running(id_) is not None:
+                return self.RUNNING
+            if self.max_pending and len(self.pending) >= self.max_pending:
+                raise QueueFullError('Prefetch queue full', retry_after=self.target.msg_queue.estimate_wait())
+            self.pending[id_] = (msg, handler)
+        self._wake.set()
+        return self.QUEUED
+
+    def status(self, id_: Hashable) -> Union[str, None]:
+        """Return `queued`/`running` for known entries, None otherwise."""
+        with self._lock:
+            if id_ in self.pending:
+                return self.QUEUED
+            if self._running(id_) is not None:
+                return self.RUNNING
+        return None
+
+    def cancel(self, id_: Hashable) -> bool:
+        """Cancel an entry. Entries already fed to the target queue are released, and therefore only cancelled if no
+        request is waiting for them.
+
+        Returns:
+            bool: Whether the entry was removed/cancelled.
+        """
+        with self._lock:
+            if self.pending.pop(id_, None) is not None:
+                return True
+            msg = self.submitted.pop(id_, None)
+        if msg is None:
+            return False
+        return msg.release()
+
+    def _forget(self, id_: Hashable, msg: Message):
+        """Done-callback removing a fed message."""
+        with self._lock:
+            if self.submitted.get(id_) is msg:
+                del self.submitted[id_]
+
+    def free_slots(self) -> int:
+        """Number of workers of the target queue that are idle and not about to take a waiting message."""
+        with self.target._scale_lock:  # pylint: disable=protected-access
+            workers = self.target.workers
+            return len(workers) - sum(worker.busy for worker in workers) - self.target.msg_queue.depth
+
+    def feed(self) -> int:
+        """Feed pending entries to the target queue, at most one per idle worker.
+
+        Returns:
+            int: Number of entries fed.
+        """
+        count = 0
+        for _ in range(self.free_slots()):
+            with self._lock:
+                if not self.pending:
+                    break
+                id_, (msg, handler) = self.pending.popitem(last=False)
+                try:
+                    res = self.target.put(id_, msg, handler, priority=Priority.PREFETCH)
+                except QueueFullError:
+                    self.pending[id_] = (msg, handler)
+                    self.pending.move_to_end(id_, last=False)
+                    break
+                self.submitted[id_] = res
+            logger.debug(f'Prefetching {id_}')
+            res.add_done_callback(lambda msg, id_=id_: self._forget(id_, msg))
+            count += 1
+        return count
+
+    def _loop(self):
+        """Feed the target queue until stopped."""
+        while not self._stop.is_set():
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            try:
+                self.feed()
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.error('Error while feeding prefetch queue', exc_info=True)
+
+    def start(self):
+        """Start the feeder thread."""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the feeder thread."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self) -> dict:
+        """Return the number of entries waiting and being resolved."""
+        with self._lock:
+            return {
+                'pending': len(self.pending),
+                'running': sum(not msg.is_resolved for msg in self.submitted.values()),
+            }
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-17 05:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ocr_translate', '0020_loadevent_language_load_events_dst_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='height',
+            field=models.IntegerField(default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='phash',
+            field=models.CharField(default=None, max_length=16, null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='width',
+            field=models.IntegerField(default=None, null=True),
+        ),
+    ]
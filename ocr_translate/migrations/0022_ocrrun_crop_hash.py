@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 05:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ocr_translate', '0021_image_height_image_phash_image_width'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ocrrun',
+            name='crop_hash',
+            field=models.CharField(db_index=True, default=None, max_length=32, null=True),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-17 09:12
+
+import hashlib
+
+from django.db import migrations, models
+
+BATCH_SIZE = 2000
+
+def backfill_digest(apps, schema_editor):
+    """Set the digest of the existing texts (same as `Text.get_digest`)."""
+    Text = apps.get_model('ocr_translate', 'Text')
+    batch = []
+    for text_obj in Text.objects.only('id', 'text').iterator(chunk_size=BATCH_SIZE):
+        text_obj.digest = hashlib.md5(text_obj.text.encode('utf-8')).hexdigest()
+        batch.append(text_obj)
+        if len(batch) >= BATCH_SIZE:
+            Text.objects.bulk_update(batch, ['digest'])
+            batch = []
+    if batch:
+        Text.objects.bulk_update(batch, ['digest'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ocr_translate', '0022_ocrrun_crop_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='text',
+            name='digest',
+            field=models.CharField(default='', editable=False, max_length=32),
+            preserve_default=False,
+        ),
+        migrations.RunPython(backfill_digest, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-17 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """Index created after the backfill of 0023 (in its own transaction), instead of being updated for every row."""
+
+    dependencies = [
+        ('ocr_translate', '0023_text_digest'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='text',
+            name='digest',
+            field=models.CharField(db_index=True, editable=False, max_length=32),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-17 05:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ocr_translate', '0024_alter_text_digest'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ocrboxrun',
+            index=models.Index(fields=['image', 'model', 'options', 'lang_src'], name='boxrun_lookup_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ocrrun',
+            index=models.Index(fields=['bbox', 'model', 'lang_src', 'options'], name='ocrrun_lookup_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='translationrun',
+            index=models.Index(fields=['text', 'model', 'lang_src', 'lang_dst', 'options'], name='tslrun_lookup_idx'),
+        ),
+    ]
@@ -17,6 +17,7 @@
 # Home: https://github.com/Crivella/ocr_translate                                 #
 ###################################################################################
 """Django models for the ocr_translate app."""
+import hashlib
 import json
 import logging
 from importlib import resources
@@ -62,13 +63,49 @@ class LoadEvent(models.Model):
 class Image(models.Model):
     """Image registered as the md5 of the uploaded file"""
     md5 = models.CharField(max_length=32, unique=True)
+    # Perceptual hash (hex of `phash.dhash`) and size, used to reuse the results of near-duplicate images
+    phash = models.CharField(max_length=16, null=True, default=None)
+    width = models.IntegerField(null=True, default=None)
+    height = models.IntegerField(null=True, default=None)
 
 
+class TextQuerySet(models.QuerySet):
+    """QuerySet routing the lookups by `text` through the indexed `digest` column (the text is only compared on
+    the rows with the same digest, instead of scanning the whole table)."""
+    @staticmethod
+    def _with_digest(kwargs: dict) -> dict:
+        if isinstance(kwargs.get('text'), str) and 'digest' not in kwargs:
+            kwargs['digest'] = Text.get_digest(kwargs['text'])
+        return kwargs
+
+    def filter(self, *args, **kwargs):
+        return super().filter(*args, **self._with_digest(kwargs))
+
+    def get_or_create(self, defaults=None, **kwargs):
+        return super().get_or_create(defaults=defaults, **self._with_digest(kwargs))
+
 class Text(models.Model):
     """Text extracted from an image or translated from another text"""
     text = models.TextField()
+    # Not unique: existing databases can contain the same text more than once (see `safe_get_or_create`)
+    digest = models.CharField(max_length=32, db_index=True, editable=False)
     # lang = models.ForeignKey(Language, on_delete=models.CASCADE, related_name='texts')
 
+    objects = TextQuerySet.as_manager()
+
+    @staticmethod
+    def get_digest(text: str) -> str:
+        """Digest of a text used to index the lookups."""
+        return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+    def save(self, *args, **kwargs):
+        """Keep the digest in sync with the text."""
+        self.digest = self.get_digest(self.text)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'text' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'digest'}
+        super().save(*args, **kwargs)
+
 class Language(models.Model):
     """Language used for translation"""
     LOADED_SRC: 'Language' = None
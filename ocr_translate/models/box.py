@@ -64,40 +64,232 @@ class BoxDetectionResult(TypedDict):
     merged: tuple[int, int, int, int]
 
 
+def _tile_spans(size: int, tile_size: int, overlap: int) -> list[tuple[int, int]]:
+    """Split [0, size) in spans of at most `tile_size` overlapping by at least `overlap`."""
+    if size <= tile_size:
+        return [(0, size)]
+    step = tile_size - overlap
+    starts = list(range(0, size - tile_size, step)) + [size - tile_size]
+    return [(start, start + tile_size) for start in starts]
+
+def tile_rects(width: int, height: int, tile_size: int, overlap: int = 0) -> list[tuple[int, int, int, int]]:
+    """Split an image in overlapping tiles.
+
+    Args:
+        width (int): Width of the image.
+        height (int): Height of the image.
+        tile_size (int): Max size in pixels of each side of a tile.
+        overlap (int, optional): Min overlap in pixels between adjacent tiles. Defaults to 0.
+
+    Raises:
+        ValueError: If the overlap is not smaller than the tile size.
+
+    Returns:
+        list[tuple[int, int, int, int]]: The tiles in lbrt format (row by row).
+    """
+    if not 0 <= overlap < tile_size:
+        raise ValueError(f'Tile overlap ({overlap}) must be non-negative and smaller than the tile size ({tile_size})')
+    return [
+        (l, b, r, t)
+        for b, t in _tile_spans(height, tile_size, overlap)
+        for l, r in _tile_spans(width, tile_size, overlap)
+        ]
+
+def _touch(box1: tuple[int, int, int, int], box2: tuple[int, int, int, int]) -> bool:
+    """Whether two lbrt boxes overlap or share an edge."""
+    return box1[0] <= box2[2] and box2[0] <= box1[2] and box1[1] <= box2[3] and box2[1] <= box1[3]
+
+def _union(boxes: list[tuple[int, int, int, int]]) -> tuple[int, int, int, int]:
+    """Smallest lbrt box containing all the boxes."""
+    return (
+        min(_[0] for _ in boxes), min(_[1] for _ in boxes),
+        max(_[2] for _ in boxes), max(_[3] for _ in boxes),
+        )
+
+def _group_across_tiles(items: list[tuple[int, tuple[int, int, int, int]]]) -> list[list[int]]:
+    """Group (union-find) the indexes of the boxes touching a box coming from a different tile.
+    Boxes from the same tile are kept separate, as already decided by the model.
+
+    Args:
+        items (list[tuple[int, tuple[int, int, int, int]]]): List of (tile index, lbrt box).
+
+    Returns:
+        list[list[int]]: Groups of indexes of `items` in order of first appearance.
+    """
+    parent = list(range(len(items)))
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, (tile1, box1) in enumerate(items):
+        for j in range(i + 1, len(items)):
+            tile2, box2 = items[j]
+            if tile1 != tile2 and _touch(box1, box2):
+                parent[find(j)] = find(i)
+
+    groups: dict[int, list[int]] = {}
+    for i in range(len(items)):
+        groups.setdefault(find(i), []).append(i)
+    return list(groups.values())
+
+def merge_tile_results(
+        results: list[list[BoxDetectionResult]], rects: list[tuple[int, int, int, int]]
+        ) -> list[BoxDetectionResult]:
+    """Merge the box detection results of the tiles of an image.
+    Boxes are moved to the coordinates of the full image, and boxes of different tiles overlapping (duplicates
+    detected in the overlap of two tiles) or touching (text cut by a seam) are merged together.
+
+    Args:
+        results (list[list[BoxDetectionResult]]): The results of each tile.
+        rects (list[tuple[int, int, int, int]]): The tiles in lbrt format (same order as `results`).
+
+    Returns:
+        list[BoxDetectionResult]: The results for the full image.
+    """
+    merged = []
+    for tile, (res, (dx, dy, _, _)) in enumerate(zip(results, rects)):
+        for dct in res:
+            l, b, r, t = dct['merged']
+            single = [(l2 + dx, b2 + dy, r2 + dx, t2 + dy) for l2, b2, r2, t2 in dct['single']]
+            merged.append((tile, (l + dx, b + dy, r + dx, t + dy), single))
+
+    res = []
+    for group in _group_across_tiles([(tile, box) for tile, box, _ in merged]):
+        singles = [(merged[i][0], box) for i in group for box in merged[i][2]]
+        res.append({
+            'merged': _union([merged[i][1] for i in group]),
+            'single': [_union([singles[i][1] for i in sub]) for sub in _group_across_tiles(singles)],
+        })
+    return res
+
+
 class OCRBoxModel(BaseModel):
     """OCR model for bounding boxes"""
     #pylint: disable=abstract-method
+    ALLOWED_OPTIONS = {
+        'tile_size': {
+            'type': int,
+            'default': ('cascade', ['box_model'], 0),
+            'description': (
+                'Max size in pixels of the side of the tiles in which big images (e.g. long webtoon strips) are split '
+                'for box detection.\nTiles are processed in parallel (and batched if supported by the model) and '
+                'boxes cut by the seams are merged back together. 0 disables tiling.'
+                ),
+        },
+        'tile_overlap': {
+            'type': int,
+            'default': ('cascade', ['box_model'], 64),
+            'description': (
+                'Overlap in pixels between adjacent tiles. Should be larger than the text boxes cut by the seams, '
+                'for them to be detected as a whole in at least one tile. Must be smaller than the tile size.'
+                ),
+        },
+    }
     CREATE_LANG_KEYS = {'lang': 'languages'}
 
     entrypoint_namespace = 'ocr_translate.box_models'
+    # Set to True in plugins whose `_box_detection` can also take a list of images (see `_box_detection`)
+    BATCHABLE = False
 
     languages = models.ManyToManyField(Language, related_name='box_models')
 
     def _box_detection(
             self,
-            image: PILImage, options: dict = None
-            ) -> list[BoxDetectionResult]:
+            image: PILImage | list[PILImage], options: dict = None
+            ) -> list[BoxDetectionResult] | list[list[BoxDetectionResult]]:
         """PLACEHOLDER (to be implemented via entrypoint): Perform box OCR on an image.
         Returns list of bounding boxes as dicts:
             - merged: The merged BBox as a tuple[int, int, int, int]
             - single: List of BBoxed merged into the merged BBox as a tuple[int, int, int, int]
 
         Args:
-            image (Image.Image): A Pillow image on which to perform OCR.
+            image (Image.Image | list[Image.Image]): A Pillow image on which to perform OCR (or a list of images if
+                the model is BATCHABLE).
             options (dict, optional): A dictionary of options.
 
         Raises:
             NotImplementedError: The type of model specified is not implemented.
 
         Returns:
-            list[BoxDetectionResult]: List of dictionary with key/value pairs:
+            list[BoxDetectionResult] | list[list[BoxDetectionResult]]: List of dictionary with key/value pairs
+              (one such list per image in the same order if `image` is a list):
               - merged: The merged BBox as a tuple[int, int, int, int]
               - single: List of BBoxed merged into the merged BBox as a tuple[int, int, int, int]
         """
         # Redefine this method with the same signature as above
         # Should return a list of `lrbt` boxes after processing the input PILImage
+        # OPTIONAL: set `BATCHABLE = True` on the plugin class to have the images sharing the same model/language/options
+        #   batched together: `image` can then be either a single image (return a list of results) or a list of images
+        #   (return a list with one list of results per image, with the same length and order).
         raise NotImplementedError('The base model class does not implement this method.')
 
+    def tile_options(self, options: dict = None) -> tuple[int, int]:
+        """Get the tiling options of a request (falling back to the default options of the model).
+
+        Args:
+            options (dict, optional): The options of the request for this model. Defaults to None.
+
+        Raises:
+            ValueError: If `tile_size` is negative, or tiling is enabled with a `tile_overlap` that is negative or
+                not smaller than `tile_size`.
+
+        Returns:
+            tuple[int, int]: The tile size (0 if tiling is disabled) and the overlap.
+        """
+        opt = {**getattr(self.default_options, 'options', {}), **(options or {})}
+        try:
+            tile_size = int(opt.get('tile_size', 0))
+            overlap = int(opt.get('tile_overlap', 64))
+        except (TypeError, ValueError) as exc:
+            raise ValueError('`tile_size` and `tile_overlap` must be integers') from exc
+        if tile_size < 0:
+            raise ValueError(f'`tile_size` ({tile_size}) must be non-negative (0 disables tiling)')
+        if tile_size and not 0 <= overlap < tile_size:
+            raise ValueError(
+                f'`tile_overlap` ({overlap}) must be non-negative and smaller than `tile_size` ({tile_size})'
+                )
+        return tile_size, overlap
+
+    def _tiled_box_detection( # pylint: disable=too-many-arguments,too-many-positional-arguments
+            self,
+            image: PILImage, tile_size: int, overlap: int,
+            id_: tuple, batch_id: tuple | None, options: dict
+            ) -> list[BoxDetectionResult]:
+        """Run the box detection on overlapping tiles of the image and merge the results.
+        Every tile is queued at once, so that they are processed in parallel by the box workers (and batched together
+        if the model is BATCHABLE).
+
+        Raises:
+            Exception: The first error raised by the detection of a tile.
+        """
+        rects = tile_rects(*image.size, tile_size, overlap)
+        logger.debug(f'BBox OCR on {len(rects)} tiles of {tile_size}px')
+        msgs = [
+            queues.box_queue.put(
+                id_=(*id_, rect),
+                batch_id=batch_id,
+                handler=self._box_detection,
+                msg={
+                    'args': (image.crop(rect),),
+                    'kwargs': {'options': options},
+                },
+            ) for rect in rects
+        ]
+        try:
+            results = [msg.response() for msg in msgs]
+        except Exception:
+            # Drop the tiles that are still pending
+            for msg in msgs:
+                if not msg.is_resolved:
+                    msg.release()
+            raise
+        for res in results:
+            if isinstance(res, Exception):
+                raise res
+        return merge_tile_results(results, rects)
+
     def box_detection( # pylint: disable=too-many-locals
             self,
             img_obj: 'Image', lang: 'Language', image: PILImage = None,
@@ -114,7 +306,8 @@ class OCRBoxModel(BaseModel):
             options (m.OptionDict, optional): An OptionDict object from the database. Defaults to None.
 
         Raises:
-            ValueError: ValueError is raised if at any step of the pipeline an image is required but not provided.
+            ValueError: ValueError is raised if at any step of the pipeline an image is required but not provided,
+                or if the tiling options are invalid (see `tile_options`).
 
         Returns:
             tuple[list['BBox'], list['BBox']]: Tuple of lists of BBox objects from the database.
@@ -141,16 +334,22 @@ class OCRBoxModel(BaseModel):
             logger.info('Running BBox OCR')
             opt_dct = options_obj.options
             id_ = (img_obj.id, self.id, lang.id, options_obj.id)
-            bboxes = queues.box_queue.put(
-                id_=id_,
-                handler=self._box_detection,
-                msg={
-                    'args': (image,),
-                    'kwargs': {'options': opt_dct},
-                },
-            )
-            # bboxes_single, bboxes_merged = bboxes.response()
-            bboxes_list = bboxes.response()
+            batch_id = (self.id, lang.id, options_obj.id) if self.BATCHABLE else None
+            tile_size, overlap = self.tile_options(opt_dct)
+            if tile_size and max(image.size) > tile_size:
+                bboxes_list = self._tiled_box_detection(image, tile_size, overlap, id_, batch_id, opt_dct)
+            else:
+                bboxes = queues.box_queue.put(
+                    id_=id_,
+                    batch_id=batch_id,
+                    handler=self._box_detection,
+                    msg={
+                        'args': (image,),
+                        'kwargs': {'options': opt_dct},
+                    },
+                )
+                # bboxes_single, bboxes_merged = bboxes.response()
+                bboxes_list = bboxes.response()
             # Create it here to avoid having a failed entry in DB
             bbox_run = OCRBoxRun.objects.create(**params)
             for dct in bboxes_list:
@@ -189,3 +388,9 @@ class OCRBoxRun(models.Model):
     image = models.ForeignKey(Image, on_delete=models.CASCADE, related_name='to_box')
     model = models.ForeignKey(OCRBoxModel, on_delete=models.CASCADE, related_name='box_runs')
     # result = models.ForeignKey(BBox, on_delete=models.CASCADE, related_name='from_ocr')
+
+    class Meta:
+        # Same fields as the run lookups in `OCRBoxModel.box_detection` and the lazy pipeline
+        indexes = [
+            models.Index(fields=['image', 'model', 'options', 'lang_src'], name='boxrun_lookup_idx'),
+        ]
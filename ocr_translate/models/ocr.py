@@ -17,6 +17,7 @@
 # Home: https://github.com/Crivella/ocr_translate                                 #
 ###################################################################################
 """Django models for the ocr_translate app."""
+import hashlib
 import logging
 from typing import Generator, Union
 
@@ -41,6 +42,8 @@ class OCRModel(BaseModel):
     _VERTICAL_LANGS = ['ja', 'zh', 'zht', 'ko']
     SINGLE='single'
     MERGED='merged'
+    # Set to True in plugins whose `_ocr` can also take a list of images (see `_ocr`)
+    BATCHABLE = False
     OCR_MODE_CHOICES = [
         (SINGLE, 'Single'),
         (MERGED, 'Merged'),
@@ -58,13 +61,21 @@ class OCRModel(BaseModel):
         """Standard operation to be performed on image before OCR. E.G color scale and crop to bbox"""
         if not isinstance(img, PILImage):
             raise TypeError(f'img should be PIL Image, but got {type(img)}')
-        img = img.convert('RGB')
-
+        # Crop first so that only the pixels of the box are converted (nothing to convert if the page is already RGB)
         if bbox:
             img = img.crop(bbox)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
 
         return img
 
+    @staticmethod
+    def hash_image(img: PILImage) -> str:
+        """Content hash of a (prepared) image, used to reuse the OCR of identical crops."""
+        res = hashlib.md5(f'{img.mode}{img.size}'.encode('utf-8'))
+        res.update(img.tobytes())
+        return res.hexdigest()
+
     @staticmethod
     def merge_single_result( # pylint: disable=too-many-locals
             lang: str,
@@ -148,12 +159,13 @@ class OCRModel(BaseModel):
 
     def _ocr(
             self,
-            img: PILImage, lang: str = None, options: dict = None
-            ) -> str:
+            img: PILImage | list[PILImage], lang: str = None, options: dict = None
+            ) -> str | list[str]:
         """PLACEHOLDER (to be implemented via entrypoint): Perform OCR on an image.
 
         Args:
-            img (Image.Image):  A Pillow image on which to perform OCR.
+            img (Image.Image | list[Image.Image]):  A Pillow image on which to perform OCR (or a list of images if the
+                model is BATCHABLE).
             lang (str, optional): The language to use for OCR. (Not every model will use this)
             bbox (tuple[int, int, int, int], optional): The bounding box of the text on the image in lbrt format.
             options (dict, optional): A dictionary of options to pass to the OCR model.
@@ -162,12 +174,15 @@ class OCRModel(BaseModel):
             TypeError: If img is not a Pillow image.
 
         Returns:
-            str: The text extracted from the image.
+            str | list[str]: The text extracted from the image (a list of texts in the same order if `img` is a list).
         """
         # Redefine this method with the same signature as above
         # Should return a string with the result of the OCR performed on the input PILImage.
         # Unless the methods `prepare_image` or `ocr` are also being overwritten, the input image will be the
         #  result of the CROP on the original image using the bounding boxes given by the box detection model.
+        # OPTIONAL: set `BATCHABLE = True` on the plugin class to have the crops of the same model/language/options
+        #   batched together: `img` can then be either a single image (return a string) or a list of images
+        #   (return a list of strings with the same length and order).
         raise NotImplementedError('The base model class does not implement this method.')
 
     def ocr(
@@ -209,31 +224,47 @@ class OCRModel(BaseModel):
         if ocr_run_obj is None or force:
             if image is None:
                 raise ValueError('Image is required for OCR')
-            logger.info('Running OCR')
-
-            id_ = (bbox_obj.id, self.id, lang.id, options_obj.id)
-            mlang = self.get_lang_code(lang)
-            opt_dct = options_obj.options
-            text = queues.ocr_queue.put(
-                id_=id_,
-                handler=self._ocr,
-                msg={
-                    'args': (self.prepare_image(image, bbox_obj.lbrt),),
-                    'kwargs': {
-                        'lang': mlang,
-                        'options': opt_dct
-                        },
-                },
-            )
-            if not block:
-                yield text
-            text = text.response()
-            if lang.iso1 in self._NO_SPACE_LANGUAGES:
-                text = text.replace(' ', '')
-
-            text_obj = safe_get_or_create(Text, text=text)
+            crop = self.prepare_image(image, bbox_obj.lbrt)
+            crop_hash = self.hash_image(crop)
+            # Identical crops (e.g. recurring sound effects/labels) from another box or image
+            same_crop = None
+            if not force:
+                same_crop = OCRRun.objects.filter(
+                    crop_hash=crop_hash, model=self, lang_src=lang, options=options_obj
+                    ).first()
+            if same_crop is not None:
+                if not block:
+                    yield None
+                logger.info(f'Reusing OCR of identical crop <{same_crop.id}>')
+                text_obj = same_crop.result_single or same_crop.result_merged
+            else:
+                logger.info('Running OCR')
+
+                id_ = (crop_hash, self.id, lang.id, options_obj.id)
+                batch_id = (self.id, lang.id, options_obj.id) if self.BATCHABLE else None
+                mlang = self.get_lang_code(lang)
+                opt_dct = options_obj.options
+                text = queues.ocr_queue.put(
+                    id_=id_,
+                    batch_id=batch_id,
+                    handler=self._ocr,
+                    msg={
+                        'args': (crop,),
+                        'kwargs': {
+                            'lang': mlang,
+                            'options': opt_dct
+                            },
+                    },
+                )
+                if not block:
+                    yield text
+                text = text.response()
+                if lang.iso1 in self._NO_SPACE_LANGUAGES:
+                    text = text.replace(' ', '')
+
+                text_obj = safe_get_or_create(Text, text=text)
             params[f'result_{self.ocr_mode}'] = text_obj
-            ocr_run_obj = OCRRun.objects.create(**params)
+            ocr_run_obj = OCRRun.objects.create(**params, crop_hash=crop_hash)
         else:
             if not block:
                 # Both branches should have the same number of yields
@@ -253,6 +284,8 @@ class OCRRun(models.Model):
 
     # image = models.ForeignKey(Image, on_delete=models.CASCADE, related_name='to_ocr')
     bbox = models.ForeignKey(BBox, on_delete=models.CASCADE, related_name='to_ocr')
+    # Hash of the prepared crop the OCR was run on (see `OCRModel.hash_image`)
+    crop_hash = models.CharField(max_length=32, null=True, default=None, db_index=True)
     model = models.ForeignKey(OCRModel, on_delete=models.CASCADE, related_name='ocr_runs')
     result_single = models.ForeignKey(
         Text, on_delete=models.CASCADE, related_name='from_ocr_single',
@@ -262,3 +295,9 @@ class OCRRun(models.Model):
         Text, on_delete=models.CASCADE, related_name='from_ocr_merged',
         default=None, null=True
         )
+
+    class Meta:
+        # Same fields as the run lookups in `OCRModel.ocr` and the lazy pipeline
+        indexes = [
+            models.Index(fields=['bbox', 'model', 'lang_src', 'options'], name='ocrrun_lookup_idx'),
+        ]
@@ -330,3 +330,9 @@ class TranslationRun(models.Model):
     text = models.ForeignKey(Text, on_delete=models.CASCADE, related_name='to_trans')
     model = models.ForeignKey(TSLModel, on_delete=models.CASCADE, related_name='tsl_runs')
     result = models.ForeignKey(Text, on_delete=models.CASCADE, related_name='from_trans')
+
+    class Meta:
+        # Same fields as the run lookups in `TSLModel.translate` and the lazy pipeline
+        indexes = [
+            models.Index(fields=['text', 'model', 'lang_src', 'lang_dst', 'options'], name='tslrun_lookup_idx'),
+        ]
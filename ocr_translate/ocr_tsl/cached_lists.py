@@ -17,8 +17,10 @@
 # Home: https://github.com/Crivella/ocr_translate                                 #
 ###################################################################################
 """Caches for list of models to be sent to the frontend."""
+import threading
+
 from django.db.models import Count
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 
 from .. import models as m
@@ -32,6 +34,10 @@ ALLOWED_BOX_MODELS: list[m.OCRBoxModel] = None
 ALLOWED_OCR_MODELS: list[m.OCRModel] = None
 ALLOWED_TSL_MODELS: list[m.TSLModel] = None
 
+# md5 of every image in the database, to answer "is this image known" without touching the database
+KNOWN_IMAGES: set[str] = None
+_known_images_lock = threading.Lock()
+
 def refresh_model_cache():
     """Refresh the models cached entry."""
     global ALLOWED_BOX_MODELS
@@ -93,6 +99,24 @@ def get_allowed_tsl_models():
         refresh_model_cache()
     return ALLOWED_TSL_MODELS
 
+def refresh_image_cache():
+    """Refresh the set of known image md5s."""
+    global KNOWN_IMAGES
+    with _known_images_lock:
+        KNOWN_IMAGES = set(m.Image.objects.values_list('md5', flat=True))
+
+def reset_image_cache():
+    """Drop the set of known image md5s (it is reloaded lazily on the next lookup)."""
+    global KNOWN_IMAGES
+    with _known_images_lock:
+        KNOWN_IMAGES = None
+
+def is_known_image(md5: str) -> bool:
+    """Return whether an image with the given md5 exists in the database."""
+    if KNOWN_IMAGES is None:
+        refresh_image_cache()
+    return md5 in KNOWN_IMAGES
+
 @receiver(post_save, sender=m.Language)
 def refres_lang_callback(sender, instance, **kwargs): # pylint: disable=unused-argument
     """Callback to refresh the cached language list when a language is added/modified."""
@@ -105,3 +129,18 @@ def refres_lang_callback(sender, instance, **kwargs): # pylint: disable=unused-a
 def refresh_models_callback(sender, **kwargs): # pylint: disable=unused-argument
     """Callback to refresh the cached model list when a language is added/modified."""
     refresh_model_cache()
+
+# The lock makes a save/delete concurrent with a (re)load wait for it, so that it is not lost
+@receiver(post_save, sender=m.Image)
+def add_image_callback(sender, instance, **kwargs): # pylint: disable=unused-argument
+    """Callback to add a new image to the set of known images."""
+    with _known_images_lock:
+        if KNOWN_IMAGES is not None:
+            KNOWN_IMAGES.add(instance.md5)
+
+@receiver(post_delete, sender=m.Image)
+def remove_image_callback(sender, instance, **kwargs): # pylint: disable=unused-argument
+    """Callback to remove a deleted image from the set of known images."""
+    with _known_images_lock:
+        if KNOWN_IMAGES is not None:
+            KNOWN_IMAGES.discard(instance.md5)
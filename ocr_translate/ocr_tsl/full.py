@@ -18,13 +18,161 @@
 ###################################################################################
 """Full OCR + translation pipelines."""
 import logging
+import time
+from queue import Empty, SimpleQueue
+from typing import Generator
 
 from PIL import Image
 
 from .. import models as m
+from .. import phash
+from ..messaging import Message, get_current_deadline
 
 logger = logging.getLogger('ocr.general')
 
+# Hashes of the images with a known size, to find near-duplicates of a new image
+phash_index = phash.PHashIndex(lambda: m.Image.objects.exclude(phash=None).exclude(width=None).values_list('phash', 'id'))
+
+def register_image(md5: str, img: Image.Image) -> m.Image:
+    """Get or create the Image object of an image, storing its perceptual hash and size if missing."""
+    img_obj, _ = m.Image.objects.get_or_create(md5=md5)
+    if img_obj.phash is None and isinstance(img, Image.Image):
+        img_obj.phash = phash.to_hex(phash.dhash(img))
+        img_obj.width, img_obj.height = img.size
+        img_obj.save(update_fields=['phash', 'width', 'height'])
+        phash_index.add(img_obj.phash, img_obj.id)
+    return img_obj
+
+def _first_by(queryset, key: str) -> dict:
+    """Map every value of `key` to the first (lowest id) object of the queryset, as `.first()` would do."""
+    res = {}
+    for obj in queryset.order_by('id'):
+        res.setdefault(getattr(obj, key), obj)
+    return res
+
+def _lazy_bulk_lookup(  # pylint: disable=too-many-locals
+        img_obj: m.Image,
+        options_box: m.OptionDict,
+        options_ocr: m.OptionDict,
+        options_tsl: m.OptionDict,
+        ) -> list[dict] | None:
+    """Look up the results of every box of an image in a fixed number of queries (instead of a few per box).
+    Returns None if any result is missing or the box run needs to be handled by `OCRBoxModel.box_detection`
+    (e.g. runs from <0.4.0), in which case the per-box lookup should be used.
+    """
+    lang_src = m.Language.get_loaded_model_src()
+    lang_dst = m.Language.get_loaded_model_dst()
+    box_model = m.OCRBoxModel.get_loaded_model()
+    ocr_model = m.OCRModel.get_loaded_model()
+    tsl_model = m.TSLModel.get_loaded_model()
+
+    box_run = m.OCRBoxRun.objects.filter(
+        image=img_obj, model=box_model, options=options_box, lang_src=lang_src
+        ).first()
+    if box_run is None:
+        return None
+    bbox_obj_list = list(box_run.result_merged.all())
+    if not bbox_obj_list or not box_run.result_single.exists():
+        return None
+
+    ocr_runs = _first_by(m.OCRRun.objects.filter(
+        bbox__in=bbox_obj_list, model=ocr_model, lang_src=lang_src, options=options_ocr
+        ).select_related('result_merged', 'result_single'), 'bbox_id')
+    if len(ocr_runs) < len(bbox_obj_list):
+        return None
+    texts = [ocr_runs[_.id].result_merged or ocr_runs[_.id].result_single for _ in bbox_obj_list]
+
+    text_ids = {_.id for _ in texts}
+    params = {'lang_src': lang_src, 'lang_dst': lang_dst}
+    tsl_runs = {}
+    if options_tsl.options.get('favor_manual', True):
+        tsl_runs = _first_by(m.TranslationRun.objects.filter(
+            model__name='manual', options=m.OptionDict.objects.get(options={}), text_id__in=text_ids, **params
+            ).select_related('result'), 'text_id')
+    missing = text_ids - set(tsl_runs)
+    if missing:
+        tsl_runs.update(_first_by(m.TranslationRun.objects.filter(
+            model=tsl_model, options=options_tsl, text_id__in=missing, **params
+            ).select_related('result'), 'text_id'))
+    if len(tsl_runs) < len(text_ids):
+        return None
+
+    return [
+        {
+            'ocr': text_obj.text,
+            'tsl': tsl_runs[text_obj.id].result.text,
+            'box': bbox_obj.lbrt,
+        } for bbox_obj, text_obj in zip(bbox_obj_list, texts)
+    ]
+
+def ocr_tsl_probe(  # pylint: disable=too-many-locals
+        md5s: list[str],
+        options_box: m.OptionDict | None,
+        options_ocr: m.OptionDict | None,
+        options_tsl: m.OptionDict | None,
+        ) -> dict[str, dict[str, bool]]:
+    """Check which stages of the pipeline are stored in the database for many images at once, in a fixed number
+    of queries. An option set that does not exist yet (None) means no run with it exists.
+
+    Returns:
+        dict[str, dict[str, bool]]: For every md5, whether the `box`, `ocr` and `tsl` stages are all available.
+            A stage is only available if the previous one is, and `tsl` true means a lazy run would succeed.
+    """
+    res = {_: {'box': False, 'ocr': False, 'tsl': False} for _ in md5s}
+    if not md5s or options_box is None:
+        return res
+
+    lang_src = m.Language.get_loaded_model_src()
+    lang_dst = m.Language.get_loaded_model_dst()
+    box_model = m.OCRBoxModel.get_loaded_model()
+    ocr_model = m.OCRModel.get_loaded_model()
+    tsl_model = m.TSLModel.get_loaded_model()
+
+    box_runs = _first_by(m.OCRBoxRun.objects.filter(
+        image__md5__in=md5s, model=box_model, options=options_box, lang_src=lang_src
+        ).select_related('image'), 'image_id')
+    run_md5 = {run.id: run.image.md5 for run in box_runs.values()}
+    for md5 in run_md5.values():
+        res[md5]['box'] = True
+    if options_ocr is None:
+        return res
+
+    # Merged box -> box run
+    bboxes = dict(m.BBox.objects.filter(from_ocr_merged_id__in=run_md5).values_list('id', 'from_ocr_merged_id'))
+    bbox_text = {}
+    for bbox_id, merged_id, single_id in m.OCRRun.objects.filter(
+            bbox_id__in=bboxes, model=ocr_model, lang_src=lang_src, options=options_ocr
+            ).order_by('id').values_list('bbox_id', 'result_merged_id', 'result_single_id'):
+        bbox_text.setdefault(bbox_id, merged_id or single_id)
+    missing_runs = {bboxes[_] for _ in set(bboxes) - set(bbox_text)}
+    ocr_runs = set(run_md5) - missing_runs
+    for run_id in ocr_runs:
+        res[run_md5[run_id]]['ocr'] = True
+    if options_tsl is None:
+        return res
+
+    text_ids = set(bbox_text.values())
+    params = {'lang_src': lang_src, 'lang_dst': lang_dst}
+    translated = set()
+    if options_tsl.options.get('favor_manual', True):
+        translated |= set(m.TranslationRun.objects.filter(
+            model__name='manual', options__options={}, text_id__in=text_ids, **params
+            ).values_list('text_id', flat=True))
+    translated |= set(m.TranslationRun.objects.filter(
+        model=tsl_model, options=options_tsl, text_id__in=text_ids - translated, **params
+        ).values_list('text_id', flat=True))
+    missing_runs = {bboxes[bbox_id] for bbox_id, text_id in bbox_text.items() if text_id not in translated}
+    for run_id in ocr_runs - missing_runs:
+        res[run_md5[run_id]]['tsl'] = True
+
+    return res
+
+def _shared_rgb(img: Image.Image) -> Image.Image:
+    """Convert the page to RGB once, to be shared (read-only) by the crops of every box."""
+    if isinstance(img, Image.Image) and img.mode != 'RGB':
+        return img.convert('RGB')
+    return img
+
 def ocr_tsl_pipeline_lazy(
         md5: str,
         options_box: m.OptionDict,
@@ -43,11 +191,18 @@ def ocr_tsl_pipeline_lazy(
 
     favor_manual = options_tsl.options.get('favor_manual', True)
     logger.debug(f'LAZY: START {md5}')
-    res = []
     try:
         img_obj= m.Image.objects.get(md5=md5)
     except m.Image.DoesNotExist as exc:
         raise ValueError(f'Image with md5 {md5} does not exist') from exc
+
+    res = _lazy_bulk_lookup(img_obj, options_box, options_ocr, options_tsl)
+    if res is not None:
+        logger.debug('LAZY: DONE (bulk)')
+        return res
+
+    # Per-box lookup: raises at the first missing result
+    res = []
     _, bbox_obj_list = box_model.box_detection(img_obj, lang_src, options=options_box)
 
     for bbox_obj in bbox_obj_list:
@@ -73,93 +228,233 @@ def ocr_tsl_pipeline_lazy(
     logger.debug('LAZY: DONE')
     return res
 
-# This is already kinda lazy, but the idea for the lazy version is to
-# check if all results are available just with the md5, and if not,
-# ask the extension to send the binary to minimize traffic
-def ocr_tsl_pipeline_work(  # pylint: disable=too-many-locals
+def ocr_tsl_pipeline_similar(
         img: Image.Image, md5: str,
         options_box: m.OptionDict,
         options_ocr: m.OptionDict,
         options_tsl: m.OptionDict,
-        force: bool = False,
+        max_distance: int = None,
         ) -> list[dict]:
     """
-    Generate response from md5 and binary.
-    Will attempt to behave lazily at every step unless force is True.
+    Lazily generate the response from the results of a near-duplicate of the image (e.g. the same page re-encoded by
+    a CDN, recompressed or resized), with the boxes rescaled to the size of the image.
+    Should raise a ValueError if no near-duplicate with every result available is found.
+    """
+    if max_distance is None:
+        max_distance = phash.max_distance
+    width, height = img.size
+    candidates = phash_index.search(phash.to_hex(phash.dhash(img)), max_distance)
+    images = m.Image.objects.in_bulk([_[1] for _ in candidates])
+    for dist, img_id in candidates:
+        img_obj = images.get(img_id)
+        if img_obj is None:
+            continue
+        # The hash ignores the aspect ratio: a crop/pad of the same page is not a near-duplicate
+        if abs(width * img_obj.height - height * img_obj.width) > 0.02 * width * img_obj.height:
+            continue
+        try:
+            res = ocr_tsl_pipeline_lazy(
+                img_obj.md5, options_box=options_box, options_ocr=options_ocr, options_tsl=options_tsl
+                )
+        except ValueError:
+            continue
+        logger.info(f'Reusing results of near-duplicate image {img_obj.md5} (distance {dist}) for {md5}')
+        scale_x, scale_y = width / img_obj.width, height / img_obj.height
+        return [
+            {**item, 'box': tuple(round(c * s) for c, s in zip(item['box'], (scale_x, scale_y) * 2))}
+            for item in res
+            ]
+
+    raise ValueError(f'No near-duplicate of image {md5} with available results')
+
+def _merge_single_texts(
+        ocr_model: m.OCRModel, lang_src: m.Language, options_ocr: m.OptionDict,
+        texts: list[m.Text], bbox_obj_list_single: list[m.BBox], bbox_obj_list_merged: list[m.BBox],
+        ) -> list[m.Text]:
+    """Merge the results of an OCR run in single element mode and store them as runs on the merged bounding boxes."""
+    logger.debug(f'OCR DONE (single): {texts}')
+    str_list = [_.text for _ in texts]
+
+    merged_text = ocr_model.merge_single_result(
+        lang_src.iso1,
+        str_list,
+        bbox_obj_list_single,
+        bbox_obj_list_merged
+        )
+    res = []
+    for text, bbox_obj in zip(merged_text, bbox_obj_list_merged):
+        text_obj, _ = m.Text.objects.get_or_create(text=text)
+        params = {
+            'bbox': bbox_obj,
+            'model': ocr_model,
+            'lang_src': lang_src,
+            'options': options_ocr,
+            'result_merged': text_obj
+        }
+        merged_run = m.OCRRun.objects.create(**params)
+
+        # Pretend the current texts are the merged ones
+        res.append(merged_run.result_merged)
+
+        logger.debug(f'OCR DONE (mock_merged): {text}')
+
+    return res
+
+def _group_single_boxes(
+        bbox_obj_list_single: list[m.BBox], bbox_obj_list_merged: list[m.BBox]
+        ) -> list[tuple[list[int], list[int]]]:
+    """Group the indexes of the single bounding boxes by the merged bounding box they belong to.
+    Falls back to a single group with every box if some single box is not linked to one of the merged ones."""
+    merged_idx = {bbox_obj.id: i for i, bbox_obj in enumerate(bbox_obj_list_merged)}
+    if not all(_.to_merged_id in merged_idx for _ in bbox_obj_list_single):
+        return [(list(range(len(bbox_obj_list_single))), list(range(len(bbox_obj_list_merged))))]
+    groups = [([], [i]) for i in range(len(bbox_obj_list_merged))]
+    for j, bbox_obj in enumerate(bbox_obj_list_single):
+        groups[merged_idx[bbox_obj.to_merged_id]][0].append(j)
+    return groups
+
+def _ocr_tsl_dataflow(  # pylint: disable=too-many-locals,too-many-statements
+        img: Image.Image,
+        bbox_obj_list_single: list[m.BBox], bbox_obj_list_merged: list[m.BBox],
+        options_ocr: m.OptionDict, options_tsl: m.OptionDict,
+        force: bool = False,
+        ) -> Generator[tuple[int, m.Text, m.Text], None, None]:
+    """Run OCR and translation on every box, enqueuing the translation of a box as soon as its OCR is done (in
+    SINGLE mode as soon as all the single boxes of its merged box are done), so that the two stages overlap.
+    Messages still pending when the generator is closed are released.
+
+    Yields:
+        Generator[tuple[int, m.Text, m.Text], None, None]: (index of the merged box, OCR text, translated text)
+            in order of completion.
+
+    Raises:
+        TimeoutError: If the deadline of the current context expires while waiting for a result.
     """
     lang_src = m.Language.get_loaded_model_src()
     lang_dst = m.Language.get_loaded_model_dst()
-    box_model = m.OCRBoxModel.get_loaded_model()
     ocr_model = m.OCRModel.get_loaded_model()
     tsl_model = m.TSLModel.get_loaded_model()
 
     favor_manual = options_tsl.options.get('favor_manual', True)
-    logger.debug(f'WORK: START {md5}')
 
-    img_obj, _ = m.Image.objects.get_or_create(md5=md5)
-    bbox_obj_list_single, bbox_obj_list_merged = box_model.box_detection(
-        img_obj, lang_src ,image=img, options=options_box
-        )
+    # (stage, index) of the steps whose result is available, filled by the done-callbacks of the messages
+    ready = SimpleQueue()
+    pending = {}
+    gens = {}
+    def submit(key: tuple[str, int], gen: Generator):
+        gens[key] = gen
+        msg = next(gen)
+        if isinstance(msg, Message):
+            pending[key] = msg
+            msg.add_done_callback(lambda _: ready.put(key))
+        else:
+            # Result already available
+            ready.put(key)
 
-    bbox_obj_list = bbox_obj_list_merged
-    if ocr_model.ocr_mode == ocr_model.SINGLE:
-        bbox_obj_list = bbox_obj_list_single
+    texts = {}
+    def translate(index: int, text_obj: m.Text):
+        texts[index] = text_obj
+        submit(('tsl', index), tsl_model.translate(
+            text_obj, lang_src, lang_dst, options=options_tsl,
+            force=force, block=False, favor_manual=favor_manual
+            ))
 
-    texts = []
-    for bbox_obj in bbox_obj_list:
-        logger.debug(str(bbox_obj))
-
-        text_obj = ocr_model.ocr(bbox_obj, lang_src, image=img, force=force, block=False, options=options_ocr)
-        next(text_obj)
-        texts.append(text_obj)
-
-    texts = [next(_) for _ in texts]
-    # If OCR is running in single element mode, must merge the results and pretend runs on the merged
-    # bounding boxes were done with the merged text as outputs
-    if ocr_model.ocr_mode == ocr_model.SINGLE:
-        logger.debug(f'OCR DONE (single): {texts}')
-        str_list = [_.text for _ in texts]
-
-        merged_text = ocr_model.merge_single_result(
-            lang_src.iso1,
-            str_list,
-            bbox_obj_list_single,
-            bbox_obj_list_merged
+    single = {}
+    groups = []
+    group_of = {}
+    remaining = {}
+    def merge(group: int):
+        idx_single, idx_merged = groups[group]
+        merged = _merge_single_texts(
+            ocr_model, lang_src, options_ocr,
+            [single[_] for _ in idx_single],
+            [bbox_obj_list_single[_] for _ in idx_single],
+            [bbox_obj_list_merged[_] for _ in idx_merged],
             )
-        texts = []
-        for text, bbox_obj in zip(merged_text, bbox_obj_list_merged):
-            text_obj, _ = m.Text.objects.get_or_create(text=text)
-            params = {
-                'bbox': bbox_obj,
-                'model': ocr_model,
-                'lang_src': lang_src,
-                'options': options_ocr,
-                'result_merged': text_obj
-            }
-            merged_run = m.OCRRun.objects.create(**params)
+        for i, text_obj in zip(idx_merged, merged):
+            translate(i, text_obj)
 
-            # Pretend the current texts are the merged ones
-            texts.append(merged_run.result_merged)
+    try:
+        if ocr_model.ocr_mode == ocr_model.SINGLE:
+            groups = _group_single_boxes(bbox_obj_list_single, bbox_obj_list_merged)
+            for group, (idx_single, _) in enumerate(groups):
+                remaining[group] = len(idx_single)
+                for j in idx_single:
+                    group_of[j] = group
+            for j, bbox_obj in enumerate(bbox_obj_list_single):
+                logger.debug(str(bbox_obj))
+                submit(('single', j), ocr_model.ocr(
+                    bbox_obj, lang_src, image=img, force=force, block=False, options=options_ocr
+                    ))
+        else:
+            for i, bbox_obj in enumerate(bbox_obj_list_merged):
+                logger.debug(str(bbox_obj))
+                submit(('ocr', i), ocr_model.ocr(
+                    bbox_obj, lang_src, image=img, force=force, block=False, options=options_ocr
+                    ))
 
-            logger.debug(f'OCR DONE (mock_merged): {text}')
+        while gens:
+            # Read at every step: the deadline is extended if a request with a later one reuses the running pipeline
+            deadline = get_current_deadline()
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                key = ready.get(timeout=timeout)
+            except Empty as exc:
+                if get_current_deadline() != deadline:
+                    continue
+                raise TimeoutError('Deadline expired while waiting for the OCR/translation results') from exc
+            pending.pop(key, None)
+            stage, i = key
+            res = next(gens.pop(key))
+            if stage == 'single':
+                single[i] = res
+                group = group_of[i]
+                remaining[group] -= 1
+                if remaining[group] == 0:
+                    merge(group)
+            elif stage == 'ocr':
+                translate(i, res)
+            else:
+                yield i, texts[i], res
+    finally:
+        for msg in pending.values():
+            msg.release()
 
+# This is already kinda lazy, but the idea for the lazy version is to
+# check if all results are available just with the md5, and if not,
+# ask the extension to send the binary to minimize traffic
+def ocr_tsl_pipeline_work(
+        img: Image.Image, md5: str,
+        options_box: m.OptionDict,
+        options_ocr: m.OptionDict,
+        options_tsl: m.OptionDict,
+        force: bool = False,
+        ) -> list[dict]:
+    """
+    Generate response from md5 and binary.
+    Will attempt to behave lazily at every step unless force is True.
+    """
+    lang_src = m.Language.get_loaded_model_src()
+    box_model = m.OCRBoxModel.get_loaded_model()
 
-    logger.debug(f'OCR DONE: {texts}')
+    logger.debug(f'WORK: START {md5}')
 
-    trans = []
-    for text_obj in texts:
-        tsl_obj = tsl_model.translate(
-            text_obj, lang_src, lang_dst, options=options_tsl,
-            force=force, block=False, favor_manual=favor_manual
-            )
-        next(tsl_obj)
-        trans.append(tsl_obj)
+    img_obj = register_image(md5, img)
+    bbox_obj_list_single, bbox_obj_list_merged = box_model.box_detection(
+        img_obj, lang_src ,image=img, options=options_box
+        )
 
-    trans = [next(_) for _ in trans]
-    logger.debug(f'TRANSLATION DONE: {trans}')
+    img = _shared_rgb(img)
+    done = {}
+    for i, text_obj, tsl_obj in _ocr_tsl_dataflow(
+            img, bbox_obj_list_single, bbox_obj_list_merged, options_ocr, options_tsl, force=force
+            ):
+        done[i] = (text_obj, tsl_obj)
+    logger.debug(f'OCR + TRANSLATION DONE: {done}')
 
     res = []
-    for bbox_obj, text_obj, tsl_obj in zip(bbox_obj_list_merged, texts, trans):
+    for i, bbox_obj in enumerate(bbox_obj_list_merged):
+        text_obj, tsl_obj = done[i]
         text = text_obj.text
         new = tsl_obj.text
 
@@ -171,3 +466,47 @@ def ocr_tsl_pipeline_work(  # pylint: disable=too-many-locals
 
     logger.debug('WORK: DONE')
     return res
+
+def ocr_tsl_pipeline_stream(
+        img: Image.Image, md5: str,
+        options_box: m.OptionDict,
+        options_ocr: m.OptionDict,
+        options_tsl: m.OptionDict,
+        force: bool = False,
+        ) -> Generator[dict, None, None]:
+    """
+    Streaming version of `ocr_tsl_pipeline_work`.
+    First yields one item per merged box with `ocr` and `tsl` set to None, then yields every item again with the
+    texts filled in as soon as its OCR and translation are done (in order of completion, not of the boxes).
+    Every item carries the `index` of its box.
+    Messages still pending when the generator is closed (e.g. the client disconnected) are released.
+
+    Raises:
+        TimeoutError: If the deadline of the current context expires while waiting for a result.
+    """
+    lang_src = m.Language.get_loaded_model_src()
+    box_model = m.OCRBoxModel.get_loaded_model()
+
+    logger.debug(f'STREAM: START {md5}')
+
+    img_obj = register_image(md5, img)
+    bbox_obj_list_single, bbox_obj_list_merged = box_model.box_detection(
+        img_obj, lang_src ,image=img, options=options_box
+        )
+
+    for i, bbox_obj in enumerate(bbox_obj_list_merged):
+        yield {'index': i, 'ocr': None, 'tsl': None, 'box': bbox_obj.lbrt}
+
+    img = _shared_rgb(img)
+
+    for i, text_obj, tsl_obj in _ocr_tsl_dataflow(
+            img, bbox_obj_list_single, bbox_obj_list_merged, options_ocr, options_tsl, force=force
+            ):
+        yield {
+            'index': i,
+            'ocr': text_obj.text,
+            'tsl': tsl_obj.text,
+            'box': bbox_obj_list_merged[i].lbrt,
+            }
+
+    logger.debug('STREAM: DONE')
@@ -0,0 +1,138 @@
+###################################################################################
+# ocr_translate - a django app to perform OCR and translation of images.          #
+# Copyright (C) 2023-present Davide Grassano                                      #
+#                                                                                 #
+# This program is free software: you can redistribute it and/or modify            #
+# it under the terms of the GNU General Public License as published by            #
+# the Free Software Foundation, either version 3 of the License.                  #
+#                                                                                 #
+# This program is distributed in the hope that it will be useful,                 #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of                  #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                   #
+# GNU General Public License for more details.                                    #
+#                                                                                 #
+# You should have received a copy of the GNU General Public License               #
+# along with this program.  If not, see {http://www.gnu.org/licenses/}.           #
+#                                                                                 #
+# Home: https://github.com/Crivella/ocr_translate                                 #
+###################################################################################
+"""Perceptual hashing of images and BK-tree index for fast Hamming distance lookups."""
+import os
+import threading
+from collections.abc import Callable, Iterable
+from typing import Any
+
+import numpy as np
+from PIL import Image
+
+# Max Hamming distance (out of 64 bits) for two images to be considered near-duplicates
+max_distance = int(os.environ.get('PHASH_MAX_DISTANCE', 6))
+
+def dhash(img: Image.Image, hash_size: int = 8) -> int:
+    """Difference hash of an image: robust to re-encoding, recompression and resizing.
+
+    Args:
+        img (Image.Image): The image to hash.
+        hash_size (int, optional): Side of the hash grid (the hash has `hash_size**2` bits). Defaults to 8.
+
+    Returns:
+        int: The hash as an integer.
+    """
+    small = img.convert('L').resize((hash_size + 1, hash_size), Image.Resampling.BOX)
+    arr = np.asarray(small, dtype=np.int16)
+    bits = (arr[:, 1:] > arr[:, :-1]).flatten()
+    return int(''.join('1' if _ else '0' for _ in bits), 2)
+
+def hamming(hash1: int, hash2: int) -> int:
+    """Hamming distance between two hashes."""
+    return (hash1 ^ hash2).bit_count()
+
+def to_hex(hash_: int, hash_size: int = 8) -> str:
+    """Hexadecimal representation of a hash (fits a 64 bit hash in the DB without signed integer issues)."""
+    return f'{hash_:0{hash_size**2 // 4}x}'
+
+class BKTreeNode:
+    """Node of the BK-tree data structure."""
+    def __init__(self, key: int, value: Any):
+        self.key = key
+        self.values = [value]
+        self.children: dict[int, 'BKTreeNode'] = {}
+
+class BKTree:
+    """BK-tree data structure indexing integer hashes by their Hamming distance."""
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(self, key: int, value: Any) -> None:
+        """Add a value under a hash (multiple values can share the same hash)."""
+        self.size += 1
+        if self.root is None:
+            self.root = BKTreeNode(key, value)
+            return
+        node = self.root
+        while True:
+            dist = hamming(key, node.key)
+            if dist == 0:
+                node.values.append(value)
+                return
+            child = node.children.get(dist)
+            if child is None:
+                node.children[dist] = BKTreeNode(key, value)
+                return
+            node = child
+
+    def search(self, key: int, max_distance: int) -> list[tuple[int, Any]]:
+        """Find the values whose hash is within `max_distance` of `key`.
+
+        Returns:
+            list[tuple[int, Any]]: List of (distance, value) sorted by distance.
+        """
+        res = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            dist = hamming(key, node.key)
+            if dist <= max_distance:
+                res.extend((dist, _) for _ in node.values)
+            # Triangle inequality: only children at distance in [dist - max, dist + max] can match
+            for child_dist, child in node.children.items():
+                if dist - max_distance <= child_dist <= dist + max_distance:
+                    stack.append(child)
+        res.sort(key=lambda _: _[0])
+        return res
+
+class PHashIndex():
+    """Thread safe BK-tree of image hashes, loaded lazily (on the first search) from a source of (hex hash, value)."""
+    def __init__(self, loader: Callable[[], Iterable[tuple[str, Any]]]):
+        self.loader = loader
+        self._lock = threading.Lock()
+        self._tree: BKTree = None
+
+    def _load(self) -> BKTree:
+        """Build the tree from the loader (must be called with the lock acquired)."""
+        if self._tree is None:
+            tree = BKTree()
+            for hex_hash, value in self.loader():
+                tree.add(int(hex_hash, 16), value)
+            self._tree = tree
+        return self._tree
+
+    def add(self, hex_hash: str, value: Any) -> None:
+        """Add a new hash. Ignored if the index was not loaded yet (it will be picked up by the loader)."""
+        with self._lock:
+            if self._tree is not None:
+                self._tree.add(int(hex_hash, 16), value)
+
+    def search(self, hex_hash: str, max_distance: int) -> list[tuple[int, Any]]:
+        """Find the values whose hash is within `max_distance` of `hex_hash`, sorted by distance."""
+        with self._lock:
+            return self._load().search(int(hex_hash, 16), max_distance)
+
+    def reset(self) -> None:
+        """Drop the tree (it will be reloaded on the next search)."""
+        with self._lock:
+            self._tree = None
@@ -19,24 +19,97 @@
 """Queues definition for the ocr_translate app."""
 import os
 
-from .messaging import WorkerMessageQueue
+from .messaging import PrefetchQueue, WorkerMessageQueue
 
 num_main_workers = int(os.environ.get('NUM_MAIN_WORKERS', 4))
 num_box_workers = int(os.environ.get('NUM_BOX_WORKERS', 1))
 num_ocr_workers = int(os.environ.get('NUM_OCR_WORKERS', 1))
 num_tsl_workers = int(os.environ.get('NUM_TSL_WORKERS', 1))
 
-main_queue = WorkerMessageQueue(num_workers=num_main_workers)
-box_queue = WorkerMessageQueue(num_workers=num_box_workers)
-ocr_queue = WorkerMessageQueue(num_workers=num_ocr_workers)
+# Upper bounds for the autoscaler (NUM_*_WORKERS is used as the lower bound)
+max_main_workers = int(os.environ.get('MAX_MAIN_WORKERS', num_main_workers))
+max_box_workers = int(os.environ.get('MAX_BOX_WORKERS', num_box_workers))
+max_ocr_workers = int(os.environ.get('MAX_OCR_WORKERS', num_ocr_workers))
+max_tsl_workers = int(os.environ.get('MAX_TSL_WORKERS', num_tsl_workers))
+
+box_executor = os.environ.get('BOX_EXECUTOR', 'thread')
+ocr_executor = os.environ.get('OCR_EXECUTOR', 'thread')
+
+tsl_batch_size = int(os.environ.get('TSL_BATCH_SIZE', 32))
+tsl_batch_timeout = float(os.environ.get('TSL_BATCH_TIMEOUT', 0.5))
+# Only used by OCR models that opt in with `BATCHABLE = True`
+ocr_batch_size = int(os.environ.get('OCR_BATCH_SIZE', 16))
+ocr_batch_timeout = float(os.environ.get('OCR_BATCH_TIMEOUT', 0.1))
+# Only used by box models that opt in with `BATCHABLE = True`
+box_batch_size = int(os.environ.get('BOX_BATCH_SIZE', 4))
+box_batch_timeout = float(os.environ.get('BOX_BATCH_TIMEOUT', 0.1))
+
+# Max time in seconds a request waits for its messages to be resolved (0 = no limit)
+response_timeout = float(os.environ.get('RESPONSE_TIMEOUT', 600))
+
+msg_cache_max_len = int(os.environ.get('MSG_CACHE_MAX_LEN', 4096))
+msg_cache_max_age = float(os.environ.get('MSG_CACHE_MAX_AGE', 3600))
+cache_kwargs = {
+    'max_len': msg_cache_max_len,
+    'max_age': msg_cache_max_age,
+}
+
+# Admission control (0 = no limit). Box/OCR queues are only fed by the main workers so they are bounded already
+main_limits = {
+    'max_depth': int(os.environ.get('MAIN_QUEUE_MAX_DEPTH', 0)),
+    'max_inflight': int(os.environ.get('MAIN_QUEUE_MAX_INFLIGHT', 0)),
+}
+tsl_limits = {
+    'max_depth': int(os.environ.get('TSL_QUEUE_MAX_DEPTH', 0)),
+    'max_inflight': int(os.environ.get('TSL_QUEUE_MAX_INFLIGHT', 0)),
+}
+
+main_queue = WorkerMessageQueue(
+    num_workers=num_main_workers, max_workers=max_main_workers, **cache_kwargs, **main_limits
+    )
+box_queue = WorkerMessageQueue(
+    num_workers=num_box_workers,
+    max_workers=max_box_workers,
+    executor=box_executor,
+    **cache_kwargs,
+    allow_batching=True,
+    batch_size=box_batch_size,
+    batch_timeout=box_batch_timeout,
+    batch_args=(0,)
+    )
+ocr_queue = WorkerMessageQueue(
+    num_workers=num_ocr_workers,
+    max_workers=max_ocr_workers,
+    executor=ocr_executor,
+    **cache_kwargs,
+    allow_batching=True,
+    batch_size=ocr_batch_size,
+    batch_timeout=ocr_batch_timeout,
+    batch_args=(0,)
+    )
 tsl_queue = WorkerMessageQueue(
     num_workers=num_tsl_workers,
+    max_workers=max_tsl_workers,
+    **cache_kwargs,
+    **tsl_limits,
     allow_batching=True,
-    # batch_timeout=15,
+    batch_size=tsl_batch_size,
+    batch_timeout=tsl_batch_timeout,
     batch_args= (0,)
     )
 
+# Fed to the main queue only while its workers are idle
+prefetch_queue = PrefetchQueue(main_queue, max_pending=int(os.environ.get('PREFETCH_MAX_PENDING', 256)))
+
+QUEUES = {
+    'main': main_queue,
+    'box': box_queue,
+    'ocr': ocr_queue,
+    'tsl': tsl_queue,
+}
+
 main_queue.start_workers()
 box_queue.start_workers()
 ocr_queue.start_workers()
 tsl_queue.start_workers()
+prefetch_queue.start()
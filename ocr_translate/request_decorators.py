@@ -19,32 +19,61 @@
 """Decorators to preparse requests and responses."""
 
 import json
+import math
 import time
 from functools import wraps
 from threading import Lock
 
-from django.http import HttpRequest, JsonResponse
+from django.http import HttpRequest, JsonResponse, StreamingHttpResponse
 
 from . import models as m
+from .messaging import (MessageCancelledError, Priority, QueueFullError,
+                        deadline_context, priority_context)
 
 locks = {}
 
+class _ClosingIterable():
+    """Iterable calling a function when closed by the server (once the response has been sent or the client
+    disconnected), even if it was never iterated."""
+    def __init__(self, iterable, callback):
+        self.iterable = iterable
+        self.callback = callback
+
+    def __iter__(self):
+        yield from self.iterable
+
+    def close(self):
+        """Close the wrapped iterable and call the callback (only once)."""
+        callback, self.callback = self.callback, None
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            if callback is not None:
+                callback()
+
+def on_close(response: StreamingHttpResponse, callback):
+    """Call `callback` when the streaming response is closed, i.e. after its content has been generated."""
+    response.streaming_content = _ClosingIterable(response.streaming_content, callback)
+
 def use_lock(lock_name: str, blocking: bool = False):
-    """Decorator to use a lock for the function."""
+    """Decorator to use a lock for the function.
+    For streaming responses the lock is held until the whole content has been generated."""
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
             lock = locks.setdefault(lock_name, Lock())
-            if blocking:
-                with lock:
-                    return func(*args, **kwargs)
-            else:
-                acquired = lock.acquire(blocking=False)
-                try:
-                    return func(*args, **kwargs)
-                finally:
-                    if acquired:
-                        lock.release()
+            acquired = lock.acquire(blocking=blocking)
+            handed_over = False
+            try:
+                res = func(*args, **kwargs)
+                if acquired and isinstance(res, StreamingHttpResponse):
+                    on_close(res, lock.release)
+                    handed_over = True
+                return res
+            finally:
+                if acquired and not handed_over:
+                    lock.release()
         return wrapper
     return decorator
 
@@ -64,6 +93,49 @@ def wait_for_lock(lock_name: str, timeout: int = None):
         return wrapper
     return decorator
 
+def with_priority(priority: Priority):
+    """Decorator to tag all the messages queued while handling the request with a priority class."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with priority_context(priority):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def queue_full_response(exc: QueueFullError) -> JsonResponse:
+    """Build the 503 response for a request rejected by the admission control of a queue."""
+    retry_after = max(1, math.ceil(exc.retry_after))
+    response = JsonResponse({'error': str(exc), 'retry_after': retry_after}, status=503)
+    response['Retry-After'] = str(retry_after)
+    return response
+
+def handle_queue_errors(func):
+    """Decorator to turn the errors of the work queues raised while handling the request into responses:
+    QueueFullError -> 503 with a Retry-After header, MessageCancelledError/TimeoutError -> 504."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except QueueFullError as exc:
+            return queue_full_response(exc)
+        except (MessageCancelledError, TimeoutError) as exc:
+            return JsonResponse({'error': f'Timeout waiting for the response: {exc}'}, status=504)
+    return wrapper
+
+def with_deadline(timeout: float):
+    """Decorator to set a deadline of `timeout` seconds from now for the request.
+    All the messages queued while handling the request are skipped by the workers once expired, and waiting for
+    their response is bounded by the deadline (see messaging.deadline_context)."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            deadline = time.monotonic() + timeout if timeout > 0 else None
+            with deadline_context(deadline):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
 def get_backend_models(strict: bool = True):
     """Decorator to check and add loaded models."""
     def decorator(func):
@@ -0,0 +1,291 @@
+###################################################################################
+# ocr_translate - a django app to perform OCR and translation of images.          #
+# Copyright (C) 2023-present Davide Grassano                                      #
+#                                                                                 #
+# This program is free software: you can redistribute it and/or modify            #
+# it under the terms of the GNU General Public License as published by            #
+# the Free Software Foundation, either version 3 of the License.                  #
+#                                                                                 #
+# This program is distributed in the hope that it will be useful,                 #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of                  #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                   #
+# GNU General Public License for more details.                                    #
+#                                                                                 #
+# You should have received a copy of the GNU General Public License               #
+# along with this program.  If not, see {http://www.gnu.org/licenses/}.           #
+#                                                                                 #
+# Home: https://github.com/Crivella/ocr_translate                                 #
+###################################################################################
+"""In-memory (+ optional disk) cache of the final results of the OCR + translation pipeline."""
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from collections.abc import Hashable, Iterable
+from pathlib import Path
+
+logger = logging.getLogger('ocr.general')
+
+class ResultCache():
+    """LRU cache of the `run_ocrtsl` payloads bounded by their serialized size.
+    Entries evicted from memory are kept in an optional disk tier (also bounded by size), from which they are
+    promoted back on a hit. Entries can be invalidated by key or by any OCR/translated text they contain.
+    Every disk operation is serialized by a lock taken before the memory one, so that an entry evicted to disk can not
+    be written after (and survive) an invalidation running concurrently.
+    """
+    def __init__(self, max_size: int = 0, disk_dir: str | Path = None, disk_max_size: int = 0):
+        """Create a new ResultCache.
+
+        Args:
+            max_size (int, optional): Max total size in bytes of the serialized payloads kept in memory.
+                Defaults to 0 (cache disabled).
+            disk_dir (str | Path, optional): Directory of the disk tier. Defaults to None (no disk tier).
+            disk_max_size (int, optional): Max total size in bytes of the disk tier. Defaults to 0 (no limit).
+        """
+        self.max_size = max_size
+        self.disk_max_size = disk_max_size
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self._lock = threading.Lock()
+        # Reentrant: promoting a disk entry (under this lock) goes through `put`
+        self._disk_lock = threading.RLock()
+        self._entries: OrderedDict[Hashable, tuple[list[dict], int]] = OrderedDict()
+        # Text -> keys of the in-memory entries containing it
+        self._index: dict[str, set[Hashable]] = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # Paths of the disk entries in LRU order -> size in bytes (running total in `disk_size`)
+        self._disk_entries: OrderedDict[Path, int] = OrderedDict()
+        self.disk_size = 0
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            self._disk_scan()
+
+    @property
+    def enabled(self) -> bool:
+        """Whether the cache is enabled."""
+        return self.max_size > 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    @staticmethod
+    def _texts(payload: list[dict]) -> set[str]:
+        """All the texts of a payload."""
+        return {_.get(k) for _ in payload for k in ('ocr', 'tsl')} - {None}
+
+    def _path(self, key: Hashable) -> Path:
+        """Path of the disk entry of a key."""
+        digest = hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+        return self.disk_dir / f'{digest}.json'
+
+    def _pop(self, key: Hashable) -> list[dict] | None:
+        """Remove an entry from memory (must be called with the lock acquired)."""
+        item = self._entries.pop(key, None)
+        if item is None:
+            return None
+        payload, size = item
+        self.size -= size
+        for text in self._texts(payload):
+            keys = self._index.get(text)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._index[text]
+        return payload
+
+    def _store(self, key: Hashable, payload: list[dict], size: int) -> list[tuple[Hashable, list[dict]]]:
+        """Add an entry to memory (must be called with the lock acquired).
+
+        Returns:
+            list[tuple[Hashable, list[dict]]]: The entries evicted to make room for the new one.
+        """
+        self._pop(key)
+        evicted = []
+        while self._entries and self.size + size > self.max_size:
+            old = next(iter(self._entries))
+            evicted.append((old, self._pop(old)))
+        self._entries[key] = (payload, size)
+        self.size += size
+        for text in self._texts(payload):
+            self._index.setdefault(text, set()).add(key)
+        return evicted
+
+    def get(self, key: Hashable) -> list[dict] | None:
+        """Get a payload (from memory or from the disk tier), or None if not cached."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return item[0]
+        payload = None
+        if self.disk_dir is not None:
+            # Promoted under the disk lock, not to resurrect an entry invalidated in between
+            with self._disk_lock:
+                payload = self._disk_get(key)
+                if payload is not None:
+                    self.put(key, payload)
+        with self._lock:
+            if payload is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return payload
+
+    def put(self, key: Hashable, payload: list[dict]):
+        """Cache a payload. Payloads bigger than the whole cache are not stored."""
+        if not self.enabled:
+            return
+        data = json.dumps(payload)
+        size = len(data)
+        if size > self.max_size:
+            return
+        if self.disk_dir is None:
+            with self._lock:
+                self._store(key, payload, size)
+            return
+        with self._disk_lock:
+            with self._lock:
+                evicted = self._store(key, payload, size)
+            for old, old_payload in evicted:
+                self._disk_put(old, old_payload)
+
+    def invalidate(self, key: Hashable):
+        """Remove an entry from both tiers."""
+        if self.disk_dir is None:
+            with self._lock:
+                self._pop(key)
+            return
+        with self._disk_lock:
+            with self._lock:
+                self._pop(key)
+            self._disk_remove(self._path(key))
+
+    def invalidate_texts(self, texts: Iterable[str]) -> int:
+        """Remove every entry containing (as OCR or translated text) any of the given texts from both tiers.
+
+        Returns:
+            int: Number of entries removed from memory.
+        """
+        texts = set(texts)
+        if self.disk_dir is None:
+            keys = self._invalidate_texts_memory(texts)
+        else:
+            with self._disk_lock:
+                keys = self._invalidate_texts_memory(texts)
+                # Rare operation (manual translations): scan the disk tier
+                for path in list(self._disk_entries):
+                    try:
+                        _, payload = json.loads(path.read_text(encoding='utf-8'))
+                    except (OSError, ValueError):
+                        continue
+                    if self._texts(payload) & texts:
+                        self._disk_remove(path)
+        if keys:
+            logger.debug(f'Invalidated {len(keys)} cached results')
+        return len(keys)
+
+    def _invalidate_texts_memory(self, texts: set[str]) -> set[Hashable]:
+        """Remove every in-memory entry containing any of the given texts and return their keys."""
+        with self._lock:
+            keys = set()
+            for text in texts:
+                keys |= self._index.get(text, set())
+            for key in keys:
+                self._pop(key)
+        return keys
+
+    def clear(self):
+        """Remove every entry from memory (the disk tier is kept)."""
+        with self._lock:
+            self._entries.clear()
+            self._index.clear()
+            self.size = 0
+
+    def _disk_scan(self):
+        """Index the entries already in the disk tier (in order of last use, from their mtime)."""
+        files = []
+        for path in self.disk_dir.glob('*.json'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, path, stat.st_size))
+        for _, path, size in sorted(files):
+            self._disk_entries[path] = size
+            self.disk_size += size
+
+    def _disk_remove(self, path: Path):
+        """Remove an entry from the disk tier (must be called with the disk lock acquired)."""
+        self.disk_size -= self._disk_entries.pop(path, 0)
+        try:
+            path.unlink(missing_ok=True)
+        except OSError:
+            logger.warning(f'Failed to remove result cache entry {path}', exc_info=True)
+
+    def _disk_get(self, key: Hashable) -> list[dict] | None:
+        """Load an entry from the disk tier (must be called with the disk lock acquired)."""
+        path = self._path(key)
+        if path not in self._disk_entries:
+            return None
+        try:
+            stored_key, payload = json.loads(path.read_text(encoding='utf-8'))
+        except FileNotFoundError:
+            # Removed from outside
+            self._disk_remove(path)
+            return None
+        except (OSError, ValueError):
+            return None
+        # Guard against hash collisions
+        if stored_key != json.loads(json.dumps(key)):
+            return None
+        self._disk_entries.move_to_end(path)
+        try:
+            # Keep the LRU order across restarts
+            path.touch()
+        except OSError:
+            pass
+        return payload
+
+    def _disk_put(self, key: Hashable, payload: list[dict]):
+        """Write an entry to the disk tier, evicting the least recently used entries if needed
+        (must be called with the disk lock acquired)."""
+        path = self._path(key)
+        data = json.dumps([key, payload]).encode('utf-8')
+        try:
+            path.write_bytes(data)
+        except OSError:
+            logger.warning(f'Failed to write result cache entry to {self.disk_dir}', exc_info=True)
+            return
+        self.disk_size -= self._disk_entries.pop(path, 0)
+        self._disk_entries[path] = len(data)
+        self.disk_size += len(data)
+        if not self.disk_max_size:
+            return
+        while self._disk_entries and self.disk_size > self.disk_max_size:
+            self._disk_remove(next(iter(self._disk_entries)))
+
+    def stats(self) -> dict:
+        """Return the size and hit/miss counters of the cache."""
+        with self._lock:
+            return {
+                'len': len(self._entries),
+                'size': self.size,
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+result_cache = ResultCache(
+    max_size=int(os.environ.get('RESULT_CACHE_MAX_SIZE', 32 * 1024 * 1024)),
+    disk_dir=os.environ.get('RESULT_CACHE_DIR', None),
+    disk_max_size=int(os.environ.get('RESULT_CACHE_DISK_MAX_SIZE', 512 * 1024 * 1024)),
+)
@@ -0,0 +1,109 @@
+###################################################################################
+# ocr_translate - a django app to perform OCR and translation of images.          #
+# Copyright (C) 2023-present Davide Grassano                                      #
+#                                                                                 #
+# This program is free software: you can redistribute it and/or modify            #
+# it under the terms of the GNU General Public License as published by            #
+# the Free Software Foundation, either version 3 of the License.                  #
+#                                                                                 #
+# This program is distributed in the hope that it will be useful,                 #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of                  #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                   #
+# GNU General Public License for more details.                                    #
+#                                                                                 #
+# You should have received a copy of the GNU General Public License               #
+# along with this program.  If not, see {http://www.gnu.org/licenses/}.           #
+#                                                                                 #
+# Home: https://github.com/Crivella/ocr_translate                                 #
+###################################################################################
+"""Helpers for the binary upload transport of images: streaming digests and decoding of the options."""
+import base64
+import hashlib
+import json
+from typing import Any, Callable
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# Same ids as the `md5` of the base64 contents sent to `run_ocrtsl`, so that results are shared with JSON clients
+DEFAULT_DIGEST = 'md5-base64'
+
+class UnsupportedFormatError(Exception):
+    """Raised when data is sent in a format (content type) that is not supported."""
+
+class Base64MD5():
+    """md5 of the base64 encoding of the data, computed in a streaming fashion (without encoding the whole data)."""
+    def __init__(self):
+        self._md5 = hashlib.md5()
+        self._rest = b''
+
+    def update(self, data: bytes) -> None:
+        """Add a chunk of binary data. Only groups of 3 bytes can be encoded without padding, the rest is kept."""
+        data = self._rest + data
+        cut = len(data) - len(data) % 3
+        self._md5.update(base64.b64encode(data[:cut]))
+        self._rest = data[cut:]
+
+    def hexdigest(self) -> str:
+        """Digest of the data added so far."""
+        res = self._md5.copy()
+        res.update(base64.b64encode(self._rest))
+        return res.hexdigest()
+
+# Factories of objects with the hashlib interface (`update`/`hexdigest`)
+DIGESTS: dict[str, Callable[[], Any]] = {
+    'md5-base64': Base64MD5,
+    'md5': hashlib.md5,
+    # 128 bits digests to fit the `Image.md5` field
+    'blake2b': lambda: hashlib.blake2b(digest_size=16),
+}
+if xxhash is not None:
+    DIGESTS['xxh128'] = xxhash.xxh3_128
+
+OPTIONS_DECODERS: dict[str, Callable[[bytes], dict]] = {
+    'application/json': json.loads,
+}
+if msgpack is not None:
+    OPTIONS_DECODERS['application/msgpack'] = msgpack.unpackb
+    OPTIONS_DECODERS['application/x-msgpack'] = msgpack.unpackb
+if cbor2 is not None:
+    OPTIONS_DECODERS['application/cbor'] = cbor2.loads
+
+def new_digest(algorithm: str) -> Any:
+    """Create a new digest object (with the hashlib interface).
+
+    Raises:
+        ValueError: If the algorithm is not supported.
+    """
+    factory = DIGESTS.get(algorithm.lower())
+    if factory is None:
+        raise ValueError(f'Unsupported digest algorithm: {algorithm}')
+    return factory()
+
+def decode_options(data: bytes, content_type: str) -> dict:
+    """Decode the options of a request from JSON, MessagePack or CBOR (the latter two if installed).
+
+    Raises:
+        UnsupportedFormatError: If the format is not supported.
+        ValueError: If the options can not be decoded to a dictionary.
+    """
+    decoder = OPTIONS_DECODERS.get((content_type or 'application/json').lower())
+    if decoder is None:
+        raise UnsupportedFormatError(f'Unsupported options format: {content_type}')
+    try:
+        res = decoder(data)
+    except Exception as exc:  # pylint: disable=broad-except
+        raise ValueError(f'Invalid options: {exc}') from exc
+    if not isinstance(res, dict):
+        raise ValueError('Invalid options: not a dictionary')
+    return res
@@ -30,8 +30,15 @@ urlpatterns = [
     path('run_tsl/', views.run_tsl, name='run_tsl'),
     path('run_tsl_xua', views.run_tsl_get_xunityautotrans, name='run_tsl_get_xunityautotrans'),
     path('run_ocrtsl/', views.run_ocrtsl, name='run_ocrtsl'),
+    path('run_ocrtsl_batch/', views.run_ocrtsl_batch, name='run_ocrtsl_batch'),
+    path('run_ocrtsl_binary/', views.run_ocrtsl_binary, name='run_ocrtsl_binary'),
+    path('probe_cached/', views.probe_cached, name='probe_cached'),
+    path('prefetch/', views.prefetch, name='prefetch'),
+    path('cancel_prefetch/', views.cancel_prefetch, name='cancel_prefetch'),
     path('set_manual_translation/', views.set_manual_translation, name='set_manual_translation'),
     path('get_active_options/', views.get_active_options, name='get_active_options'),
     path('get_plugin_data/', views.get_plugin_data, name='get_plugin_data'),
     path('manage_plugins/', views.manage_plugins, name='manage_plugins'),
+    path('get_queue_stats/', views.get_queue_stats, name='get_queue_stats'),
+    path('set_queue_bounds/', views.set_queue_bounds, name='set_queue_bounds'),
 ]
@@ -21,11 +21,14 @@
 import base64
 import hashlib
 import io
+import json
 import logging
-from typing import Union
+import time
+from queue import Empty, SimpleQueue
+from typing import Generator, Iterator, Union
 
-import numpy as np
-from django.http import HttpRequest, HttpResponse, JsonResponse
+from django.http import (HttpRequest, HttpResponse, JsonResponse,
+                         StreamingHttpResponse)
 from django.middleware import csrf
 from django.views.decorators.csrf import csrf_exempt
 from PIL import Image
@@ -34,10 +37,22 @@ from . import __version__array__
 from . import models as m
 from . import request_decorators as reqdec
 from .entrypoint_manager import ep_manager
+from .messaging import (Message, MessageCancelledError, Priority,
+                        QueueFullError, deadline_context,
+                        get_current_deadline, get_current_priority,
+                        priority_context)
 from .ocr_tsl import cached_lists as cl
-from .ocr_tsl.full import ocr_tsl_pipeline_lazy, ocr_tsl_pipeline_work
+from .ocr_tsl.full import (ocr_tsl_pipeline_lazy, ocr_tsl_pipeline_similar,
+                           ocr_tsl_pipeline_stream, ocr_tsl_pipeline_work,
+                           ocr_tsl_probe)
 from .plugin_manager import PluginManager
+from .queues import QUEUES
 from .queues import main_queue as q
+from .queues import prefetch_queue
+from .queues import response_timeout
+from .result_cache import result_cache
+from .transport import (DEFAULT_DIGEST, DIGESTS, UnsupportedFormatError,
+                        decode_options, new_digest)
 
 logger = logging.getLogger('ocr.general')
 
@@ -173,6 +188,9 @@ def set_lang(request: HttpRequest, lang_src, lang_dst) -> JsonResponse:
 @reqdec.get_backend_models(strict=True)
 @reqdec.wait_for_lock('plugin')
 @reqdec.use_lock('block_plugin_changes', blocking=False)
+@reqdec.with_priority(Priority.INTERACTIVE)
+@reqdec.handle_queue_errors
+@reqdec.with_deadline(response_timeout)
 def run_tsl(request: HttpRequest, text, tsl_model: m.TSLModel, **kwargs) -> JsonResponse:
     """Handle a POST request to run translation.
     Expected data:
@@ -196,6 +214,9 @@ def run_tsl(request: HttpRequest, text, tsl_model: m.TSLModel, **kwargs) -> Json
 @reqdec.get_data_deserializer(['text'], required=True)
 @reqdec.wait_for_lock('plugin')
 @reqdec.use_lock('block_plugin_changes', blocking=False)
+@reqdec.with_priority(Priority.INTERACTIVE)
+@reqdec.handle_queue_errors
+@reqdec.with_deadline(response_timeout)
 def run_tsl_get_xunityautotrans(
     request: HttpRequest, tsl_model: m.TSLModel, text: str,
     lang_src: m.Language, lang_dst: m.Language, **kwargs
@@ -212,19 +233,179 @@ def run_tsl_get_xunityautotrans(
 
     return HttpResponse(dst_obj.text)
 
+def _get_options(
+        options: dict, box_model: m.OCRBoxModel, ocr_model: m.OCRModel, tsl_model: m.TSLModel
+        ) -> tuple[m.OptionDict, m.OptionDict, m.OptionDict]:
+    """Get the OptionDict objects for the box, OCR and translation models from the options of a request.
+
+    Raises:
+        ValueError: If the options are invalid (checked before anything is queued).
+    """
+    opt = options or {}
+
+    opt_box = opt.get(box_model.name if box_model else None, {})
+    opt_ocr = opt.get(ocr_model.name if ocr_model else None, {})
+    opt_tsl = opt.get(tsl_model.name if tsl_model else None, {})
+
+    if box_model is not None:
+        box_model.tile_options(opt_box)
+
+    options_box, _ = m.OptionDict.objects.get_or_create(options=opt_box)
+    options_ocr, _ = m.OptionDict.objects.get_or_create(options=opt_ocr)
+    options_tsl, _ = m.OptionDict.objects.get_or_create(options=opt_tsl)
+
+    return options_box, options_ocr, options_tsl
+
+def _check_md5(b64: str, md5: str):
+    """Check a base64 image against its md5 (without decoding it).
+
+    Raises:
+        ValueError: If the md5 does not match.
+    """
+    # Doing md5 on the base64 to have consistency with the JS generate one
+    # Can't find a way to run md5 on the binary in JS (the blob does not work)
+    if md5 != hashlib.md5(b64.encode('utf-8')).hexdigest():
+        raise ValueError('md5 mismatch')
+
+def _decode_image(b64: str) -> Image.Image:
+    """Decode a base64 image (already checked with `_check_md5`)."""
+    binary = base64.b64decode(b64)
+    logger.debug(f'{len(binary)} bytes decoded')
+
+    return _open_image(binary)
+
+def _load_image(b64: str, md5: str) -> Image.Image:
+    """Decode a base64 image, checking it against its md5.
+
+    Raises:
+        ValueError: If the md5 does not match.
+    """
+    _check_md5(b64, md5)
+    logger.debug(f'md5 {md5}')
+
+    return _decode_image(b64)
+
+def _open_image(binary: bytes) -> Image.Image:
+    """Open and decode an image from its binary contents."""
+    img = Image.open(io.BytesIO(binary))
+    # Decode the image synchronously (once) before going forward: enforce thread safety as the workers share it
+    img.load()
+
+    return img
+
+def _ocrtsl_id(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        md5: str,
+        lang_src: m.Language, lang_dst: m.Language,
+        box_model: m.OCRBoxModel, ocr_model: m.OCRModel, tsl_model: m.TSLModel,
+        options_box: m.OptionDict, options_ocr: m.OptionDict, options_tsl: m.OptionDict,
+        ) -> tuple:
+    """Id of the full OCR + translation pipeline of an image in the main queue."""
+    return (
+        md5,
+        lang_src.id, lang_dst.id,
+        box_model.id, ocr_model.id, tsl_model.id,
+        options_box.id, options_ocr.id, options_tsl.id,
+        )
+
+def _result_key(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        md5: str,
+        lang_src: m.Language, lang_dst: m.Language,
+        box_model: m.OCRBoxModel, ocr_model: m.OCRModel, tsl_model: m.TSLModel,
+        options: dict,
+        ) -> tuple:
+    """Key of the result of the full OCR + translation pipeline of an image in the result cache.
+    The options are keyed by their (canonical) content instead of the OptionDict ids (1:1 as options are unique),
+    so that a lookup does not need to touch the database."""
+    opt = options or {}
+    return (
+        md5,
+        lang_src.id, lang_dst.id,
+        box_model.id, ocr_model.id, tsl_model.id,
+        *(json.dumps(opt.get(_.name, {}), sort_keys=True) for _ in (box_model, ocr_model, tsl_model)),
+        )
+
+def _ocrtsl_msg(
+        img: Image.Image, md5: str, force: bool,
+        options_box: m.OptionDict, options_ocr: m.OptionDict, options_tsl: m.OptionDict,
+        ) -> dict:
+    """Message of the full OCR + translation pipeline of an image in the main queue."""
+    return {
+        'args': (img, md5),
+        'kwargs': {
+            'force': force,
+            # 'options': opt,
+            'options_box': options_box,
+            'options_ocr': options_ocr,
+            'options_tsl': options_tsl,
+            },
+    }
+
+def _put_ocrtsl(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        img: Image.Image, md5: str, force: bool,
+        lang_src: m.Language, lang_dst: m.Language,
+        box_model: m.OCRBoxModel, ocr_model: m.OCRModel, tsl_model: m.TSLModel,
+        options_box: m.OptionDict, options_ocr: m.OptionDict, options_tsl: m.OptionDict,
+        ) -> Message:
+    """Queue the full OCR + translation pipeline of an image in the main queue."""
+    # Check if same request is already in queue. If yes attach listener to it
+    return q.put(
+        id_ = _ocrtsl_id(
+            md5, lang_src, lang_dst, box_model, ocr_model, tsl_model, options_box, options_ocr, options_tsl
+            ),
+        msg = _ocrtsl_msg(img, md5, force, options_box, options_ocr, options_tsl),
+        handler = ocr_tsl_pipeline_work,
+    )
+
+def _ndjson_lines(
+        first: dict, items: Iterator[dict], priority: Priority, deadline: float
+        ) -> Generator[str, None, None]:
+    """Serialize the items as NDJSON, running the remaining steps in the priority/deadline context of the request
+    (the response is consumed after the view returned). Errors are reported as a final `{"error": ...}` line."""
+    with priority_context(priority), deadline_context(deadline):
+        try:
+            if first is not None:
+                yield json.dumps(first) + '\n'
+            for item in items:
+                yield json.dumps(item) + '\n'
+        except (QueueFullError, MessageCancelledError, TimeoutError) as exc:
+            logger.info(f'Stream interrupted: {exc}')
+            yield json.dumps({'error': str(exc)}) + '\n'
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.error(f'Failed to run ocr: {exc}')
+            yield json.dumps({'error': str(exc)}) + '\n'
+
+def _result_response(res: list[dict], stream: bool) -> Union[JsonResponse, StreamingHttpResponse]:
+    """Response with an already available result: NDJSON if `stream` else JSON."""
+    if stream:
+        return _ndjson_response(iter([{'index': i, **item} for i, item in enumerate(res)]))
+    return JsonResponse({'result': res})
+
+def _ndjson_response(items: Iterator[dict]) -> StreamingHttpResponse:
+    """Create a streaming NDJSON response.
+    The first item is generated right away so that errors in the first stage (e.g. a full queue) are still reported
+    with the proper status code."""
+    first = next(items, None)
+    return StreamingHttpResponse(
+        _ndjson_lines(first, items, get_current_priority(), get_current_deadline()),
+        content_type='application/x-ndjson',
+        )
+
 @csrf_exempt
 @reqdec.method_or_405(['POST'])
 @reqdec.get_backend_langs(strict=True)
 @reqdec.get_backend_models(strict=True)
-@reqdec.post_data_deserializer(['contents', 'md5', 'force', 'options'], required=False)
+@reqdec.post_data_deserializer(['contents', 'md5', 'force', 'options', 'stream', 'reuse_similar'], required=False)
 @reqdec.wait_for_lock('plugin')
 @reqdec.use_lock('block_plugin_changes', blocking=False)
-def run_ocrtsl(  # pylint: disable=too-many-locals
+@reqdec.with_priority(Priority.BULK)
+@reqdec.handle_queue_errors
+@reqdec.with_deadline(response_timeout)
+def run_ocrtsl(  # pylint: disable=too-many-locals,too-many-branches,too-many-return-statements
     request: HttpRequest,
     lang_src: m.Language, lang_dst: m.Language,
     box_model: m.OCRBoxModel, ocr_model: m.OCRModel, tsl_model: m.TSLModel,
-    contents: str, md5: str, force: bool, options: dict,
-    ) -> JsonResponse:
+    contents: str, md5: str, force: bool, options: dict, stream: bool = False, reuse_similar: bool = False,
+    ) -> Union[JsonResponse, StreamingHttpResponse]:
     """Handle a POST request to run OCR and translation.
     Expected data:
     {
@@ -232,19 +413,35 @@ def run_ocrtsl(  # pylint: disable=too-many-locals
         'md5': 'md5',
         'force': 'bool',
         'options': 'dict',
+        'stream': 'bool',
+        'reuse_similar': 'bool',
     }
+    If `reuse_similar` is true and `force` is not, the results of a near-duplicate of the image (same perceptual hash
+    within `PHASH_MAX_DISTANCE`) are reused, with the boxes rescaled to the size of the image.
+    If `stream` is true the response is NDJSON (one `{index, ocr, tsl, box}` item per line): first every box with
+    `ocr`/`tsl` set to null, then every item again with the texts as soon as they are ready.
     """
     b64 = contents
     frc = force
-    opt = options or {}
 
-    opt_box = opt.get(box_model.name if box_model else None, {})
-    opt_ocr = opt.get(ocr_model.name if ocr_model else None, {})
-    opt_tsl = opt.get(tsl_model.name if tsl_model else None, {})
+    if b64 is not None:
+        # Checked before the cache lookup, not to serve a cached result to a request with mismatching contents
+        try:
+            _check_md5(b64, md5)
+        except ValueError as exc:
+            return JsonResponse({'error': str(exc)}, status=400)
 
-    options_box, _ = m.OptionDict.objects.get_or_create(options=opt_box)
-    options_ocr, _ = m.OptionDict.objects.get_or_create(options=opt_ocr)
-    options_tsl, _ = m.OptionDict.objects.get_or_create(options=opt_tsl)
+    key = _result_key(md5, lang_src, lang_dst, box_model, ocr_model, tsl_model, options)
+    if frc:
+        result_cache.invalidate(key)
+    elif (res := result_cache.get(key)) is not None:
+        # Hot page: served without touching the database
+        return _result_response(res, stream)
+
+    try:
+        options_box, options_ocr, options_tsl = _get_options(options, box_model, ocr_model, tsl_model)
+    except ValueError as exc:
+        return JsonResponse({'error': str(exc)}, status=400)
 
     if b64 is None:
         logger.info('No contents, trying to lazyload')
@@ -260,53 +457,533 @@ def run_ocrtsl(  # pylint: disable=too-many-locals
         except ValueError:
             logger.info('Failed to lazyload ocr')
             return JsonResponse({'error': 'Failed to lazyload ocr'}, status=406)
-    else:
-        binary = base64.b64decode(b64)
-        # Doing md5 on the base64 to have consistency with the JS generate one
-        # Can't find a way to run md5 on the binary in JS (the blob does not work)
-        if md5 != hashlib.md5(b64.encode('utf-8')).hexdigest():
-            return JsonResponse({'error': 'md5 mismatch'}, status=400)
-        logger.debug(f'md5 {md5} <- {len(binary)} bytes')
-
-        img = Image.open(io.BytesIO(binary))
-        # Needed to make sure the image is loaded synchronously before going forward
-        # Enforce thread safety. Maybe there is a way to do it without numpy?
-        np.array(img)
-
-        # Check if same request is already in queue. If yes attach listener to it
-        id_ = (
-            md5,
-            lang_src.id, lang_dst.id,
-            box_model.id, ocr_model.id, tsl_model.id,
-            options_box.id, options_ocr.id, options_tsl.id,
-            )
+        result_cache.put(key, res)
+        return _result_response(res, stream)
 
-        msg = q.put(
-            id_ = id_,
-            msg = {
-                'args': (img, md5),
-                'kwargs': {
-                    'force': frc,
-                    # 'options': opt,
-                    'options_box': options_box,
-                    'options_ocr': options_ocr,
-                    'options_tsl': options_tsl,
-                    },
-            },
-            handler = ocr_tsl_pipeline_work,
+    try:
+        img = _decode_image(b64)
+    except ValueError as exc:
+        return JsonResponse({'error': str(exc)}, status=400)
+
+    return _run_ocrtsl_image(
+        img, md5, frc, key, stream, reuse_similar,
+        lang_src, lang_dst, box_model, ocr_model, tsl_model,
+        options_box, options_ocr, options_tsl,
         )
 
-        res = msg.response()
+def _run_ocrtsl_image(  # pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-locals
+        img: Image.Image, md5: str, force: bool, key: tuple, stream: bool, reuse_similar: bool,
+        lang_src: m.Language, lang_dst: m.Language,
+        box_model: m.OCRBoxModel, ocr_model: m.OCRModel, tsl_model: m.TSLModel,
+        options_box: m.OptionDict, options_ocr: m.OptionDict, options_tsl: m.OptionDict,
+        ) -> Union[JsonResponse, StreamingHttpResponse]:
+    """Run OCR and translation on a decoded image and create the response (shared by the JSON and binary
+    transports of `run_ocrtsl`)."""
+    if reuse_similar and not force:
+        try:
+            res = ocr_tsl_pipeline_similar(
+                img, md5,
+                options_box=options_box,
+                options_ocr=options_ocr,
+                options_tsl=options_tsl,
+                )
+        except ValueError:
+            logger.info('No near-duplicate image with results, running the pipeline')
+        else:
+            # Not cached: the rescaled results are approximate and must only be served to requests that opt in
+            return _result_response(res, stream)
+
+    if stream:
+        # Run in the request thread (every stage is still queued) to get the results of each box as they come.
+        # The run takes a slot of the main queue until the response is closed, to be subject to the same admission
+        # control (MAIN_QUEUE_MAX_DEPTH/MAX_INFLIGHT) and concurrency bound (max main workers) as the queued runs
+        release = q.reserve()
+        try:
+            response = _ndjson_response(ocr_tsl_pipeline_stream(
+                img, md5,
+                options_box=options_box,
+                options_ocr=options_ocr,
+                options_tsl=options_tsl,
+                force=force,
+                ))
+        except Exception:
+            release()
+            raise
+        reqdec.on_close(response, release)
+        return response
 
-        if isinstance(res, Exception):
-            logger.error(f'Failed to run ocr: {res}')
-            return JsonResponse({'error': str(res)}, status=500)
+    msg = _put_ocrtsl(
+        img, md5, force,
+        lang_src, lang_dst, box_model, ocr_model, tsl_model,
+        options_box, options_ocr, options_tsl,
+        )
+
+    try:
+        res = msg.response()
+    except TimeoutError:
+        # Drop the interest of this request (cancels the pipeline if no other request is waiting for it)
+        msg.release()
+        raise
 
+    if isinstance(res, (QueueFullError, MessageCancelledError, TimeoutError)):
+        # Rejected or timed out in one of the stage queues
+        raise res
+    if isinstance(res, Exception):
+        logger.error(f'Failed to run ocr: {res}')
+        return JsonResponse({'error': str(res)}, status=500)
+    result_cache.put(key, res)
 
     return JsonResponse({
         'result': res,
         })
 
+def _digest_response(
+        response: Union[JsonResponse, StreamingHttpResponse], digest: str, algorithm: str
+        ) -> Union[JsonResponse, StreamingHttpResponse]:
+    """Set the digest of the image (and its algorithm) in the headers of a `run_ocrtsl_binary` response."""
+    response['X-Image-Digest'] = digest
+    response['X-Digest-Algorithm'] = algorithm
+    return response
+
+def _parse_bool(value: str) -> bool:
+    """Parse a boolean from a query parameter."""
+    return (value or '').lower() in ('1', 'true', 'yes')
+
+BINARY_CHUNK_SIZE = 64 * 1024
+
+def _read_binary_upload(request: HttpRequest, digest) -> tuple[bytes, dict]:
+    """Read the image of a binary upload (raw body or `image` part of a multipart body) hashing it chunk by chunk,
+    together with the options if sent as the `options` part of a multipart body (JSON, MessagePack or CBOR).
+
+    Raises:
+        ValueError: If the image is missing or the options can not be decoded.
+        UnsupportedFormatError: If the format of the options is not supported.
+    """
+    options = None
+    if request.content_type == 'multipart/form-data':
+        upload = request.FILES.get('image')
+        if upload is None:
+            raise ValueError('image not found in multipart data')
+        chunks = upload.chunks()
+        part = request.FILES.get('options')
+        if part is not None:
+            options = decode_options(part.read(), part.content_type)
+        elif 'options' in request.POST:
+            options = decode_options(request.POST['options'].encode('utf-8'), 'application/json')
+    else:
+        chunks = iter(lambda: request.read(BINARY_CHUNK_SIZE), b'')
+
+    buffer = io.BytesIO()
+    for chunk in chunks:
+        digest.update(chunk)
+        buffer.write(chunk)
+    if not buffer.tell():
+        raise ValueError('No image data')
+    return buffer.getvalue(), options
+
+@csrf_exempt
+@reqdec.method_or_405(['POST'])
+@reqdec.get_backend_langs(strict=True)
+@reqdec.get_backend_models(strict=True)
+@reqdec.get_data_deserializer(['force', 'options', 'stream', 'reuse_similar'], required=False)
+@reqdec.wait_for_lock('plugin')
+@reqdec.use_lock('block_plugin_changes', blocking=False)
+@reqdec.with_priority(Priority.BULK)
+@reqdec.handle_queue_errors
+@reqdec.with_deadline(response_timeout)
+def run_ocrtsl_binary(  # pylint: disable=too-many-locals,too-many-return-statements
+    request: HttpRequest,
+    lang_src: m.Language, lang_dst: m.Language,
+    box_model: m.OCRBoxModel, ocr_model: m.OCRModel, tsl_model: m.TSLModel,
+    force: str, options: str, stream: str, reuse_similar: str,
+    ) -> Union[JsonResponse, StreamingHttpResponse]:
+    """Handle a POST request to run OCR and translation on an image sent as raw bytes (or as the `image` part of a
+    multipart body) instead of base64 inside JSON.
+    Expected query parameters (all optional):
+        force, stream, reuse_similar: 'true'/'false' (same as `run_ocrtsl`)
+        options: JSON dict (can also be sent as the `options` part of a multipart body, as JSON/MessagePack/CBOR)
+    Headers:
+        X-Digest-Algorithm: Algorithm used to identify the image (default `md5-base64`, the same ids as the `md5`
+            of `run_ocrtsl`). Faster alternatives (e.g. `blake2b`, `xxh128`) are listed in the error if not supported.
+        X-Image-Digest: Digest of the image computed by the client (optional). If given it is checked, and a
+            cached result is served without reading the image.
+    The response is the same as `run_ocrtsl`, with the digest of the image in the `X-Image-Digest` header.
+    The digest is used as the id of the image (`Image.md5`) whatever the algorithm: the same page uploaded with two
+    different algorithms is stored as two images and runs the pipeline twice. Clients should stick to one algorithm
+    (`md5-base64` to share the results with `run_ocrtsl`).
+    """
+    algorithm = request.headers.get('X-Digest-Algorithm', DEFAULT_DIGEST).lower()
+    try:
+        digest = new_digest(algorithm)
+    except ValueError as exc:
+        return JsonResponse({'error': str(exc), 'supported': list(DIGESTS)}, status=400)
+    client_digest = request.headers.get('X-Image-Digest')
+    frc = _parse_bool(force)
+    stream = _parse_bool(stream)
+
+    try:
+        opt = decode_options(options.encode('utf-8'), 'application/json') if options else None
+        if client_digest and not frc and request.content_type != 'multipart/form-data':
+            # Served from the cache without reading/hashing the body
+            key = _result_key(client_digest, lang_src, lang_dst, box_model, ocr_model, tsl_model, opt)
+            if (res := result_cache.get(key)) is not None:
+                return _digest_response(_result_response(res, stream), client_digest, algorithm)
+        binary, part_options = _read_binary_upload(request, digest)
+    except UnsupportedFormatError as exc:
+        return JsonResponse({'error': str(exc)}, status=415)
+    except ValueError as exc:
+        return JsonResponse({'error': str(exc)}, status=400)
+    opt = part_options if part_options is not None else opt
+
+    md5 = digest.hexdigest()
+    if client_digest and client_digest != md5:
+        return JsonResponse({'error': 'digest mismatch'}, status=400)
+    logger.debug(f'{algorithm} {md5} <- {len(binary)} bytes')
+
+    key = _result_key(md5, lang_src, lang_dst, box_model, ocr_model, tsl_model, opt)
+    if frc:
+        result_cache.invalidate(key)
+        res = None
+    else:
+        res = result_cache.get(key)
+    if res is not None:
+        response = _result_response(res, stream)
+    else:
+        try:
+            img = _open_image(binary)
+        except OSError:
+            return JsonResponse({'error': 'Invalid image'}, status=400)
+        try:
+            options_box, options_ocr, options_tsl = _get_options(opt, box_model, ocr_model, tsl_model)
+        except ValueError as exc:
+            return JsonResponse({'error': str(exc)}, status=400)
+        response = _run_ocrtsl_image(
+            img, md5, frc, key, stream, _parse_bool(reuse_similar),
+            lang_src, lang_dst, box_model, ocr_model, tsl_model,
+            options_box, options_ocr, options_tsl,
+            )
+    return _digest_response(response, md5, algorithm)
+
+def _iter_pages(pages: list[dict]) -> Generator[dict, None, None]:
+    """Yield the result of every page of a batch in order of completion.
+    Pages with a `msg` wait for the message (and the result is cached under the page `key`, if any), the others are
+    yielded as they are. Errors of a single page (including the deadline expiring) are reported in its `error` field
+    without failing the other pages.
+    Messages still pending when the generator is closed are released."""
+    ready = SimpleQueue()
+    pending = {}
+    keys = {}
+    for i, page in enumerate(pages):
+        keys[i] = page.pop('key', None)
+        msg = page.pop('msg', None)
+        if msg is None:
+            ready.put(i)
+        else:
+            pending[i] = msg
+            msg.add_done_callback(lambda _, i=i: ready.put(i))
+
+    deadline = get_current_deadline()
+    try:
+        for _ in range(len(pages)):
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                i = ready.get(timeout=timeout)
+            except Empty:
+                break
+            page = pages[i]
+            msg = pending.pop(i, None)
+            if msg is not None:
+                try:
+                    res = msg.response()
+                except MessageCancelledError as exc:
+                    res = exc
+                if isinstance(res, Exception):
+                    logger.error(f'Failed to run ocr on {page["md5"]}: {res}')
+                    page['error'] = str(res)
+                else:
+                    page['result'] = res
+                    if keys[i] is not None:
+                        result_cache.put(keys[i], res)
+            yield {'index': i, **page}
+        for i in pending:
+            yield {'index': i, **pages[i], 'error': 'Timeout waiting for the response'}
+    finally:
+        for msg in pending.values():
+            msg.release()
+
+@csrf_exempt
+@reqdec.method_or_405(['POST'])
+@reqdec.get_backend_langs(strict=True)
+@reqdec.get_backend_models(strict=True)
+@reqdec.post_data_deserializer(['images', 'force', 'options', 'stream'], required=False)
+@reqdec.wait_for_lock('plugin')
+@reqdec.use_lock('block_plugin_changes', blocking=False)
+@reqdec.with_priority(Priority.BULK)
+@reqdec.handle_queue_errors
+@reqdec.with_deadline(response_timeout)
+def run_ocrtsl_batch(  # pylint: disable=too-many-locals
+    request: HttpRequest,
+    lang_src: m.Language, lang_dst: m.Language,
+    box_model: m.OCRBoxModel, ocr_model: m.OCRModel, tsl_model: m.TSLModel,
+    images: list[dict], force: bool, options: dict, stream: bool = False,
+    ) -> Union[JsonResponse, StreamingHttpResponse]:
+    """Handle a POST request to run OCR and translation on many images (e.g. a whole chapter) at once.
+    All the pages are queued together so that box detection, OCR and translation can batch across pages.
+    Expected data:
+    {
+        'images': [{'contents': 'base64', 'md5': 'md5'}, ...],  # `contents` can be omitted to lazyload the page
+        'force': 'bool',
+        'options': 'dict',
+        'stream': 'bool',
+    }
+    Returns `{'results': [{'md5', 'result' | 'error'}, ...]}` in the order of `images`, or if `stream` is true one
+    `{index, md5, result | error}` item per line (NDJSON) as soon as each page is done.
+    """
+    if not isinstance(images, list) or not images:
+        return JsonResponse({'error': '`images` must be a non-empty list'}, status=400)
+    try:
+        options_box, options_ocr, options_tsl = _get_options(options, box_model, ocr_model, tsl_model)
+    except ValueError as exc:
+        return JsonResponse({'error': str(exc)}, status=400)
+
+    # Validate everything before queuing anything
+    decoded = []
+    keys = []
+    cached = []
+    for i, page in enumerate(images):
+        if not isinstance(page, dict) or 'md5' not in page:
+            return JsonResponse({'error': f'Image {i}: md5 not found'}, status=400)
+        b64 = page.get('contents')
+        if b64 is None and force:
+            return JsonResponse({'error': f'Image {i}: Cannot force ocr without contents'}, status=400)
+        try:
+            if b64 is not None:
+                _check_md5(b64, page['md5'])
+        except ValueError as exc:
+            return JsonResponse({'error': f'Image {i}: {exc}'}, status=400)
+        key = _result_key(page['md5'], lang_src, lang_dst, box_model, ocr_model, tsl_model, options)
+        res = None if force else result_cache.get(key)
+        keys.append(key)
+        cached.append(res)
+        if b64 is None or res is not None:
+            # Hot pages are served without decoding them
+            decoded.append(None)
+            continue
+        try:
+            decoded.append(_decode_image(b64))
+        except ValueError as exc:
+            return JsonResponse({'error': f'Image {i}: {exc}'}, status=400)
+
+    pages = []
+    try:
+        for page, img, key, res in zip(images, decoded, keys, cached):
+            md5 = page['md5']
+            if res is not None:
+                pages.append({'md5': md5, 'result': res})
+                continue
+            if force:
+                result_cache.invalidate(key)
+            if img is None:
+                try:
+                    res = ocr_tsl_pipeline_lazy(
+                        md5,
+                        options_box=options_box,
+                        options_ocr=options_ocr,
+                        options_tsl=options_tsl,
+                        )
+                except ValueError:
+                    pages.append({'md5': md5, 'error': 'Failed to lazyload ocr'})
+                else:
+                    result_cache.put(key, res)
+                    pages.append({'md5': md5, 'result': res})
+                continue
+            pages.append({'md5': md5, 'key': key, 'msg': _put_ocrtsl(
+                img, md5, force,
+                lang_src, lang_dst, box_model, ocr_model, tsl_model,
+                options_box, options_ocr, options_tsl,
+                )})
+    except QueueFullError:
+        # Do not leave part of the batch running
+        for page in pages:
+            if 'msg' in page:
+                page['msg'].release()
+        raise
+
+    results = _iter_pages(pages)
+    if stream:
+        return _ndjson_response(results)
+
+    res = [None] * len(pages)
+    for item in results:
+        res[item.pop('index')] = item
+    return JsonResponse({
+        'results': res,
+        })
+
+
+@csrf_exempt
+@reqdec.method_or_405(['POST'])
+@reqdec.get_backend_langs(strict=True)
+@reqdec.get_backend_models(strict=True)
+@reqdec.post_data_deserializer(['images', 'options'], required=False)
+@reqdec.wait_for_lock('plugin')
+@reqdec.with_priority(Priority.PREFETCH)
+@reqdec.handle_queue_errors
+def prefetch(  # pylint: disable=too-many-locals
+    request: HttpRequest,
+    lang_src: m.Language, lang_dst: m.Language,
+    box_model: m.OCRBoxModel, ocr_model: m.OCRModel, tsl_model: m.TSLModel,
+    images: list[dict], options: dict,
+    ) -> JsonResponse:
+    """Handle a POST request to prefetch upcoming pages.
+    The full pipeline is run at the lowest priority only while the main workers are idle, so that a later
+    `run_ocrtsl` without contents finds the results in the database.
+    Expected data:
+    {
+        'images': [{'contents': 'base64', 'md5': 'md5'}, ...],  # `contents` can be omitted to only check the status
+        'options': 'dict',
+    }
+    Returns `{'results': [{'md5', 'status'}, ...]}` with status:
+      - `done`: results already available
+      - `queued`: waiting for the workers to be idle
+      - `running`: already being processed (also by a normal request)
+      - `missing`: not available and no contents to run the pipeline on
+    """
+    if not isinstance(images, list) or not images:
+        return JsonResponse({'error': '`images` must be a non-empty list'}, status=400)
+    try:
+        options_box, options_ocr, options_tsl = _get_options(options, box_model, ocr_model, tsl_model)
+    except ValueError as exc:
+        return JsonResponse({'error': str(exc)}, status=400)
+    for i, page in enumerate(images):
+        if not isinstance(page, dict) or 'md5' not in page:
+            return JsonResponse({'error': f'Image {i}: md5 not found'}, status=400)
+
+    res = []
+    for i, page in enumerate(images):
+        md5 = page['md5']
+        id_ = _ocrtsl_id(
+            md5, lang_src, lang_dst, box_model, ocr_model, tsl_model, options_box, options_ocr, options_tsl
+            )
+        status = prefetch_queue.status(id_)
+        if status is None:
+            try:
+                ocr_tsl_pipeline_lazy(md5, options_box=options_box, options_ocr=options_ocr, options_tsl=options_tsl)
+                status = 'done'
+            except ValueError:
+                status = 'missing'
+        if status == 'missing' and page.get('contents') is not None:
+            try:
+                img = _load_image(page['contents'], md5)
+            except ValueError as exc:
+                return JsonResponse({'error': f'Image {i}: {exc}'}, status=400)
+            status = prefetch_queue.put(
+                id_,
+                _ocrtsl_msg(img, md5, False, options_box, options_ocr, options_tsl),
+                ocr_tsl_pipeline_work,
+                )
+        res.append({'md5': md5, 'status': status})
+
+    return JsonResponse({
+        'results': res,
+        })
+
+@csrf_exempt
+@reqdec.method_or_405(['POST'])
+@reqdec.get_backend_langs(strict=True)
+@reqdec.get_backend_models(strict=True)
+@reqdec.post_data_deserializer(['images', 'options'], required=False)
+def cancel_prefetch(
+    request: HttpRequest,
+    lang_src: m.Language, lang_dst: m.Language,
+    box_model: m.OCRBoxModel, ocr_model: m.OCRModel, tsl_model: m.TSLModel,
+    images: list[dict], options: dict,
+    ) -> JsonResponse:
+    """Handle a POST request to cancel prefetched pages.
+    Pages already being processed are only cancelled if no other request is waiting for them.
+    Expected data:
+    {
+        'images': [{'md5': 'md5'}, ...],
+        'options': 'dict',
+    }
+    """
+    if not isinstance(images, list) or not images:
+        return JsonResponse({'error': '`images` must be a non-empty list'}, status=400)
+    try:
+        options_box, options_ocr, options_tsl = _get_options(options, box_model, ocr_model, tsl_model)
+    except ValueError as exc:
+        return JsonResponse({'error': str(exc)}, status=400)
+
+    res = []
+    for i, page in enumerate(images):
+        if not isinstance(page, dict) or 'md5' not in page:
+            return JsonResponse({'error': f'Image {i}: md5 not found'}, status=400)
+        id_ = _ocrtsl_id(
+            page['md5'], lang_src, lang_dst, box_model, ocr_model, tsl_model, options_box, options_ocr, options_tsl
+            )
+        res.append({'md5': page['md5'], 'cancelled': prefetch_queue.cancel(id_)})
+
+    return JsonResponse({
+        'results': res,
+        })
+
+
+def _find_options(
+        options: dict, box_model: m.OCRBoxModel, ocr_model: m.OCRModel, tsl_model: m.TSLModel
+        ) -> tuple[m.OptionDict | None, m.OptionDict | None, m.OptionDict | None]:
+    """Like `_get_options` but without creating the OptionDict objects (None if they do not exist)."""
+    opt = options or {}
+    return tuple(
+        m.OptionDict.objects.filter(options=opt.get(_.name if _ else None, {})).first()
+        for _ in (box_model, ocr_model, tsl_model)
+        )
+
+@csrf_exempt
+@reqdec.method_or_405(['POST'])
+@reqdec.get_backend_langs(strict=True)
+@reqdec.get_backend_models(strict=True)
+@reqdec.post_data_deserializer(['md5s', 'options'], required=False)
+def probe_cached(
+    request: HttpRequest,
+    lang_src: m.Language, lang_dst: m.Language,
+    box_model: m.OCRBoxModel, ocr_model: m.OCRModel, tsl_model: m.TSLModel,
+    md5s: list[str], options: dict,
+    ) -> JsonResponse:
+    """Handle a POST request to check which stages of the pipeline are cached for many images at once, to know
+    which images need to be uploaded without a lazy `run_ocrtsl` attempt for each of them.
+    Unknown images are answered from an in-memory set of md5s, and cached results from the result cache, without
+    touching the database. The other images are checked together in a fixed number of queries.
+    Expected data:
+    {
+        'md5s': ['md5', ...],
+        'options': 'dict',
+    }
+    Returns `{'results': [{'md5', 'image', 'box', 'ocr', 'tsl'}, ...]}` in the order of `md5s`, where `tsl` true
+    means that a lazy `run_ocrtsl` would succeed.
+    """
+    if not isinstance(md5s, list) or not md5s or not all(isinstance(_, str) for _ in md5s):
+        return JsonResponse({'error': '`md5s` must be a non-empty list of strings'}, status=400)
+
+    res = {}
+    to_check = []
+    for md5 in md5s:
+        if md5 in res:
+            continue
+        if not cl.is_known_image(md5):
+            res[md5] = {'image': False, 'box': False, 'ocr': False, 'tsl': False}
+        elif _result_key(md5, lang_src, lang_dst, box_model, ocr_model, tsl_model, options) in result_cache:
+            res[md5] = {'image': True, 'box': True, 'ocr': True, 'tsl': True}
+        else:
+            to_check.append(md5)
+
+    if to_check:
+        options_box, options_ocr, options_tsl = _find_options(options, box_model, ocr_model, tsl_model)
+        for md5, stages in ocr_tsl_probe(to_check, options_box, options_ocr, options_tsl).items():
+            res[md5] = {'image': True, **stages}
+
+    return JsonResponse({
+        'results': [{'md5': md5, **res[md5]} for md5 in md5s],
+        })
 
 @csrf_exempt
 @reqdec.method_or_405(['GET'])
@@ -368,13 +1045,17 @@ def set_manual_translation(
     }
 
     tsl_run_obj = m.TranslationRun.objects.filter(**params).first()
+    # Cached results showing the text (or the previous manual translation edited in place) are now stale
+    stale = [text]
     if tsl_run_obj is None:
         res_obj, _ = m.Text.objects.get_or_create(text=translation)
         params['result'] = res_obj
         tsl_run_obj = m.TranslationRun.objects.create(**params)
     else:
+        stale.append(tsl_run_obj.result.text)
         tsl_run_obj.result.text = translation
         tsl_run_obj.result.save()
+    result_cache.invalidate_texts(stale)
 
     return JsonResponse({})
 
@@ -492,3 +1173,28 @@ def manage_plugins(request: HttpRequest, plugins: dict[str, bool]) -> JsonRespon
         logger.error('Failed to manage plugins', exc_info=exc)
         return JsonResponse({'error': str(exc)[0:100]}, status=502)
     return JsonResponse({'status': 'success'})
+
+@reqdec.method_or_405(['GET'])
+def get_queue_stats(request: HttpRequest) -> JsonResponse:
+    """Handle a GET request to get the state of the work queues and of their worker pools."""
+    return JsonResponse({name: queue.stats() for name, queue in QUEUES.items()})
+
+@csrf_exempt
+@reqdec.method_or_405(['POST'])
+@reqdec.post_data_deserializer(['queue', 'min_workers', 'max_workers'], required=False)
+def set_queue_bounds(request: HttpRequest, queue: str, min_workers: int, max_workers: int) -> JsonResponse:
+    """Handle a POST request to change the bounds of the worker pool of a queue.
+    Expected data:
+    {
+        'queue': 'main' | 'box' | 'ocr' | 'tsl',
+        'min_workers': int, (optional)
+        'max_workers': int, (optional)
+    }
+    """
+    if queue not in QUEUES:
+        return JsonResponse({'error': f'Unknown queue {queue}. Allowed: {", ".join(QUEUES)}'}, status=400)
+    try:
+        QUEUES[queue].set_bounds(min_workers=min_workers, max_workers=max_workers)
+    except (TypeError, ValueError) as exc:
+        return JsonResponse({'error': str(exc)}, status=400)
+    return JsonResponse(QUEUES[queue].stats())
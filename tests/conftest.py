@@ -25,6 +25,9 @@ from PIL import Image
 from ocr_translate import entrypoint_manager as epm
 from ocr_translate import models as m
 from ocr_translate import queues
+from ocr_translate.ocr_tsl import cached_lists as cl
+from ocr_translate.ocr_tsl import full
+from ocr_translate.result_cache import result_cache
 
 strings = [
     'This is a test string.',
@@ -343,6 +346,27 @@ def queues_no_reuse(monkeypatch):
     monkeypatch.setattr(queues.ocr_queue.msg_queue, 'reuse_msg', False)
     monkeypatch.setattr(queues.tsl_queue.msg_queue, 'reuse_msg', False)
 
+@pytest.fixture(autouse=True)
+def clear_result_cache():
+    """Make sure no pipeline result is cached between tests."""
+    result_cache.clear()
+    yield
+    result_cache.clear()
+
+@pytest.fixture(autouse=True)
+def reset_phash_index():
+    """Make sure the index of perceptual hashes is reloaded from the database of each test."""
+    full.phash_index.reset()
+    yield
+    full.phash_index.reset()
+
+@pytest.fixture(autouse=True)
+def reset_known_images():
+    """Make sure the set of known images is reloaded from the database of each test."""
+    cl.reset_image_cache()
+    yield
+    cl.reset_image_cache()
+
 @pytest.fixture()
 def epm_no_ept(monkeypatch):
     """Set entrypoints to be empty."""
@@ -0,0 +1,177 @@
+###################################################################################
+# ocr_translate - a django app to perform OCR and translation of images.          #
+# Copyright (C) 2023-present Davide Grassano                                      #
+#                                                                                 #
+# This program is free software: you can redistribute it and/or modify            #
+# it under the terms of the GNU General Public License as published by            #
+# the Free Software Foundation, either version 3 of the License.                  #
+#                                                                                 #
+# This program is distributed in the hope that it will be useful,                 #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of                  #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                   #
+# GNU General Public License for more details.                                    #
+#                                                                                 #
+# You should have received a copy of the GNU General Public License               #
+# along with this program.  If not, see {http://www.gnu.org/licenses/}.           #
+#                                                                                 #
+# Home: https://github.com/Crivella/ocr_translate                                 #
+###################################################################################
+"""Tests for executors.py"""
+# pylint: disable=redefined-outer-name
+
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from ocr_translate import executors, messaging
+from ocr_translate.messaging import Message, WorkerMessageQueue
+
+
+def image_info(img: Image.Image, scale: int = 1):
+    """Handler run in the child process (must be importable)."""
+    return img.size, img.mode, int(np.asarray(img, dtype=np.int64).sum()) * scale, os.getpid()
+
+def images_info(imgs: list[Image.Image]):
+    """Batched handler run in the child process."""
+    return [image_info(_)[:3] for _ in imgs]
+
+@pytest.fixture(scope='module')
+def process_executor():
+    """Process executor with a single child process (no django setup)."""
+    executor = executors.ProcessExecutor(num_procs=1, setup_django=False)
+    yield executor
+    executor.shutdown()
+
+def test_get_executor():
+    """Test getting the executors by name."""
+    assert isinstance(executors.get_executor('thread'), executors.ThreadExecutor)
+    assert isinstance(executors.get_executor('THREAD'), executors.ThreadExecutor)
+
+def test_get_executor_unknown():
+    """Test that an unknown executor name raises."""
+    with pytest.raises(ValueError):
+        executors.get_executor('unknown')
+
+def test_get_executor_process_in_child(monkeypatch):
+    """Test that a child process never spawns other processes."""
+    monkeypatch.setenv(executors.CHILD_ENV, '1')
+    assert isinstance(executors.get_executor('process'), executors.ThreadExecutor)
+
+def test_thread_executor(image_pillow):
+    """Test the thread executor calls the handler in the same process."""
+    res = executors.ThreadExecutor().call(image_info, (image_pillow,), {'scale': 2})
+    assert res[3] == os.getpid()
+    assert res[2] == 2 * int(np.asarray(image_pillow, dtype=np.int64).sum())
+
+def test_shared_image_roundtrip(image_pillow):
+    """Test copying an image to shared memory and back."""
+    ref, shm = executors.SharedImage.from_image(image_pillow)
+    try:
+        img = ref.to_image()
+    finally:
+        shm.close()
+        shm.unlink()
+    assert img.size == image_pillow.size
+    assert img.mode == image_pillow.mode
+    assert np.array_equal(np.asarray(img), np.asarray(image_pillow))
+
+def test_shared_image_palette():
+    """Test that palette images are shared as RGBA."""
+    img = Image.new('P', (10, 5))
+    ref, shm = executors.SharedImage.from_image(img)
+    try:
+        assert ref.to_image().mode == 'RGBA'
+    finally:
+        shm.close()
+        shm.unlink()
+
+def test_process_executor(process_executor, image_pillow):
+    """Test running a handler with an image in a child process."""
+    size, mode, total, pid = process_executor.call(image_info, (image_pillow,), {'scale': 3})
+    assert pid != os.getpid()
+    assert size == image_pillow.size
+    assert mode == image_pillow.mode
+    assert total == 3 * int(np.asarray(image_pillow, dtype=np.int64).sum())
+
+def test_process_executor_batched(process_executor, image_pillow):
+    """Test that images inside batched (list) arguments are shared."""
+    res = process_executor.call(images_info, ([image_pillow, image_pillow],), {})
+    assert len(res) == 2
+    assert res[0] == res[1]
+
+def test_process_executor_raise(process_executor):
+    """Test that exceptions raised in the child are propagated."""
+    with pytest.raises(AttributeError):
+        process_executor.call(image_info, (None,), {})
+
+def test_process_executor_message(process_executor, image_pillow):
+    """Test resolving a message through the process executor."""
+    msg = Message(id_=1, msg={'args': (image_pillow,)}, handler=image_info)
+    msg.resolve(call=process_executor.call)
+    assert msg.response()[0] == image_pillow.size
+
+def test_process_executor_resize(image_pillow):
+    """Test that resizing the process executor adds/removes processes one by one, keeping the used ones."""
+    executor = executors.ProcessExecutor(num_procs=1, setup_django=False)
+    try:
+        first = executor._idle[0]  # pylint: disable=protected-access
+        assert executor.call(image_info, (image_pillow,), {})[0] == image_pillow.size
+        executor.resize(1)
+        assert executor._pools == [first]  # pylint: disable=protected-access
+        executor.resize(3)
+        assert executor.num_procs == 3
+        assert len(executor._pools) == 3  # pylint: disable=protected-access
+        # The process with the replicas already loaded is used first
+        assert executor._idle[-1] is first  # pylint: disable=protected-access
+        executor.resize(1)
+        assert executor._pools == [first]  # pylint: disable=protected-access
+        assert executor.call(image_info, (image_pillow,), {})[0] == image_pillow.size
+    finally:
+        executor.shutdown()
+
+def test_process_executor_shrink_busy():
+    """Test that busy processes removed by a resize are shut down once their call is done."""
+    executor = executors.ProcessExecutor(num_procs=2, setup_django=False)
+    try:
+        pool1 = executor._acquire()  # pylint: disable=protected-access
+        pool2 = executor._acquire()  # pylint: disable=protected-access
+        executor.resize(1)
+        assert len(executor._pools) == 2  # pylint: disable=protected-access
+        executor._release(pool1)  # pylint: disable=protected-access
+        assert executor._pools == [pool2]  # pylint: disable=protected-access
+        executor._release(pool2)  # pylint: disable=protected-access
+        assert executor._idle == [pool2]  # pylint: disable=protected-access
+    finally:
+        executor.shutdown()
+
+def test_wmq_scale_resizes_executor(monkeypatch):
+    """Test that the executor follows the number of workers (not `max_workers`)."""
+    sizes = []
+    def mock_get_executor(name, num_procs):
+        sizes.append(num_procs)
+        return executors.ThreadExecutor()
+    monkeypatch.setattr(messaging, 'get_executor', mock_get_executor)
+    wmq = WorkerMessageQueue(num_workers=1, max_workers=4, executor='process')
+    monkeypatch.setattr(wmq.executor, 'resize', sizes.append)
+    wmq.scale_to(3)
+    wmq.scale_to(2)
+    wmq.set_bounds(max_workers=1)
+    assert sizes == [1, 3, 2, 1]
+
+def test_wmq_executor():
+    """Test that the WorkerMessageQueue shares the executor with its workers."""
+    wmq = WorkerMessageQueue(num_workers=2, executor='thread')
+    assert isinstance(wmq.executor, executors.ThreadExecutor)
+    assert all(worker.executor is wmq.executor for worker in wmq.workers)
+
+@pytest.mark.django_db
+def test_get_target_model(box_model):
+    """Test that handlers bound to a model are referenced by pk instead of being pickled."""
+    target = executors._get_target(box_model.box_detection)  # pylint: disable=protected-access
+    assert target == ('model', type(box_model).__module__, type(box_model).__qualname__, box_model.pk, 'box_detection')
+
+def test_get_target_callable():
+    """Test that plain callables are sent as is."""
+    assert executors._get_target(image_info) == ('callable', image_info)  # pylint: disable=protected-access
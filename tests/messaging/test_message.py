@@ -19,9 +19,14 @@
 """Tests for messaging.py"""
 # pylint: disable=redefined-outer-name
 
+import threading
+import time
+
 import pytest
 
-from ocr_translate.messaging import Message
+from ocr_translate.messaging import (Message, MessageCancelledError,
+                                     deadline_context, get_current_deadline,
+                                     message_context)
 
 msg_list = [
     {
@@ -137,6 +142,30 @@ def test_message_batch_resolve_different_kwargs(message):
     with pytest.raises(ValueError, match=r'.*same kwargs$'):
         message1.batch_resolve([message3,message2])
 
+def test_message_batch_resolve_handler_error():
+    """Test that an error of the batched handler becomes the response of every message."""
+    exc = RuntimeError('test')
+    def handler(*args):
+        raise exc
+    messages = [Message(id_=i, msg={'args': (i,), 'kwargs': {}}, handler=handler, batch_args=(0,)) for i in range(3)]
+
+    messages[0].batch_resolve(messages[1:])
+
+    for msg in messages:
+        assert msg.is_resolved
+        assert msg.response() is exc
+
+def test_message_batch_resolve_wrong_number_of_results():
+    """Test that a batched handler returning the wrong number of results resolves every message with an error."""
+    def handler(args):
+        return args[:-1]
+    messages = [Message(id_=i, msg={'args': (i,), 'kwargs': {}}, handler=handler, batch_args=(0,)) for i in range(3)]
+
+    messages[0].batch_resolve(messages[1:])
+
+    for msg in messages:
+        assert isinstance(msg.response(), ValueError)
+
 @pytest.mark.parametrize(
         'batch_message',
         [
@@ -198,3 +227,141 @@ def test_message_args(message):
     message.resolve()
     assert message.is_resolved
     assert message.response() == (args, kwargs)
+
+def test_message_done_callback(message):
+    """Test that done-callbacks are run once the message is resolved."""
+    called = []
+    message.add_done_callback(called.append)
+    assert not called
+    message.resolve()
+    assert called == [message]
+
+def test_message_done_callback_resolved(message):
+    """Test that done-callbacks added after resolution are run immediately."""
+    called = []
+    message.resolve()
+    message.add_done_callback(called.append)
+    assert called == [message]
+
+def test_message_done_callback_raise(message):
+    """Test that a failing done-callback does not prevent the resolution of the message."""
+    def callback(msg):
+        raise ValueError('Test exception')
+    message.add_done_callback(callback)
+    message.resolve()
+    assert message.is_resolved
+    assert message.response() == ((), {})
+
+def test_message_response_wakeup(message):
+    """Test that a waiter is woken up as soon as the message is resolved and not after a polling interval."""
+    timer = threading.Timer(0.05, message.resolve)
+    start = time.monotonic()
+    timer.start()
+    assert message.response(timeout=1.0) == ((), {})
+    assert time.monotonic() - start < 0.15
+    timer.join()
+
+def test_message_set_response_wakeup(message):
+    """Test that set_response wakes up the waiters."""
+    timer = threading.Timer(0.05, message.set_response, args=('test',))
+    timer.start()
+    assert message.wait(timeout=1.0)
+    assert message.response() == 'test'
+    timer.join()
+
+def test_message_cancel(message):
+    """Test that cancelling a message wakes up the waiters with an error and ignores later responses."""
+    assert message.cancel()
+    assert message.cancelled
+    with pytest.raises(MessageCancelledError):
+        message.response()
+    message.resolve()
+    with pytest.raises(MessageCancelledError):
+        message.response()
+    assert not message.cancel()
+
+def test_message_cancel_resolved(message):
+    """Test that a resolved message can not be cancelled."""
+    message.resolve()
+    assert not message.cancel()
+    assert message.response() == ((), {})
+
+def test_message_release(message):
+    """Test that a message is cancelled only once all the parties waiting for it released it."""
+    message.retain()
+    message.retain()
+    assert not message.release()
+    assert not message.cancelled
+    assert message.release()
+    assert message.cancelled
+
+def test_message_cancel_children(message):
+    """Test that cancelling a message releases its children (cancelling the ones nobody else is waiting for)."""
+    child1 = message.copy()
+    child2 = message.copy()
+    child1.retain()
+    child2.retain()
+    child2.retain()
+    message.add_child(child1)
+    message.add_child(child2)
+
+    message.cancel()
+    assert child1.cancelled
+    assert not child2.cancelled
+
+def test_message_add_child_cancelled(message):
+    """Test that children added to an already cancelled message are released immediately."""
+    message.cancel()
+    child = message.copy()
+    child.retain()
+    message.add_child(child)
+    assert child.cancelled
+
+def test_message_response_deadline(message):
+    """Test that waiting for the response is bounded by the deadline of the current context."""
+    with deadline_context(time.monotonic() + 0.05):
+        with pytest.raises(TimeoutError):
+            message.response()
+
+def test_message_extend_deadline(message):
+    """Test that extending the deadline is cascaded to the children and never shortens it."""
+    message.deadline = 10
+    child = message.copy()
+    child.deadline = 10
+    message.add_child(child)
+
+    message.extend_deadline(5)
+    assert message.deadline == 10
+    message.extend_deadline(20)
+    assert message.deadline == child.deadline == 20
+    message.extend_deadline(None)
+    assert message.deadline is child.deadline is None
+
+def test_message_context_deadline_live(message):
+    """Test that the deadline of the context follows the message being resolved when it is extended."""
+    message.deadline = 10
+    with message_context(message):
+        assert get_current_deadline() == 10
+        message.extend_deadline(20)
+        assert get_current_deadline() == 20
+    assert get_current_deadline() is None
+
+def test_message_response_deadline_extended(message):
+    """Test that waiting for a child follows the deadline of the parent being extended while waiting."""
+    parent = message.copy()
+    parent.deadline = time.monotonic() + 0.1
+    def extend_and_resolve():
+        time.sleep(0.05)
+        parent.extend_deadline(time.monotonic() + 5)
+        time.sleep(0.2)
+        message.set_response('done')
+    threading.Thread(target=extend_and_resolve).start()
+
+    with message_context(parent):
+        assert message.response() == 'done'
+
+def test_message_expired(message):
+    """Test the expired property."""
+    assert not message.expired
+    message.deadline = time.monotonic() - 1
+    assert message.expired
@@ -0,0 +1,136 @@
+###################################################################################
+# ocr_translate - a django app to perform OCR and translation of images.          #
+# Copyright (C) 2023-present Davide Grassano                                      #
+#                                                                                 #
+# This program is free software: you can redistribute it and/or modify            #
+# it under the terms of the GNU General Public License as published by            #
+# the Free Software Foundation, either version 3 of the License.                  #
+#                                                                                 #
+# This program is distributed in the hope that it will be useful,                 #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of                  #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                   #
+# GNU General Public License for more details.                                    #
+#                                                                                 #
+# You should have received a copy of the GNU General Public License               #
+# along with this program.  If not, see {http://www.gnu.org/licenses/}.           #
+#                                                                                 #
+# Home: https://github.com/Crivella/ocr_translate                                 #
+###################################################################################
+"""Tests for the prefetch queue."""
+# pylint: disable=redefined-outer-name
+
+import time
+
+import pytest
+
+from ocr_translate.messaging import (Priority, PrefetchQueue, QueueFullError,
+                                     WorkerMessageQueue)
+
+
+@pytest.fixture()
+def prefetch_queue(worker_message_queue):
+    """Return a prefetch queue feeding a (not started) worker message queue"""
+    return PrefetchQueue(worker_message_queue, max_pending=2)
+
+def handler(*args, **kwargs):
+    """Generic handler."""
+    return 'done'
+
+def test_prefetch_put_dedup(prefetch_queue):
+    """Test that entries with the same id are registered only once."""
+    assert prefetch_queue.put(1, {}, handler) == PrefetchQueue.QUEUED
+    assert prefetch_queue.put(1, {}, handler) == PrefetchQueue.QUEUED
+    assert len(prefetch_queue) == 1
+    assert prefetch_queue.status(1) == PrefetchQueue.QUEUED
+    assert prefetch_queue.status(2) is None
+
+def test_prefetch_put_dedup_inflight(prefetch_queue, worker_message_queue):
+    """Test that entries already in the target queue are not registered."""
+    worker_message_queue.put(1, {}, handler)
+
+    assert prefetch_queue.put(1, {}, handler) == PrefetchQueue.RUNNING
+    assert len(prefetch_queue) == 0
+
+def test_prefetch_put_full(prefetch_queue):
+    """Test that new entries are rejected once `max_pending` entries are waiting."""
+    prefetch_queue.put(1, {}, handler)
+    prefetch_queue.put(2, {}, handler)
+    with pytest.raises(QueueFullError):
+        prefetch_queue.put(3, {}, handler)
+
+def test_prefetch_feed_idle(prefetch_queue, worker_message_queue):
+    """Test that entries are fed at PREFETCH priority, at most one per idle worker."""
+    prefetch_queue.put(1, {}, handler)
+    prefetch_queue.put(2, {}, handler)
+
+    assert prefetch_queue.feed() == 1
+    msg = worker_message_queue.get_msg(1)
+    assert msg.priority == Priority.PREFETCH
+    assert prefetch_queue.status(1) == PrefetchQueue.RUNNING
+    assert prefetch_queue.status(2) == PrefetchQueue.QUEUED
+
+def test_prefetch_feed_busy(prefetch_queue, worker_message_queue):
+    """Test that nothing is fed while the target queue has work waiting."""
+    worker_message_queue.put('other', {}, handler)
+    prefetch_queue.put(1, {}, handler)
+
+    assert prefetch_queue.feed() == 0
+    assert len(prefetch_queue) == 1
+
+def test_prefetch_feed_target_full():
+    """Test that an entry rejected by the target queue is kept at the front."""
+    target = WorkerMessageQueue(max_inflight=1)
+    prefetch_queue = PrefetchQueue(target)
+    target.msg_queue.num_consumers = 1
+    target.put('other', {}, handler)
+    target.get()
+    prefetch_queue.put(1, {}, handler)
+    prefetch_queue.put(2, {}, handler)
+
+    assert prefetch_queue.feed() == 0
+    assert list(prefetch_queue.pending) == [1, 2]
+
+def test_prefetch_cancel_pending(prefetch_queue):
+    """Test cancelling an entry not yet fed."""
+    prefetch_queue.put(1, {}, handler)
+
+    assert prefetch_queue.cancel(1)
+    assert len(prefetch_queue) == 0
+    assert not prefetch_queue.cancel(1)
+
+def test_prefetch_cancel_fed(prefetch_queue, worker_message_queue):
+    """Test cancelling an entry already fed: the message is cancelled if nobody else waits for it."""
+    prefetch_queue.put(1, {}, handler)
+    prefetch_queue.feed()
+    msg = worker_message_queue.get_msg(1)
+
+    assert prefetch_queue.cancel(1)
+    assert msg.cancelled
+
+def test_prefetch_cancel_fed_shared(prefetch_queue, worker_message_queue):
+    """Test that cancelling a prefetch does not cancel a message a request is waiting for."""
+    prefetch_queue.put(1, {}, handler)
+    prefetch_queue.feed()
+    msg = worker_message_queue.put(1, {}, handler, priority=Priority.INTERACTIVE)
+
+    assert not prefetch_queue.cancel(1)
+    assert not msg.cancelled
+    assert msg.priority == Priority.INTERACTIVE
+
+def test_prefetch_run(prefetch_queue, worker_message_queue):
+    """Test that the feeder thread runs the entries when the workers are idle."""
+    worker_message_queue.start_workers()
+    prefetch_queue.poll_interval = 0.01
+    prefetch_queue.start()
+    try:
+        prefetch_queue.put(1, {'args': (), 'kwargs': {}}, handler)
+        for _ in range(100):
+            msg = worker_message_queue.get_msg(1)
+            if msg is not None and msg.wait(0.05):
+                break
+            time.sleep(0.01)
+        assert msg.response() == 'done'
+        assert prefetch_queue.status(1) is None
+    finally:
+        prefetch_queue.stop()
+        worker_message_queue.stop_workers()
@@ -19,9 +19,18 @@
 """Tests for messaging.py"""
 # pylint: disable=redefined-outer-name
 
+import queue
+import threading
+import time
+
 import pytest
 
-from ocr_translate.messaging import MessageQueue
+from ocr_translate.messaging import (AdaptiveBatcher, MessageCache,
+                                     MessageCancelledError,
+                                     MessageExpiredError, MessageQueue,
+                                     Priority, QueueFullError, Worker,
+                                     deadline_context, get_current_priority,
+                                     message_context, priority_context)
 
 
 def test_queue_instantiation(message_queue):
@@ -119,3 +128,385 @@ def test_batch_queue_get_multiple(batched_queue, message, num_msg):
     assert len(res) == num_msg
     for msg in messages:
         assert msg in res
+
+@pytest.mark.parametrize('message_queue', [((), {'max_len': 2})], indirect=True)
+def test_queue_cache_max_len(message_queue, message):
+    """Test that resolved messages are evicted in LRU order once max_len is exceeded."""
+    handler = message.handler
+    msg1 = message_queue.put(id_=1, msg={}, handler=handler)
+    msg2 = message_queue.put(id_=2, msg={}, handler=handler)
+    msg1.resolve()
+    msg2.resolve()
+    # Access 1 to make 2 the least recently used
+    assert message_queue.put(id_=1, msg={}, handler=handler) is msg1
+    message_queue.put(id_=3, msg={}, handler=handler)
+
+    assert message_queue.get_msg(1) is msg1
+    assert message_queue.get_msg(2) is None
+    assert message_queue.cache_stats()['evictions'] == 1
+
+@pytest.mark.parametrize('message_queue', [((), {'max_len': 1})], indirect=True)
+def test_queue_cache_unresolved_not_evicted(message_queue, message):
+    """Test that unresolved messages are never evicted."""
+    handler = message.handler
+    msg1 = message_queue.put(id_=1, msg={}, handler=handler)
+    msg2 = message_queue.put(id_=2, msg={}, handler=handler)
+
+    assert message_queue.get_msg(1) is msg1
+    assert message_queue.get_msg(2) is msg2
+    assert message_queue.cache_stats()['evictions'] == 0
+
+@pytest.mark.parametrize('message_queue', [((), {'max_age': 0.01})], indirect=True)
+def test_queue_cache_max_age(message_queue, message):
+    """Test that resolved messages older than max_age are not reused."""
+    handler = message.handler
+    msg1 = message_queue.put(id_=1, msg={}, handler=handler)
+    msg1.resolve()
+    time.sleep(0.02)
+    msg2 = message_queue.put(id_=1, msg={}, handler=handler)
+
+    assert msg2 is not msg1
+    assert message_queue.get_msg(1) is msg2
+
+def test_message_cache_max_age_last_access(monkeypatch, message):
+    """Test that max_age is the time since the last access, both on lookup and on eviction."""
+    now = [0.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    cache = MessageCache(max_age=10)
+    hot, cold = message.copy(), message.copy()
+    hot.id_, cold.id_ = 'hot', 'cold'
+    for msg in (hot, cold):
+        msg.resolve()
+        cache.add(msg)
+
+    for _ in range(3):
+        now[0] += 6
+        assert cache.get('hot') is hot
+    # Created 18s ago but accessed 0s ago: kept on eviction, while the idle entry is evicted
+    cache.add(message.copy())
+    assert 'hot' in cache
+    assert 'cold' not in cache
+
+    now[0] += 11
+    assert cache.get('hot') is None
+
+def test_queue_cache_stats(message_queue, message):
+    """Test the hit/miss counters of the message cache."""
+    handler = message.handler
+    message_queue.put(id_=1, msg={}, handler=handler)
+    message_queue.put(id_=1, msg={}, handler=handler)
+    message_queue.put(id_=2, msg={}, handler=handler)
+
+    assert message_queue.cache_stats() == {'size': 2, 'hits': 1, 'misses': 2, 'evictions': 0}
+
+def test_batch_queue_get_alone(batched_queue, message):
+    """Test that a lone batchable message does not wait for the full batch timeout."""
+    batched_queue.put(id_=0, msg=message.msg, handler=message.handler, batch_id=0)
+
+    start = time.monotonic()
+    res = batched_queue.get()
+    assert len(res) == 1
+    assert time.monotonic() - start < batched_queue.batch_timeout / 2
+
+def test_batch_queue_get_max_size(message):
+    """Test that batches are capped to batch_size and the leftover is served by the next get."""
+    batched_queue = MessageQueue(allow_batching=True, batch_args=(0,), batch_size=2, batch_timeout=5)
+    messages = [
+        batched_queue.put(id_=i, msg=message.msg, handler=message.handler, batch_id=0) for i in range(3)
+        ]
+
+    start = time.monotonic()
+    res1 = batched_queue.get()
+    res2 = batched_queue.get()
+    # Flushed early as the pool is full
+    assert time.monotonic() - start < 1
+
+    assert len(res1) == 2
+    assert len(res2) == 1
+    assert set(map(id, res1 + res2)) == set(map(id, messages))
+    assert batched_queue.empty()
+
+def test_batch_queue_get_wait_arrivals(message):
+    """Test that the batch keeps waiting while messages keep arriving at a steady rate."""
+    batched_queue = MessageQueue(allow_batching=True, batch_args=(0,), batch_timeout=1)
+    batched_queue.batcher.interarrival = 0.02
+
+    def producer():
+        for i in range(1, 5):
+            time.sleep(0.01)
+            batched_queue.put(id_=i, msg=message.msg, handler=message.handler, batch_id=0)
+
+    batched_queue.put(id_=0, msg=message.msg, handler=message.handler, batch_id=0)
+    thread = threading.Thread(target=producer)
+    thread.start()
+    res = batched_queue.get()
+    thread.join()
+
+    assert len(res) == 5
+
+def test_adaptive_batcher_idle_window():
+    """Test that the idle window shrinks for sparse arrivals and follows the arrival rate for dense ones."""
+    batcher = AdaptiveBatcher(max_wait=0.5, min_wait=0.01)
+    assert batcher.idle_window() == 0.01
+
+    for i in range(10):
+        batcher.record_arrival(now=i * 0.05)
+    assert batcher.idle_window() == pytest.approx(0.1)
+
+    for i in range(10):
+        batcher.record_arrival(now=10 + i * 10)
+    assert batcher.idle_window() == 0.01
+
+def test_queue_get_empty(message_queue):
+    """Test that get raises queue.Empty on timeout or when not blocking."""
+    with pytest.raises(queue.Empty):
+        message_queue.get(block=False)
+    with pytest.raises(queue.Empty):
+        message_queue.get(timeout=0.01)
+
+def test_queue_priority(message_queue, message):
+    """Test that higher priority messages are served first regardless of the insertion order."""
+    handler = message.handler
+    msg1 = message_queue.put(id_=1, msg={}, handler=handler, priority=Priority.PREFETCH)
+    msg2 = message_queue.put(id_=2, msg={}, handler=handler, priority=Priority.BULK)
+    msg3 = message_queue.put(id_=3, msg={}, handler=handler, priority=Priority.INTERACTIVE)
+
+    assert message_queue.get() is msg3
+    assert message_queue.get() is msg2
+    assert message_queue.get() is msg1
+
+@pytest.mark.parametrize('message_queue', [((), {'aging_time': 0.01})], indirect=True)
+def test_queue_priority_aging(message_queue, message):
+    """Test that low priority messages are served before newer higher priority ones after waiting long enough."""
+    handler = message.handler
+    msg1 = message_queue.put(id_=1, msg={}, handler=handler, priority=Priority.PREFETCH)
+    time.sleep(0.05)
+    msg2 = message_queue.put(id_=2, msg={}, handler=handler, priority=Priority.INTERACTIVE)
+
+    assert message_queue.get() is msg1
+    assert message_queue.get() is msg2
+
+def test_queue_priority_context(message_queue, message):
+    """Test that messages without an explicit priority inherit the one of the current context."""
+    with priority_context(Priority.BULK):
+        msg = message_queue.put(id_=1, msg={}, handler=message.handler)
+    assert msg.priority == Priority.BULK
+    assert get_current_priority() == Priority.INTERACTIVE
+
+def test_queue_priority_promote(message_queue, message):
+    """Test that reusing a pending message with a higher priority promotes it."""
+    handler = message.handler
+    msg1 = message_queue.put(id_=1, msg={}, handler=handler, priority=Priority.BULK)
+    msg2 = message_queue.put(id_=2, msg={}, handler=handler, priority=Priority.PREFETCH)
+    assert message_queue.put(id_=2, msg={}, handler=handler, priority=Priority.INTERACTIVE) is msg2
+
+    assert message_queue.get() is msg2
+    assert message_queue.get() is msg1
+    # Stale entry of the promoted message is skipped
+    with pytest.raises(queue.Empty):
+        message_queue.get(block=False)
+
+def test_queue_priority_promote_running(message_queue):
+    """Test that an interactive request reusing a running prefetch pipeline promotes the stage messages it already
+    queued (ahead of the bulk work) and the ones it queues afterwards."""
+    stage_queue = MessageQueue()
+    started = threading.Event()
+    promoted = threading.Event()
+    queued = threading.Event()
+    stages = []
+    def pipeline():
+        stages.append(stage_queue.put(id_='stage1', msg={}, handler=lambda: 'stage1'))
+        started.set()
+        promoted.wait(timeout=1)
+        stages.append(stage_queue.put(id_='stage2', msg={}, handler=lambda: 'stage2'))
+        queued.set()
+        return [_.response(timeout=1) for _ in stages]
+    def resolve_pipeline():
+        msg = message_queue.get(timeout=1)
+        with message_context(msg):
+            msg.resolve()
+
+    prefetch = message_queue.put(id_='page', msg={}, handler=pipeline, priority=Priority.PREFETCH)
+    thread = threading.Thread(target=resolve_pipeline)
+    thread.start()
+    assert started.wait(timeout=1)
+    bulk = stage_queue.put(id_='bulk', msg={}, handler=lambda: 'bulk', priority=Priority.BULK)
+    assert stages[0].priority == Priority.PREFETCH
+
+    assert message_queue.put(id_='page', msg={}, handler=pipeline, priority=Priority.INTERACTIVE) is prefetch
+    assert stages[0].priority == Priority.INTERACTIVE
+    promoted.set()
+    assert queued.wait(timeout=1)
+    first = stage_queue.get(timeout=1)
+    second = stage_queue.get(timeout=1)
+    assert [first, second] == stages
+    assert second.priority == Priority.INTERACTIVE
+    first.resolve()
+    second.resolve()
+    thread.join(timeout=1)
+
+    assert prefetch.response(timeout=1) == ['stage1', 'stage2']
+    assert stage_queue.get(block=False) is bulk
+
+@pytest.mark.parametrize('message_queue', [((), {'max_depth': 2})], indirect=True)
+def test_queue_max_depth(message_queue, message):
+    """Test that new messages are rejected once the max depth is reached, while reused ones are not."""
+    handler = message.handler
+    message_queue.put(id_=1, msg={}, handler=handler)
+    message_queue.put(id_=2, msg={}, handler=handler)
+    with pytest.raises(QueueFullError):
+        message_queue.put(id_=3, msg={}, handler=handler)
+    assert message_queue.rejected == 1
+    message_queue.put(id_=1, msg={}, handler=handler)
+
+    message_queue.get()
+    assert message_queue.depth == 1
+    message_queue.put(id_=3, msg={}, handler=handler)
+
+@pytest.mark.parametrize('message_queue', [((), {'max_inflight': 1})], indirect=True)
+def test_queue_max_inflight(message_queue, message):
+    """Test that the in-flight slot is released only once the message is resolved."""
+    handler = message.handler
+    message_queue.put(id_=1, msg={'args': (1,)}, handler=handler)
+    msg = message_queue.get()
+    assert message_queue.depth == 0
+    with pytest.raises(QueueFullError):
+        message_queue.put(id_=2, msg={}, handler=handler)
+
+    msg.resolve()
+    assert message_queue.inflight == 0
+    message_queue.put(id_=2, msg={}, handler=handler)
+
+@pytest.mark.parametrize('message_queue', [((), {'max_depth': 2})], indirect=True)
+def test_queue_retry_after(message_queue, message):
+    """Test that the Retry-After estimate follows the depth and the measured service time."""
+    handler = message.handler
+    message_queue.num_consumers = 2
+    message_queue.record_service(4, count=2)
+    assert message_queue.service_time == 2
+    message_queue.record_service(12)
+    assert message_queue.service_time == pytest.approx(5)
+
+    message_queue.put(id_=1, msg={}, handler=handler)
+    message_queue.put(id_=2, msg={}, handler=handler)
+    with pytest.raises(QueueFullError) as exc:
+        message_queue.put(id_=3, msg={}, handler=handler)
+    assert exc.value.retry_after == pytest.approx(3 * 5 / 2)
+
+def test_queue_full_error_not_cached(message_queue):
+    """Test that messages resolved with a QueueFullError (from a downstream queue) are not reused."""
+    def handler():
+        raise QueueFullError('test', retry_after=1)
+    msg = message_queue.put(id_=1, msg={}, handler=handler)
+    message_queue.get().resolve()
+    assert isinstance(msg.response(), QueueFullError)
+    assert message_queue.put(id_=1, msg={}, handler=handler) is not msg
+
+@pytest.mark.parametrize('error', [
+    TimeoutError('test'), MessageCancelledError('test'), MessageExpiredError('test'),
+    ], ids=['timeout', 'cancelled', 'expired'])
+def test_transient_error_not_cached(message_queue, error):
+    """Test that messages resolved with a timeout/cancellation of a child stage are not reused."""
+    def handler():
+        raise error
+    msg = message_queue.put(id_=1, msg={}, handler=handler)
+    message_queue.get().resolve()
+    assert msg.response() is error
+    assert message_queue.put(id_=1, msg={}, handler=handler) is not msg
+
+def test_queue_reserve():
+    """Test that reserved slots count as in-flight messages for the admission control."""
+    mq = MessageQueue(max_inflight=1)
+    release = mq.reserve()
+    assert mq.inflight == 1
+    assert mq.depth == 0
+    with pytest.raises(QueueFullError):
+        mq.put(id_=1, msg={}, handler=lambda: None)
+    release()
+    release()
+    assert mq.inflight == 0
+    mq.put(id_=1, msg={}, handler=lambda: None)
+
+def test_queue_skip_expired(message_queue, message):
+    """Test that expired messages are cancelled and skipped instead of being served."""
+    handler = message.handler
+    msg1 = message_queue.put(id_=1, msg={}, handler=handler, deadline=time.monotonic() - 1)
+    msg2 = message_queue.put(id_=2, msg={}, handler=handler)
+
+    assert message_queue.get() is msg2
+    with pytest.raises(MessageExpiredError):
+        msg1.response()
+    assert message_queue.depth == 0
+
+def test_queue_skip_cancelled(message_queue, message):
+    """Test that cancelled messages are skipped and removed from the cache."""
+    handler = message.handler
+    msg1 = message_queue.put(id_=1, msg={}, handler=handler)
+    msg1.cancel()
+    with pytest.raises(queue.Empty):
+        message_queue.get(block=False)
+    assert message_queue.put(id_=1, msg={}, handler=handler) is not msg1
+
+def test_queue_deadline_context(message_queue, message):
+    """Test that messages inherit the deadline of the context and reuse extends it."""
+    with deadline_context(10):
+        msg = message_queue.put(id_=1, msg={}, handler=message.handler)
+    assert msg.deadline == 10
+    message_queue.put(id_=1, msg={}, handler=message.handler, deadline=20)
+    assert msg.deadline == 20
+    message_queue.put(id_=1, msg={}, handler=message.handler)
+    assert msg.deadline is None
+
+def test_queue_deadline_reuse_running(message_queue):
+    """Test that a request reusing a running message with a later deadline extends the deadline of the messages it
+    already queued, and that the running handler waits for them until the new deadline."""
+    started = threading.Event()
+    def handler():
+        child = message_queue.put(id_='child', msg={}, handler=lambda: 'child')
+        started.set()
+        return child.response()
+
+    def resolve_parent():
+        msg = message_queue.get(timeout=1)
+        with message_context(msg):
+            msg.resolve()
+
+    parent = message_queue.put(id_='parent', msg={}, handler=handler, deadline=time.monotonic() + 0.2)
+    thread = threading.Thread(target=resolve_parent)
+    thread.start()
+    assert started.wait(timeout=1)
+    message_queue.put(id_='parent', msg={}, handler=handler, deadline=time.monotonic() + 5)
+    child = message_queue.get(timeout=1)
+    assert child.deadline == parent.deadline
+
+    # Past the first deadline: the child is not expired and the parent is still waiting for it
+    time.sleep(0.3)
+    assert not child.expired
+    child.resolve()
+    thread.join(timeout=1)
+    assert parent.response(timeout=1) == 'child'
+
+def test_queue_cancel_cascade(message_queue):
+    """Test that cancelling a message being resolved cancels the messages it queued and stops it from queueing
+    more."""
+    started = threading.Event()
+    children = []
+    errors = []
+    def handler():
+        children.append(message_queue.put(id_='child', msg={}, handler=lambda: None))
+        started.set()
+        try:
+            children[0].response(timeout=1)
+            message_queue.put(id_='child2', msg={}, handler=lambda: None)
+        except MessageCancelledError as exc:
+            errors.append(exc)
+
+    parent = message_queue.put(id_='parent', msg={}, handler=handler)
+    worker = Worker(message_queue)
+    worker.start()
+    started.wait(timeout=1)
+    parent.cancel()
+    worker.stop()
+
+    assert children[0].cancelled
+    assert len(errors) == 1
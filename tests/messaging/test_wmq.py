@@ -19,18 +19,19 @@
 """Tests for messaging.py"""
 # pylint: disable=redefined-outer-name
 
-import queue
 import threading
+from collections import Counter
 
 import pytest
 
-from ocr_translate.messaging import Worker, WorkerMessageQueue
+from ocr_translate.messaging import (MessageQueue, Priority, QueueFullError,
+                                     Worker, WorkerMessageQueue)
 
 
 def test_wmq_instantiation(worker_message_queue):
     """Test that the worker message queue class can be instantiated"""
     assert isinstance(worker_message_queue, WorkerMessageQueue)
-    assert isinstance(worker_message_queue.msg_queue, queue.SimpleQueue)
+    assert isinstance(worker_message_queue.msg_queue, MessageQueue)
     for worker in worker_message_queue.workers:
         assert isinstance(worker, Worker)
 
@@ -112,3 +113,149 @@ def test_worker_batch_resolve(batched_worker_message_queue, batch_message, num_m
     for message in messages:
         assert message.response(timeout=1.0) == (args, kwargs)
     batched_worker_message_queue.stop_workers()
+
+@pytest.mark.parametrize('handler', [
+    lambda a: 1 / 0,
+    lambda a: a[:-1],
+    ], ids=['raise', 'wrong_len'])
+def test_worker_batch_resolve_error(handler):
+    """Test that a failing batched handler resolves the whole batch and does not kill the worker."""
+    wmq = WorkerMessageQueue(allow_batching=True, batch_args=(0,), batch_timeout=0.2)
+    messages = [wmq.put(id_=i, msg={'args': (i,)}, handler=handler, batch_id=0) for i in range(3)]
+    wmq.start_workers()
+    try:
+        for message in messages:
+            assert isinstance(message.response(timeout=1.0), Exception)
+        after = wmq.put(id_='after', msg={'args': (1,)}, handler=lambda a: a, batch_id=0)
+        assert after.response(timeout=1.0) == 1
+        assert all(_.running for _ in wmq.workers)
+        assert not any(_.busy for _ in wmq.workers)
+    finally:
+        wmq.stop_workers()
+
+def test_wmq_reserve_max_workers():
+    """Test that at most `max_workers` slots can be reserved for external runs."""
+    wmq = WorkerMessageQueue(num_workers=1, max_workers=2)
+    releases = [wmq.reserve(), wmq.reserve()]
+    with pytest.raises(QueueFullError):
+        wmq.reserve()
+    releases[0]()
+    releases[0]()
+    releases.append(wmq.reserve())
+    assert wmq.msg_queue.inflight == 2
+
+def test_worker_priority_inherit(worker_message_queue):
+    """Test that messages put while resolving a message inherit its priority."""
+    worker_message_queue.start_workers()
+    inner = []
+    def handler():
+        inner.append(worker_message_queue.put(id_='inner', msg={}, handler=lambda: None))
+
+    msg = worker_message_queue.put(id_='outer', msg={}, handler=handler, priority=Priority.PREFETCH)
+    msg.response(timeout=1.0)
+    inner[0].response(timeout=1.0)
+    worker_message_queue.stop_workers()
+
+    assert inner[0].priority == Priority.PREFETCH
+
+def test_wmq_autoscale_up(message):
+    """Test that the pool grows to cover the backlog, up to max_workers."""
+    wmq = WorkerMessageQueue(num_workers=1, max_workers=3)
+    for i in range(5):
+        wmq.put(id_=i, msg={}, handler=message.handler)
+    assert wmq.autoscale() == 3
+    assert wmq.msg_queue.num_consumers == 3
+
+def test_wmq_autoscale_down():
+    """Test that idle workers are removed one at a time after the delay, down to min_workers."""
+    wmq = WorkerMessageQueue(num_workers=3, min_workers=1, max_workers=3, scale_down_delay=10)
+    assert wmq.autoscale(now=0) == 3
+    assert wmq.autoscale(now=5) == 3
+    assert wmq.autoscale(now=10) == 2
+    assert wmq.autoscale(now=15) == 2
+    assert wmq.autoscale(now=20) == 1
+    assert wmq.autoscale(now=100) == 1
+
+def test_wmq_autoscale_running(message):
+    """Test that workers added while running are started and removed ones are stopped."""
+    wmq = WorkerMessageQueue(num_workers=1, max_workers=2, scale_interval=100)
+    wmq.start_workers()
+    assert wmq.scale_to(2) == 2
+    assert all(worker.thread.is_alive() for worker in wmq.workers)
+    removed = wmq.workers[-1]
+    wmq.set_bounds(max_workers=1)
+    assert len(wmq.workers) == 1
+    removed.thread.join(timeout=1)
+    assert not removed.thread.is_alive()
+
+    msg = wmq.put(id_=1, msg={}, handler=message.handler)
+    assert msg.response(timeout=1.0) == ((), {})
+    wmq.stop_workers()
+
+def test_wmq_set_bounds_invalid(worker_message_queue):
+    """Test that invalid bounds are rejected."""
+    with pytest.raises(ValueError):
+        worker_message_queue.set_bounds(min_workers=0)
+    with pytest.raises(ValueError):
+        worker_message_queue.set_bounds(min_workers=2, max_workers=1)
+
+def test_wmq_stats(worker_message_queue, message):
+    """Test the stats of the queue."""
+    worker_message_queue.put(id_=1, msg={}, handler=message.handler)
+    stats = worker_message_queue.stats()
+    assert stats['workers'] == 1
+    assert stats['busy_workers'] == 0
+    assert stats['depth'] == 1
+    assert stats['inflight'] == 1
+
+@pytest.mark.parametrize('num_workers', [1, 4], ids=['num_workers=1', 'num_workers=4'])
+def test_wmq_batch_stress(num_workers):
+    """Stress batching with several producers and workers: every message must be resolved exactly once, with its
+    own result, in a batch of messages sharing its batch id and not exceeding the max batch size."""
+    num_producers = 8
+    num_msg = 200
+    num_pools = 3
+    batch_size = 7
+    lock = threading.Lock()
+    seen = Counter()
+    batches = []
+
+    def handler(values, pool):
+        single = not isinstance(values, list)
+        values = [values] if single else values
+        with lock:
+            seen.update(values)
+            batches.append((pool, values))
+        res = [f'{pool}-{value}' for value in values]
+        return res[0] if single else res
+
+    wmq = WorkerMessageQueue(
+        num_workers=num_workers, reuse_msg=False,
+        allow_batching=True, batch_args=(0,), batch_size=batch_size, batch_timeout=0.05,
+        )
+    wmq.start_workers()
+    messages = {}
+    def producer(idx):
+        for i in range(idx, num_msg, num_producers):
+            pool = i % num_pools
+            msg = wmq.put(id_=i, msg={'args': (i, pool), 'kwargs': {}}, handler=handler, batch_id=pool)
+            with lock:
+                messages[i] = msg
+
+    threads = [threading.Thread(target=producer, args=(_,)) for _ in range(num_producers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for i, msg in messages.items():
+        assert msg.response(timeout=10) == f'{i % num_pools}-{i}'
+    wmq.stop_workers()
+
+    assert len(messages) == num_msg
+    assert seen == Counter(range(num_msg))
+    for pool, values in batches:
+        assert len(values) <= batch_size
+        assert all(value % num_pools == pool for value in values)
+    assert wmq.msg_queue.depth == 0
+    assert not wmq.msg_queue.batch_pools
@@ -19,16 +19,15 @@
 """Tests for messaging.py"""
 # pylint: disable=redefined-outer-name
 
-import queue
 import threading
 
-from ocr_translate.messaging import Worker
+from ocr_translate.messaging import MessageQueue, Worker
 
 
 def test_worker_instantiation(worker):
     """Test that the worker class can be instantiated"""
     assert isinstance(worker, Worker)
-    assert isinstance(worker.queue, queue.SimpleQueue)
+    assert isinstance(worker.queue, MessageQueue)
 
 def test_worker_start(worker):
     """Test that the worker class can be started"""
@@ -19,10 +19,15 @@
 """Tests for full module."""
 # pylint: disable=too-many-positional-arguments,too-many-arguments
 
+import threading
 
+import numpy as np
 import pytest
+from PIL import Image
 
 from ocr_translate import models as m
+from ocr_translate import phash
+from ocr_translate.messaging import Message
 from ocr_translate.ocr_tsl import full
 
 pytestmark = pytest.mark.django_db
@@ -144,3 +149,205 @@ def test_lazy_option_favor_manual_specified_false(
             )
 
     assert mock_called.kwargs['favor_manual'] is False
+
+@pytest.fixture()
+def stage_mocks(monkeypatch, image):
+    """Mock OCR/TSL runs: the OCR of box `i` waits for message `msgs[i]`, every step is logged in `events`."""
+    class StageMocks():
+        """Container of the mocked stages."""
+        events = []
+        msgs = [Message(id_=i, msg={}, handler=None) for i in range(2)]
+
+        @classmethod
+        def ocr(cls, bbox_obj, *args, block=True, **kwargs):
+            """Mock OCR run."""
+            msg = cls.msgs[bbox_obj.l]
+            yield msg
+            cls.events.append(f'ocr_{bbox_obj.l}')
+            res, _ = m.Text.objects.get_or_create(text=msg.response())
+            yield res
+
+        @classmethod
+        def translate(cls, obj, *args, block=True, **kwargs):
+            """Mock TSL run."""
+            cls.events.append(f'tsl_{obj.text}')
+            yield None
+            res, _ = m.Text.objects.get_or_create(text=obj.text + '_translated')
+            yield res
+
+    monkeypatch.setattr(m.OCRModel.LOADED_MODEL, 'ocr', StageMocks.ocr)
+    monkeypatch.setattr(m.TSLModel.LOADED_MODEL, 'translate', StageMocks.translate)
+    return StageMocks
+
+def test_work_pipelined(
+        lang_src_loaded, box_model_loaded, ocr_model_loaded, tsl_model_loaded, stage_mocks,
+        image, box_run, option_dict
+        ):
+    """Test that the translation of a box is enqueued as soon as its OCR is done."""
+    bboxes = [m.BBox.objects.create(image=image, l=i, b=0, r=i, t=0, from_ocr_merged=box_run) for i in range(2)]
+    box_model_loaded.box_detection = lambda *args, **kwargs: (bboxes, bboxes)
+
+    stage_mocks.msgs[0].set_response('text_0')
+    threading.Timer(0.2, stage_mocks.msgs[1].set_response, args=('text_1',)).start()
+    res = full.ocr_tsl_pipeline_work(
+        image, image.md5,
+        options_box=option_dict, options_ocr=option_dict, options_tsl=option_dict
+        )
+
+    assert stage_mocks.events == ['ocr_0', 'tsl_text_0', 'ocr_1', 'tsl_text_1']
+    assert [_['tsl'] for _ in res] == ['text_0_translated', 'text_1_translated']
+
+def test_work_pipelined_single(
+        lang_src_loaded, box_model_loaded, ocr_model_single_loaded, tsl_model_loaded, stage_mocks,
+        image, box_run, option_dict
+        ):
+    """Test that in SINGLE mode the translation of a merged box is enqueued as soon as all its single boxes are
+    done."""
+    merged = [m.BBox.objects.create(image=image, l=i, b=0, r=i+1, t=1, from_ocr_merged=box_run) for i in range(2)]
+    single = [
+        m.BBox.objects.create(image=image, l=i, b=0, r=i+1, t=1, from_ocr_single=box_run, to_merged=merged[i])
+        for i in range(2)
+        ]
+    box_model_loaded.box_detection = lambda *args, **kwargs: (single, merged)
+
+    stage_mocks.msgs[0].set_response('text_0')
+    threading.Timer(0.2, stage_mocks.msgs[1].set_response, args=('text_1',)).start()
+    res = full.ocr_tsl_pipeline_work(
+        image, image.md5,
+        options_box=option_dict, options_ocr=option_dict, options_tsl=option_dict
+        )
+
+    assert stage_mocks.events == ['ocr_0', 'tsl_text_0', 'ocr_1', 'tsl_text_1']
+    assert [_['ocr'] for _ in res] == ['text_0', 'text_1']
+    assert m.OCRRun.objects.filter(bbox=merged[1], result_merged__text='text_1').exists()
+
+def test_group_single_boxes(image, box_run):
+    """Test grouping the single boxes by merged box (one group with every box if some single is not linked)."""
+    merged = [m.BBox.objects.create(image=image, l=i, b=0, r=i, t=0, from_ocr_merged=box_run) for i in range(2)]
+    single = [
+        m.BBox.objects.create(image=image, l=0, b=0, r=0, t=0, from_ocr_single=box_run, to_merged=merged[i % 2])
+        for i in range(3)
+        ]
+    assert full._group_single_boxes(single, merged) == [([0, 2], [0]), ([1], [1])] # pylint: disable=protected-access
+
+    single.append(m.BBox.objects.create(image=image, l=0, b=0, r=0, t=0, from_ocr_single=box_run))
+    assert full._group_single_boxes(single, merged) == [([0, 1, 2, 3], [0, 1])] # pylint: disable=protected-access
+
+@pytest.fixture()
+def cached_page(request, image, box_run, language, ocr_model, tsl_model, option_dict):
+    """Image with `request.param` boxes whose OCR and translation results are all in the database."""
+    for i in range(request.param):
+        merged = m.BBox.objects.create(image=image, l=i, b=0, r=i+1, t=1, from_ocr_merged=box_run)
+        m.BBox.objects.create(image=image, l=i, b=0, r=i+1, t=1, from_ocr_single=box_run, to_merged=merged)
+        text = m.Text.objects.create(text=f'text_{i}')
+        m.OCRRun.objects.create(
+            bbox=merged, model=ocr_model, lang_src=language, options=option_dict, result_merged=text
+            )
+        m.TranslationRun.objects.create(
+            text=text, model=tsl_model, lang_src=language, lang_dst=language, options=option_dict,
+            result=m.Text.objects.create(text=f'tsl_{i}')
+            )
+    return request.param
+
+@pytest.mark.parametrize('cached_page', [1, 20], indirect=True)
+def test_lazy_bulk_num_queries(
+        monkeypatch, django_assert_max_num_queries, cached_page,
+        mock_loaded, image, option_dict
+        ):
+    """Test that a cache hit of the lazy pipeline takes a fixed number of queries, independent of the number of
+    boxes, and gives the same result as the per-box lookup."""
+    with django_assert_max_num_queries(8):
+        res = full.ocr_tsl_pipeline_lazy(
+            image.md5,
+            options_box=option_dict, options_ocr=option_dict, options_tsl=option_dict
+            )
+
+    assert [_['tsl'] for _ in res] == [f'tsl_{i}' for i in range(cached_page)]
+
+    monkeypatch.setattr(full, '_lazy_bulk_lookup', lambda *args, **kwargs: None)
+    assert res == full.ocr_tsl_pipeline_lazy(
+        image.md5,
+        options_box=option_dict, options_ocr=option_dict, options_tsl=option_dict
+        )
+
+@pytest.mark.parametrize('cached_page', [2], indirect=True)
+def test_lazy_bulk_favor_manual(cached_page, mock_loaded, language, option_dict, image):
+    """Test that the bulk lookup favors manual translations."""
+    manual, _ = m.TSLModel.objects.get_or_create(name='manual')
+    m.TranslationRun.objects.create(
+        text=m.Text.objects.get(text='text_1'), model=manual, lang_src=language, lang_dst=language,
+        options=option_dict, result=m.Text.objects.create(text='manual_1')
+        )
+
+    res = full.ocr_tsl_pipeline_lazy(
+        image.md5,
+        options_box=option_dict, options_ocr=option_dict, options_tsl=option_dict
+        )
+
+    assert [_['tsl'] for _ in res] == ['tsl_0', 'manual_1']
+
+@pytest.mark.parametrize('cached_page', [2], indirect=True)
+def test_lazy_bulk_missing_tsl(cached_page, mock_loaded, option_dict, image):
+    """Test that a missing result still makes the lazy pipeline fail."""
+    m.TranslationRun.objects.filter(result__text='tsl_1').delete()
+
+    with pytest.raises(ValueError):
+        full.ocr_tsl_pipeline_lazy(
+            image.md5,
+            options_box=option_dict, options_ocr=option_dict, options_tsl=option_dict
+            )
+
+def test_register_image(image_pillow):
+    """Test that registering an image stores its perceptual hash and size only once."""
+    img_obj = full.register_image('new_md5', image_pillow)
+
+    assert img_obj.phash == phash.to_hex(phash.dhash(image_pillow))
+    assert (img_obj.width, img_obj.height) == image_pillow.size
+    assert full.phash_index.search(img_obj.phash, 0) == [(0, img_obj.id)]
+
+    full.register_image('new_md5', image_pillow)
+    assert m.Image.objects.count() == 1
+    assert len(full.phash_index.search(img_obj.phash, 0)) == 1
+
+@pytest.fixture()
+def similar_page(monkeypatch):
+    """Registered image with lazily available results (mocked) and its size."""
+    img = Image.fromarray(np.kron(np.arange(96).reshape(12, 8) * 2, np.ones((20, 20))).astype(np.uint8))
+    full.register_image('similar_md5', img)
+    def mock_lazy(md5, **kwargs):
+        if md5 != 'similar_md5':
+            raise ValueError('test')
+        return [{'ocr': 'ocr', 'tsl': 'tsl', 'box': (10, 20, 30, 40)}]
+    monkeypatch.setattr(full, 'ocr_tsl_pipeline_lazy', mock_lazy)
+    return img
+
+def test_similar_rescaled(similar_page, option_dict):
+    """Test reusing the results of a near-duplicate image, with the boxes rescaled."""
+    img = similar_page.resize((80, 120))
+    res = full.ocr_tsl_pipeline_similar(
+        img, 'other_md5', options_box=option_dict, options_ocr=option_dict, options_tsl=option_dict
+        )
+
+    assert res == [{'ocr': 'ocr', 'tsl': 'tsl', 'box': (5, 10, 15, 20)}]
+
+def test_similar_different_aspect(similar_page, option_dict):
+    """Test that an image with the same hash but a different aspect ratio is not a near-duplicate."""
+    img = similar_page.resize((80, 200))
+    with pytest.raises(ValueError):
+        full.ocr_tsl_pipeline_similar(
+            img, 'other_md5', options_box=option_dict, options_ocr=option_dict, options_tsl=option_dict
+            )
+
+def test_similar_different(similar_page, option_dict):
+    """Test that a different image is not a near-duplicate."""
+    img = similar_page.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+    with pytest.raises(ValueError):
+        full.ocr_tsl_pipeline_similar(
+            img, 'other_md5', options_box=option_dict, options_ocr=option_dict, options_tsl=option_dict
+            )
+
+def test_shared_rgb(image_pillow):
+    """Test that the page is converted to RGB only if needed (an RGB page is shared as is)."""
+    assert full._shared_rgb(image_pillow) is image_pillow  # pylint: disable=protected-access
+    res = full._shared_rgb(image_pillow.convert('P'))  # pylint: disable=protected-access
+    assert res.mode == 'RGB'
@@ -19,6 +19,7 @@
 """Tests for base plugin facility."""
 
 import pytest
+from PIL import Image
 
 from ocr_translate import models as m
 from ocr_translate.ocr_tsl import signals
@@ -95,6 +96,17 @@ def test_ocr_non_pil_image(ocr_model: m.OCRModel):
     with pytest.raises(TypeError, match=r'^img should be PIL Image, but got <class \'str\'>$'):
         ocr_model.prepare_image('test_image')
 
+@pytest.mark.parametrize('mode', ['RGB', 'RGBA', 'P', 'L'])
+def test_ocr_prepare_image(ocr_model: m.OCRModel, image_pillow: Image.Image, mode: str):
+    """Test that cropping before converting gives the same crop as converting the whole page first."""
+    img = image_pillow.convert(mode)
+    bbox = (2, 3, 10, 12)
+
+    res = ocr_model.prepare_image(img, bbox)
+
+    assert res.mode == 'RGB'
+    assert res.tobytes() == img.convert('RGB').crop(bbox).tobytes()
+
 def test_box_main_method_notimplemented(box_model: m.OCRBoxModel):
     """Test that ocr method raises TypeError if image is not PIL.Image."""
     with pytest.raises(NotImplementedError):
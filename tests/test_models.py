@@ -19,15 +19,20 @@
 """Tests for the database models."""
 #pylint: disable=protected-access,too-many-positional-arguments,too-many-arguments
 
+import importlib
+import threading
+import time
 from dataclasses import dataclass
 
 import django
 import numpy as np
 import pytest
+from PIL import Image
 from PIL.Image import Image as PILImage
 
 from ocr_translate import models as m
-from ocr_translate.messaging import Message
+from ocr_translate import queues
+from ocr_translate.messaging import Message, deadline_context
 from ocr_translate.ocr_tsl import full
 from ocr_translate.trie import Trie
 
@@ -116,6 +121,41 @@ def test_goc_multiple_object_returned_strict(box_model_dict: dict):
     with pytest.raises(m.OCRBoxModel.MultipleObjectsReturned):
         m.base.safe_get_or_create(m.OCRBoxModel, **box_model_dict, strict=True)
 
+def test_text_digest():
+    """Test that the digest of a text is set on creation and kept in sync on save."""
+    text_obj = m.Text.objects.create(text='test')
+    assert text_obj.digest == m.Text.get_digest('test')
+    text_obj.text = 'changed'
+    text_obj.save(update_fields=['text'])
+    text_obj.refresh_from_db()
+    assert text_obj.digest == m.Text.get_digest('changed')
+
+def test_text_lookup_uses_digest(django_assert_num_queries):
+    """Test that the lookups by text filter on the indexed digest."""
+    text_obj = m.Text.objects.create(text='test')
+    assert 'digest' in str(m.Text.objects.filter(text='test').query)
+    with django_assert_num_queries(1):
+        assert m.Text.objects.get_or_create(text='test') == (text_obj, False)
+    assert m.base.safe_get_or_create(m.Text, text='test') == text_obj
+
+def test_text_lookup_digest_collision():
+    """Test that texts with the same digest are told apart by the text."""
+    text1 = m.Text.objects.create(text='test1')
+    text2 = m.Text.objects.create(text='test2')
+    m.Text.objects.filter(id=text2.id).update(digest=text1.digest)
+    assert m.Text.objects.get(text='test1') == text1
+    assert m.Text.objects.filter(text='test2', digest=text1.digest).get() == text2
+
+def test_text_digest_backfill():
+    """Test the data migration setting the digest of the existing texts."""
+    migration = importlib.import_module('ocr_translate.migrations.0023_text_digest')
+    texts = [m.Text.objects.create(text=f'test{i}') for i in range(3)]
+    m.Text.objects.update(digest='')
+    migration.backfill_digest(django.apps.apps, None)
+    for text_obj in texts:
+        text_obj.refresh_from_db()
+        assert text_obj.digest == m.Text.get_digest(text_obj.text)
+
 def test_lang_load_src(language: m.Language):
     """Test that loading a Language creates a respective src LoadEvent."""
     assert m.LoadEvent.objects.count() == 0
@@ -276,6 +316,206 @@ def test_box_run_04migration_replace(
     assert len(single) == 1
     assert len(merged) == 1
 
+def test_box_run_batchable(
+        monkeypatch, queues_no_reuse, image: m.Image, language: m.Language, box_model: m.OCRBoxModel,
+        option_dict: m.OptionDict
+        ):
+    """Test that the images of a BATCHABLE model are queued with a (model, lang, options) batch id and that the
+    results of a batched call are mapped back to the right OCRBoxRun."""
+    calls = []
+    def mock_pipeline(img, *args, **kwargs):
+        calls.append(img)
+        if isinstance(img, list):
+            return [[{'single': [(i,i,i,i)], 'merged': (i,i,i,i)}] for i in img]
+        return [{'single': [(img,img,img,img)], 'merged': (img,img,img,img)}]
+
+    monkeypatch.setattr(m.OCRBoxModel, 'LOADED_MODEL', box_model)
+    monkeypatch.setattr(box_model, '_box_detection', mock_pipeline)
+    monkeypatch.setattr(box_model, 'BATCHABLE', True)
+
+    batch_id = (box_model.id, language.id, option_dict.id)
+    # Message from another image already waiting in the queue with the same batch id
+    other = m.Image.objects.create(md5='other_md5')
+    msg = queues.box_queue.put(
+        id_=(other.id, box_model.id, language.id, option_dict.id),
+        batch_id=batch_id,
+        handler=box_model._box_detection,
+        msg={'args': (2,), 'kwargs': {'options': {}}},
+        )
+    _, merged = box_model.box_detection(image, language, image=1, options=option_dict)
+
+    assert msg.batch_id == batch_id
+    assert msg.response() == [{'single': [(2,2,2,2)], 'merged': (2,2,2,2)}]
+    assert merged[0].lbrt == (1,1,1,1)
+    assert m.OCRBoxRun.objects.get(image=image).result_merged.get().lbrt == (1,1,1,1)
+    assert sum(len(_) if isinstance(_, list) else 1 for _ in calls) == 2
+
+def test_box_run_not_batchable(
+        monkeypatch, queues_no_reuse, image: m.Image, language: m.Language, box_model: m.OCRBoxModel,
+        option_dict: m.OptionDict
+        ):
+    """Test that models not opting in are never batched."""
+    lbrt = (1,2,3,4)
+    batch_ids = []
+    put = queues.box_queue.put
+    def mock_put(*args, **kwargs):
+        batch_ids.append(kwargs.get('batch_id'))
+        return put(*args, **kwargs)
+
+    monkeypatch.setattr(m.OCRBoxModel, 'LOADED_MODEL', box_model)
+    monkeypatch.setattr(box_model, '_box_detection', lambda *args, **kwargs: [{'single': [lbrt], 'merged': lbrt}])
+    monkeypatch.setattr(queues.box_queue, 'put', mock_put)
+
+    _, merged = box_model.box_detection(image, language, image=1, options=option_dict)
+
+    assert batch_ids == [None]
+    assert merged[0].lbrt == lbrt
+
+@pytest.mark.parametrize(
+    'size, tile_size, overlap, expected',
+    [
+        ((50, 80), 100, 10, [(0, 0, 50, 80)]),
+        ((50, 100), 100, 10, [(0, 0, 50, 100)]),
+        ((50, 250), 100, 20, [(0, 0, 50, 100), (0, 80, 50, 180), (0, 150, 50, 250)]),
+        ((150, 150), 100, 0, [(0, 0, 100, 100), (50, 0, 150, 100), (0, 50, 100, 150), (50, 50, 150, 150)]),
+    ],
+    ids=['smaller', 'equal', 'tall', 'grid']
+)
+def test_tile_rects(size, tile_size, overlap, expected):
+    """Test splitting an image in overlapping tiles covering all of it."""
+    assert m.box.tile_rects(*size, tile_size, overlap) == expected
+
+@pytest.mark.parametrize('overlap', [-1, 100, 200])
+def test_tile_rects_invalid_overlap(overlap):
+    """Test that the overlap must be smaller than the tile size."""
+    with pytest.raises(ValueError):
+        m.box.tile_rects(50, 250, 100, overlap)
+
+@pytest.mark.parametrize(
+    'options, expected',
+    [
+        ({}, (0, 64)),
+        ({'tile_size': 100, 'tile_overlap': 20}, (100, 20)),
+        ({'tile_size': '100'}, (100, 64)),
+        ({'tile_overlap': 500}, (0, 500)),
+    ],
+    ids=['default', 'set', 'str', 'disabled']
+)
+def test_tile_options(box_model, options, expected):
+    """Test getting the tiling options of a request."""
+    assert box_model.tile_options(options) == expected
+
+@pytest.mark.parametrize(
+    'options',
+    [
+        {'tile_size': 64},
+        {'tile_size': 32},
+        {'tile_size': 100, 'tile_overlap': 100},
+        {'tile_size': 100, 'tile_overlap': 150},
+        {'tile_size': 100, 'tile_overlap': -1},
+        {'tile_size': -100},
+        {'tile_size': 'abc'},
+    ],
+    ids=['equal_default', 'larger_default', 'equal', 'larger', 'negative_overlap', 'negative_size', 'not_int']
+)
+def test_tile_options_invalid(box_model, options):
+    """Test that the overlap must be smaller than the tile size (the default overlap is 64)."""
+    with pytest.raises(ValueError):
+        box_model.tile_options(options)
+
+def test_merge_tile_results():
+    """Test merging the results of the tiles: shifted to image coordinates, with duplicates in the overlap and boxes
+    cut by the seam merged together, and boxes of the same tile kept separate."""
+    rects = [(0, 0, 50, 100), (0, 80, 50, 180)]
+    results = [
+        [
+            # Two separate boxes touching in the same tile
+            {'merged': (0, 0, 10, 10), 'single': [(0, 0, 10, 10)]},
+            {'merged': (0, 10, 10, 20), 'single': [(0, 10, 10, 20)]},
+            # Cut by the bottom of the tile
+            {'merged': (5, 90, 40, 100), 'single': [(5, 90, 20, 100), (25, 90, 40, 100)]},
+        ],
+        [
+            # Whole box (seen from its top at y=90 in the image)
+            {'merged': (5, 10, 40, 30), 'single': [(5, 10, 20, 30), (25, 10, 40, 30)]},
+            {'merged': (0, 50, 10, 60), 'single': [(0, 50, 10, 60)]},
+        ],
+    ]
+
+    res = m.box.merge_tile_results(results, rects)
+
+    assert res == [
+        {'merged': (0, 0, 10, 10), 'single': [(0, 0, 10, 10)]},
+        {'merged': (0, 10, 10, 20), 'single': [(0, 10, 10, 20)]},
+        {'merged': (5, 90, 40, 110), 'single': [(5, 90, 20, 110), (25, 90, 40, 110)]},
+        {'merged': (0, 130, 10, 140), 'single': [(0, 130, 10, 140)]},
+    ]
+
+@pytest.mark.parametrize('batchable', [False, True], ids=['not_batchable', 'batchable'])
+def test_box_run_tiled(
+        monkeypatch, queues_no_reuse, image: m.Image, language: m.Language, box_model: m.OCRBoxModel,
+        batchable: bool
+        ):
+    """Test box detection on a tall image split in tiles, with a box duplicated in the overlap of two tiles."""
+    calls = []
+    def detect(img):
+        return [{'merged': (0, 0, 10, img.size[1]), 'single': [(0, 0, 10, img.size[1])]}]
+    def mock_pipeline(img, *args, **kwargs):
+        calls.append(img)
+        if isinstance(img, list):
+            return [detect(_) for _ in img]
+        return detect(img)
+
+    monkeypatch.setattr(m.OCRBoxModel, 'LOADED_MODEL', box_model)
+    monkeypatch.setattr(box_model, '_box_detection', mock_pipeline)
+    monkeypatch.setattr(box_model, 'BATCHABLE', batchable)
+    options, _ = m.OptionDict.objects.get_or_create(options={'tile_size': 100, 'tile_overlap': 20})
+
+    pil_image = Image.new('RGB', (50, 250))
+    single, merged = box_model.box_detection(image, language, image=pil_image, options=options)
+
+    assert sum(len(_) if isinstance(_, list) else 1 for _ in calls) == 3
+    assert all(max(_.size) <= 100 for _ in calls if not isinstance(_, list))
+    assert [_.lbrt for _ in merged] == [(0, 0, 10, 250)]
+    assert [_.lbrt for _ in single] == [(0, 0, 10, 250)]
+
+def test_box_run_tiled_model_default(
+        monkeypatch, queues_no_reuse, image: m.Image, language: m.Language, box_model: m.OCRBoxModel,
+        option_dict: m.OptionDict
+        ):
+    """Test that the tile size can be set in the default options of the model."""
+    calls = []
+    def mock_pipeline(img, *args, **kwargs):
+        calls.append(img)
+        return []
+
+    monkeypatch.setattr(m.OCRBoxModel, 'LOADED_MODEL', box_model)
+    monkeypatch.setattr(box_model, '_box_detection', mock_pipeline)
+    box_model.default_options, _ = m.OptionDict.objects.get_or_create(options={'tile_size': 100, 'tile_overlap': 20})
+
+    box_model.box_detection(image, language, image=Image.new('RGB', (50, 250)), options=option_dict)
+
+    assert len(calls) == 3
+
+def test_box_run_tiled_error(
+        monkeypatch, queues_no_reuse, image: m.Image, language: m.Language, box_model: m.OCRBoxModel
+        ):
+    """Test that an error in one of the tiles is raised and nothing is saved."""
+    calls = []
+    def mock_pipeline(img, *args, **kwargs):
+        calls.append(img)
+        if len(calls) == 2:
+            raise ValueError('test_error')
+        return []
+
+    monkeypatch.setattr(m.OCRBoxModel, 'LOADED_MODEL', box_model)
+    monkeypatch.setattr(box_model, '_box_detection', mock_pipeline)
+    options, _ = m.OptionDict.objects.get_or_create(options={'tile_size': 100, 'tile_overlap': 0})
+
+    with pytest.raises(ValueError, match='test_error'):
+        box_model.box_detection(image, language, image=Image.new('RGB', (50, 250)), options=options)
+    assert m.OCRBoxRun.objects.count() == 0
+
 def test_ocr_load(monkeypatch, ocr_model: m.OCRModel):
     """Test that loading a TSLModel creates a respective LoadEvent."""
     monkeypatch.setattr(ocr_model, 'load', lambda: None)
@@ -375,6 +615,99 @@ def test_ocr_run_nonblock(
     assert next(gen_lazy) is None
     assert next(gen_lazy) == res
 
+def test_ocr_run_batchable(
+        monkeypatch, queues_no_reuse, image_pillow: PILImage, image: m.Image, box_run: m.OCRBoxRun,
+        language: m.Language, ocr_model: m.OCRModel, option_dict: m.OptionDict
+        ):
+    """Test that the crops of a BATCHABLE model are queued with a (model, lang, options) batch id and that the
+    results of a batched call are mapped back to the right bbox."""
+    calls = []
+    def mock_ocr(img, *args, **kwargs):
+        calls.append(img)
+        if isinstance(img, list):
+            return [f'text_{_.size[0]}' for _ in img]
+        return f'text_{img.size[0]}'
+
+    monkeypatch.setattr(m.OCRModel, 'LOADED_MODEL', ocr_model)
+    monkeypatch.setattr(ocr_model, '_ocr', mock_ocr)
+    monkeypatch.setattr(ocr_model, 'BATCHABLE', True)
+
+    bboxes = [
+        m.BBox.objects.create(image=image, l=0, b=0, r=i, t=5, from_ocr_merged=box_run) for i in range(1, 6)
+        ]
+    gens = [ocr_model.ocr(_, language, image=image_pillow, options=option_dict, block=False) for _ in bboxes]
+    msgs = [next(_) for _ in gens]
+    res = [next(_) for _ in gens]
+
+    assert all(msg.batch_id == (ocr_model.id, language.id, option_dict.id) for msg in msgs)
+    assert [_.text for _ in res] == [f'text_{i}' for i in range(1, 6)]
+    assert sum(len(_) if isinstance(_, list) else 1 for _ in calls) == 5
+
+def test_ocr_run_not_batchable(
+        monkeypatch, queues_no_reuse, image_pillow: PILImage,
+        bbox: m.BBox, language: m.Language, ocr_model: m.OCRModel, option_dict: m.OptionDict
+        ):
+    """Test that models not opting in are never batched."""
+    monkeypatch.setattr(m.OCRModel, 'LOADED_MODEL', ocr_model)
+    monkeypatch.setattr(ocr_model, '_ocr', lambda *args, **kwargs: 'test_text')
+
+    gen = ocr_model.ocr(bbox, language, image=image_pillow, options=option_dict, block=False)
+    msg = next(gen)
+
+    assert msg.batch_id is None
+    assert next(gen).text == 'test_text'
+
+def test_ocr_run_same_crop(
+        monkeypatch, queues_no_reuse, image_pillow: PILImage, image: m.Image, box_run: m.OCRBoxRun,
+        bbox: m.BBox, language: m.Language, ocr_model: m.OCRModel, option_dict: m.OptionDict
+        ):
+    """Test that an identical crop in another box/image reuses the OCR result without queueing the OCR."""
+    calls = []
+    def mock_ocr(*args, **kwargs):
+        calls.append(1)
+        return 'test_text'
+    monkeypatch.setattr(m.OCRModel, 'LOADED_MODEL', ocr_model)
+    monkeypatch.setattr(ocr_model, '_ocr', mock_ocr)
+
+    res1 = next(ocr_model.ocr(bbox, language, image=image_pillow, options=option_dict))
+    # Same content at a different position of another image
+    other = Image.new('RGB', (30, 30))
+    other.paste(image_pillow.crop(bbox.lbrt), (10, 10))
+    bbox2 = m.BBox.objects.create(image=image, l=10, b=10, r=12, t=12, from_ocr_merged=box_run)
+    gen = ocr_model.ocr(bbox2, language, image=other, options=option_dict, block=False)
+
+    assert next(gen) is None
+    res2 = next(gen)
+    assert res2 == res1
+    assert len(calls) == 1
+    assert m.OCRRun.objects.get(bbox=bbox2).crop_hash == m.OCRRun.objects.get(bbox=bbox).crop_hash
+
+def test_ocr_run_same_crop_other_options(
+        monkeypatch, queues_no_reuse, image_pillow: PILImage, box_run: m.OCRBoxRun,
+        bbox: m.BBox, language: m.Language, ocr_model: m.OCRModel, option_dict: m.OptionDict
+        ):
+    """Test that identical crops are not reused across different options or when forcing."""
+    calls = []
+    def mock_ocr(*args, **kwargs):
+        calls.append(1)
+        return 'test_text'
+    monkeypatch.setattr(m.OCRModel, 'LOADED_MODEL', ocr_model)
+    monkeypatch.setattr(ocr_model, '_ocr', mock_ocr)
+    options2, _ = m.OptionDict.objects.get_or_create(options={'test': 1})
+
+    next(ocr_model.ocr(bbox, language, image=image_pillow, options=option_dict))
+    next(ocr_model.ocr(bbox, language, image=image_pillow, options=options2))
+    next(ocr_model.ocr(bbox, language, image=image_pillow, options=option_dict, force=True))
+
+    assert len(calls) == 3
+
+def test_ocr_hash_image(image_pillow: PILImage, ocr_model: m.OCRModel):
+    """Test the content hash of a crop only depends on its pixels."""
+    crop = image_pillow.crop((1, 2, 5, 6))
+    assert ocr_model.hash_image(crop) == ocr_model.hash_image(crop.copy())
+    assert ocr_model.hash_image(crop) != ocr_model.hash_image(image_pillow.crop((1, 2, 5, 7)))
+    assert ocr_model.hash_image(crop) != ocr_model.hash_image(crop.convert('L'))
+
 @pytest.mark.parametrize('lang_src', ['ja', 'en'])
 def test_ocr_merge_single_result(lang_src): # pylint: disable=too-many-locals
     # pylint: disable=invalid-name
@@ -698,6 +1031,70 @@ def test_ocr_tsl_work_plus_lazy(
 
     assert res == res_lazy
 
+def test_ocr_tsl_stream(
+        image_pillow: PILImage, image: m.Image, text: m.Text, box_run: m.OCRBoxRun, language: m.Language,
+        box_model_loaded: m.OCRBoxModel, ocr_model_loaded: m.OCRModel, tsl_model_loaded: m.TSLModel,
+        option_dict: m.OptionDict
+        ):
+    """Test the streaming pipeline: boxes first, then every item as soon as its OCR and translation are done."""
+    bboxes = [m.BBox.objects.create(image=image, l=i, b=0, r=i, t=0, from_ocr_merged=box_run) for i in range(2)]
+    msgs = [Message(id_=i, msg={}, handler=None) for i in range(2)]
+    def mock_box_run(*args, **kwargs):
+        return bboxes, bboxes
+    def mock_ocr_run(bbox_obj, *args, block=True, **kwargs):
+        msg = msgs[bbox_obj.l]
+        yield msg
+        res, _ = m.Text.objects.get_or_create(text=msg.response())
+        yield res
+    def mock_tsl_run(obj, *args, block=True, **kwargs):
+        yield None
+        res, _ = m.Text.objects.get_or_create(text = obj.text + '_translated')
+        yield res
+
+    box_model_loaded.box_detection = mock_box_run
+    ocr_model_loaded.ocr = mock_ocr_run
+    tsl_model_loaded.translate = mock_tsl_run
+
+    gen = full.ocr_tsl_pipeline_stream(
+        image_pillow, image.md5,
+        options_box=option_dict, options_ocr=option_dict, options_tsl=option_dict
+        )
+    assert next(gen) == {'index': 0, 'ocr': None, 'tsl': None, 'box': bboxes[0].lbrt}
+    assert next(gen) == {'index': 1, 'ocr': None, 'tsl': None, 'box': bboxes[1].lbrt}
+
+    # The second box is done first
+    msgs[1].set_response('text_1')
+    threading.Timer(0.1, msgs[0].set_response, args=('text_0',)).start()
+    assert list(gen) == [
+        {'index': 1, 'ocr': 'text_1', 'tsl': 'text_1_translated', 'box': bboxes[1].lbrt},
+        {'index': 0, 'ocr': 'text_0', 'tsl': 'text_0_translated', 'box': bboxes[0].lbrt},
+        ]
+
+def test_ocr_tsl_stream_close(
+        image_pillow: PILImage, image: m.Image, bbox: m.BBox,
+        box_model_loaded: m.OCRBoxModel, ocr_model_loaded: m.OCRModel, tsl_model_loaded: m.TSLModel,
+        option_dict: m.OptionDict
+        ):
+    """Test that closing the stream (client disconnected) releases the pending messages."""
+    msg = Message(id_=1, msg={}, handler=None)
+    msg.retain()
+    def mock_ocr_run(*args, block=True, **kwargs):
+        yield msg
+        yield msg.response()
+
+    box_model_loaded.box_detection = lambda *args, **kwargs: ([bbox], [bbox])
+    ocr_model_loaded.ocr = mock_ocr_run
+
+    gen = full.ocr_tsl_pipeline_stream(
+        image_pillow, image.md5,
+        options_box=option_dict, options_ocr=option_dict, options_tsl=option_dict
+        )
+    next(gen)
+    with deadline_context(time.monotonic() + 0.1):
+        with pytest.raises(TimeoutError):
+            next(gen)
+    assert msg.cancelled
+
 def test_ocr_tsl_lazy(option_dict: m.OptionDict):
     """Test performing an ocr_tsl_run lazy (no image)"""
     with pytest.raises(ValueError, match=r'^Image with md5 .* does not exist$'):
@@ -0,0 +1,104 @@
+###################################################################################
+# ocr_translate - a django app to perform OCR and translation of images.          #
+# Copyright (C) 2023-present Davide Grassano                                      #
+#                                                                                 #
+# This program is free software: you can redistribute it and/or modify            #
+# it under the terms of the GNU General Public License as published by            #
+# the Free Software Foundation, either version 3 of the License.                  #
+#                                                                                 #
+# This program is distributed in the hope that it will be useful,                 #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of                  #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                   #
+# GNU General Public License for more details.                                    #
+#                                                                                 #
+# You should have received a copy of the GNU General Public License               #
+# along with this program.  If not, see {http://www.gnu.org/licenses/}.           #
+#                                                                                 #
+# Home: https://github.com/Crivella/ocr_translate                                 #
+###################################################################################
+"""Tests for perceptual hashing and the BK-tree index."""
+
+import io
+import random
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from ocr_translate import phash
+
+
+@pytest.fixture(scope='module')
+def page():
+    """Random grayscale page with some structure (blocks) for the hash to pick up."""
+    rng = np.random.default_rng(0)
+    arr = np.kron(rng.integers(0, 255, (12, 8)), np.ones((50, 50))).astype(np.uint8)
+    return Image.fromarray(arr).convert('RGB')
+
+def test_dhash_identical(page):
+    """Test that the hash is deterministic."""
+    assert phash.dhash(page) == phash.dhash(page.copy())
+
+def test_dhash_resized(page):
+    """Test that resizing an image barely changes its hash."""
+    assert phash.hamming(phash.dhash(page), phash.dhash(page.resize((300, 450)))) <= 2
+
+def test_dhash_recompressed(page):
+    """Test that recompressing an image barely changes its hash."""
+    buffer = io.BytesIO()
+    page.save(buffer, format='JPEG', quality=30)
+    assert phash.hamming(phash.dhash(page), phash.dhash(Image.open(buffer))) <= 2
+
+def test_dhash_different(page):
+    """Test that different images have distant hashes."""
+    assert phash.hamming(phash.dhash(page), phash.dhash(page.transpose(Image.Transpose.FLIP_TOP_BOTTOM))) > 10
+
+def test_to_hex():
+    """Test the hex representation is zero padded to the size of the hash."""
+    assert phash.to_hex(0) == '0' * 16
+    assert phash.to_hex(2**64 - 1) == 'f' * 16
+
+def test_bktree_search():
+    """Test BK-tree search against a brute force search."""
+    rnd = random.Random(0)
+    keys = [rnd.getrandbits(16) for _ in range(500)]
+    tree = phash.BKTree()
+    for i, key in enumerate(keys):
+        tree.add(key, i)
+    assert len(tree) == len(keys)
+
+    for query in keys[:20]:
+        res = tree.search(query, 3)
+        expected = sorted((phash.hamming(query, key), i) for i, key in enumerate(keys) if phash.hamming(query, key) <= 3)
+        assert sorted(res) == expected
+        assert [_[0] for _ in res] == sorted(_[0] for _ in res)
+
+def test_bktree_same_key():
+    """Test that values sharing the same hash are all returned."""
+    tree = phash.BKTree()
+    tree.add(5, 'a')
+    tree.add(5, 'b')
+    assert tree.search(5, 0) == [(0, 'a'), (0, 'b')]
+
+def test_bktree_empty():
+    """Test searching an empty tree."""
+    assert not phash.BKTree().search(0, 64)
+
+def test_index_lazy_load():
+    """Test that the index is loaded on the first search, and that hashes added before are left to the loader."""
+    calls = []
+    def loader():
+        calls.append(1)
+        return [('00000000000000ff', 1)]
+    index = phash.PHashIndex(loader)
+    index.add('0000000000000000', 2)
+    assert not calls
+
+    assert index.search('00000000000000fe', 1) == [(1, 1)]
+    index.add('00000000000000fe', 3)
+    assert index.search('00000000000000fe', 1) == [(0, 3), (1, 1)]
+    assert len(calls) == 1
+
+    index.reset()
+    index.search('0000000000000000', 0)
+    assert len(calls) == 2
@@ -25,6 +25,9 @@ import pytest
 from django.http import JsonResponse
 
 from ocr_translate import request_decorators as rd
+from ocr_translate.messaging import (MessageCancelledError, Priority,
+                                     QueueFullError, get_current_deadline,
+                                     get_current_priority)
 
 
 @pytest.fixture(autouse=True)
@@ -190,3 +193,41 @@ def test_wait_for_existing_lock_timeout():
     t2.start()
     t2.join(timeout=2)
     assert isinstance(res, JsonResponse)
+
+def test_with_priority():
+    """Test that the priority class is set only while running the decorated function."""
+    @rd.with_priority(Priority.BULK)
+    def func():
+        return get_current_priority()
+
+    assert func() == Priority.BULK
+    assert get_current_priority() == Priority.INTERACTIVE
+
+def test_handle_queue_errors_full():
+    """Test that a QueueFullError is turned into a 503 with a Retry-After header."""
+    @rd.handle_queue_errors
+    def func():
+        raise QueueFullError('Queue full', retry_after=2.3)
+
+    res = func()
+    assert res.status_code == 503
+    assert res['Retry-After'] == '3'
+
+@pytest.mark.parametrize('exc', [MessageCancelledError, TimeoutError])
+def test_handle_queue_errors_timeout(exc):
+    """Test that cancelled/timed out messages are turned into a 504."""
+    @rd.handle_queue_errors
+    def func():
+        raise exc('test')
+
+    assert func().status_code == 504
+
+def test_with_deadline():
+    """Test that the deadline is set only while running the decorated function."""
+    @rd.with_deadline(10)
+    def func():
+        return get_current_deadline()
+
+    deadline = func()
+    assert 9 < deadline - time.monotonic() <= 10
+    assert get_current_deadline() is None
@@ -0,0 +1,190 @@
+###################################################################################
+# ocr_translate - a django app to perform OCR and translation of images.          #
+# Copyright (C) 2023-present Davide Grassano                                      #
+#                                                                                 #
+# This program is free software: you can redistribute it and/or modify            #
+# it under the terms of the GNU General Public License as published by            #
+# the Free Software Foundation, either version 3 of the License.                  #
+#                                                                                 #
+# This program is distributed in the hope that it will be useful,                 #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of                  #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                   #
+# GNU General Public License for more details.                                    #
+#                                                                                 #
+# You should have received a copy of the GNU General Public License               #
+# along with this program.  If not, see {http://www.gnu.org/licenses/}.           #
+#                                                                                 #
+# Home: https://github.com/Crivella/ocr_translate                                 #
+###################################################################################
+"""Tests for the pipeline result cache."""
+
+import json
+import threading
+
+import pytest
+
+from ocr_translate.result_cache import ResultCache
+
+
+def payload(text: str) -> list[dict]:
+    """Payload of a page with a single box."""
+    return [{'ocr': text, 'tsl': f'tsl_{text}', 'box': [1, 2, 3, 4]}]
+
+SIZE = len(json.dumps(payload('a')))
+
+def test_disabled():
+    """Test that a cache with max_size 0 does not store anything."""
+    cache = ResultCache(max_size=0)
+    cache.put(('a',), payload('a'))
+
+    assert not cache.enabled
+    assert cache.get(('a',)) is None
+    assert len(cache) == 0
+
+def test_get_put():
+    """Test storing and retrieving a payload."""
+    cache = ResultCache(max_size=SIZE * 10)
+    assert cache.get(('a',)) is None
+    cache.put(('a',), payload('a'))
+
+    assert cache.get(('a',)) == payload('a')
+    assert cache.size == SIZE
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+def test_put_same_key():
+    """Test that overwriting an entry does not count its size twice."""
+    cache = ResultCache(max_size=SIZE * 10)
+    cache.put(('a',), payload('a'))
+    cache.put(('a',), payload('b'))
+
+    assert len(cache) == 1
+    assert cache.size == SIZE
+    assert cache.get(('a',)) == payload('b')
+
+def test_lru_eviction():
+    """Test that the least recently used entries are evicted to stay within max_size."""
+    cache = ResultCache(max_size=SIZE * 2)
+    cache.put(('a',), payload('a'))
+    cache.put(('b',), payload('b'))
+    cache.get(('a',))
+    cache.put(('c',), payload('c'))
+
+    assert ('a',) in cache
+    assert ('b',) not in cache
+    assert ('c',) in cache
+    assert cache.size == SIZE * 2
+
+def test_too_big():
+    """Test that a payload bigger than the whole cache is not stored."""
+    cache = ResultCache(max_size=SIZE - 1)
+    cache.put(('a',), payload('a'))
+
+    assert len(cache) == 0
+
+def test_invalidate():
+    """Test invalidating a single entry."""
+    cache = ResultCache(max_size=SIZE * 10)
+    cache.put(('a',), payload('a'))
+    cache.invalidate(('a',))
+
+    assert len(cache) == 0
+    assert cache.size == 0
+
+@pytest.mark.parametrize('text', ['a', 'tsl_a'])
+def test_invalidate_texts(text):
+    """Test invalidating the entries containing a text (either as OCR or translation)."""
+    cache = ResultCache(max_size=SIZE * 10)
+    cache.put(('a',), payload('a'))
+    cache.put(('a2',), payload('a'))
+    cache.put(('b',), payload('b'))
+
+    assert cache.invalidate_texts([text]) == 2
+    assert list(cache._entries) == [('b',)]  # pylint: disable=protected-access
+    assert cache.invalidate_texts([text]) == 0
+
+def test_disk_tier(tmp_path):
+    """Test that evicted entries are kept on disk and promoted back on a hit."""
+    cache = ResultCache(max_size=SIZE, disk_dir=tmp_path)
+    cache.put(('a', 1), payload('a'))
+    cache.put(('b', 1), payload('b'))
+
+    assert ('a', 1) not in cache
+    assert len(list(tmp_path.glob('*.json'))) == 1
+    assert cache.get(('a', 1)) == payload('a')
+    assert ('a', 1) in cache
+
+def test_disk_tier_invalidate_texts(tmp_path):
+    """Test that invalidating by text also removes the entries in the disk tier."""
+    cache = ResultCache(max_size=SIZE, disk_dir=tmp_path)
+    cache.put(('a',), payload('a'))
+    cache.put(('b',), payload('b'))
+    cache.invalidate_texts(['a'])
+    cache.clear()
+
+    assert cache.get(('a',)) is None
+    assert cache.get(('b',)) is None
+    assert not list(tmp_path.glob('*.json'))
+
+def test_disk_tier_max_size(tmp_path):
+    """Test that the disk tier is bounded by disk_max_size."""
+    disk_size = len(json.dumps([['a'], payload('a')]))
+    cache = ResultCache(max_size=SIZE, disk_dir=tmp_path, disk_max_size=disk_size * 2)
+    for key in 'abcd':
+        cache.put((key,), payload(key))
+
+    assert len(list(tmp_path.glob('*.json'))) == 2
+
+def test_disk_tier_size_total(tmp_path):
+    """Test that the running total of the disk tier matches the files, also when reopening the directory."""
+    cache = ResultCache(max_size=SIZE, disk_dir=tmp_path)
+    for key in 'abcd':
+        cache.put((key,), payload(key))
+    files = list(tmp_path.glob('*.json'))
+
+    assert len(files) == 3
+    assert cache.disk_size == sum(_.stat().st_size for _ in files)
+    cache.invalidate(('a',))
+    assert cache.disk_size == sum(_.stat().st_size for _ in tmp_path.glob('*.json'))
+
+    reopened = ResultCache(max_size=SIZE, disk_dir=tmp_path)
+    assert reopened.disk_size == cache.disk_size
+    assert reopened.get(('b',)) == payload('b')
+
+def test_disk_tier_invalidate_during_eviction(tmp_path):
+    """Test that an invalidation running while an evicted entry is being written to disk is not lost."""
+    cache = ResultCache(max_size=SIZE, disk_dir=tmp_path)
+    cache.put(('a',), payload('a'))
+    disk_put = cache._disk_put  # pylint: disable=protected-access
+    invalidator = threading.Thread(target=cache.invalidate_texts, args=(['a'],))
+
+    def slow_disk_put(key, data):
+        # Entry `a` is already out of memory, but not yet on disk
+        invalidator.start()
+        invalidator.join(timeout=0.2)
+        disk_put(key, data)
+    cache._disk_put = slow_disk_put  # pylint: disable=protected-access
+
+    cache.put(('b',), payload('b'))
+    invalidator.join()
+
+    assert cache.get(('a',)) is None
+    assert not list(tmp_path.glob('*.json'))
+
+def test_disk_tier_concurrent_evictions(tmp_path):
+    """Test that concurrent puts evicting to a bounded disk tier do not fail."""
+    disk_size = len(json.dumps([['a0'], payload('a0')]))
+    cache = ResultCache(max_size=SIZE * 2, disk_dir=tmp_path, disk_max_size=disk_size * 3)
+
+    def worker(i):
+        for j in range(20):
+            cache.put((f'{i}{j}',), payload(f'{i}{j}'))
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    files = list(tmp_path.glob('*.json'))
+    assert len(files) <= 3
+    assert cache.disk_size == sum(_.stat().st_size for _ in files)
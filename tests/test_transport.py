@@ -0,0 +1,84 @@
+###################################################################################
+# ocr_translate - a django app to perform OCR and translation of images.          #
+# Copyright (C) 2023-present Davide Grassano                                      #
+#                                                                                 #
+# This program is free software: you can redistribute it and/or modify            #
+# it under the terms of the GNU General Public License as published by            #
+# the Free Software Foundation, either version 3 of the License.                  #
+#                                                                                 #
+# This program is distributed in the hope that it will be useful,                 #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of                  #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                   #
+# GNU General Public License for more details.                                    #
+#                                                                                 #
+# You should have received a copy of the GNU General Public License               #
+# along with this program.  If not, see {http://www.gnu.org/licenses/}.           #
+#                                                                                 #
+# Home: https://github.com/Crivella/ocr_translate                                 #
+###################################################################################
+"""Tests for the binary upload transport helpers."""
+
+import base64
+import hashlib
+import os
+
+import pytest
+
+from ocr_translate import transport
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 64, 1000])
+def test_base64_md5(chunk_size):
+    """Test that the streaming md5 of the base64 matches the md5 of the whole base64, for any chunking."""
+    data = os.urandom(500)
+    digest = transport.Base64MD5()
+    for i in range(0, len(data), chunk_size):
+        digest.update(data[i:i + chunk_size])
+
+    assert digest.hexdigest() == hashlib.md5(base64.b64encode(data)).hexdigest()
+
+def test_base64_md5_hexdigest_not_final():
+    """Test that hexdigest can be called before adding more data."""
+    digest = transport.Base64MD5()
+    digest.update(b'ab')
+    assert digest.hexdigest() == hashlib.md5(base64.b64encode(b'ab')).hexdigest()
+    digest.update(b'c')
+    assert digest.hexdigest() == hashlib.md5(base64.b64encode(b'abc')).hexdigest()
+
+@pytest.mark.parametrize('algorithm', list(transport.DIGESTS))
+def test_new_digest(algorithm):
+    """Test that every supported digest fits the Image.md5 field."""
+    digest = transport.new_digest(algorithm.upper())
+    digest.update(b'test')
+    assert len(digest.hexdigest()) == 32
+
+def test_new_digest_unsupported():
+    """Test that unsupported algorithms raise ValueError."""
+    with pytest.raises(ValueError, match='Unsupported digest algorithm'):
+        transport.new_digest('sha0')
+
+@pytest.mark.parametrize('content_type', [None, 'application/json', 'APPLICATION/JSON'])
+def test_decode_options_json(content_type):
+    """Test decoding JSON options (the default)."""
+    assert transport.decode_options(b'{"a": 1}', content_type) == {'a': 1}
+
+@pytest.mark.parametrize('data', [b'{', b'[1]'], ids=['invalid', 'not_dict'])
+def test_decode_options_invalid(data):
+    """Test decoding invalid options."""
+    with pytest.raises(ValueError):
+        transport.decode_options(data, 'application/json')
+
+def test_decode_options_unsupported():
+    """Test decoding options in an unknown format."""
+    with pytest.raises(transport.UnsupportedFormatError):
+        transport.decode_options(b'', 'application/yaml')
+
+def test_decode_options_msgpack():
+    """Test decoding MessagePack options (if installed)."""
+    msgpack = pytest.importorskip('msgpack')
+    assert transport.decode_options(msgpack.packb({'a': 1}), 'application/msgpack') == {'a': 1}
+
+def test_decode_options_cbor():
+    """Test decoding CBOR options (if installed)."""
+    cbor2 = pytest.importorskip('cbor2')
+    assert transport.decode_options(cbor2.dumps({'a': 1}), 'application/cbor') == {'a': 1}
@@ -0,0 +1,131 @@
+###################################################################################
+# ocr_translate - a django app to perform OCR and translation of images.          #
+# Copyright (C) 2023-present Davide Grassano                                      #
+#                                                                                 #
+# This program is free software: you can redistribute it and/or modify            #
+# it under the terms of the GNU General Public License as published by            #
+# the Free Software Foundation, either version 3 of the License.                  #
+#                                                                                 #
+# This program is distributed in the hope that it will be useful,                 #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of                  #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                   #
+# GNU General Public License for more details.                                    #
+#                                                                                 #
+# You should have received a copy of the GNU General Public License               #
+# along with this program.  If not, see {http://www.gnu.org/licenses/}.           #
+#                                                                                 #
+# Home: https://github.com/Crivella/ocr_translate                                 #
+###################################################################################
+"""Test prefetch and cancel_prefetch serverside views."""
+# pylint: disable=redefined-outer-name
+
+import base64
+import hashlib
+import io
+
+import pytest
+from django.urls import reverse
+from PIL import Image
+
+from ocr_translate import models as m
+from ocr_translate import views
+from ocr_translate.messaging import PrefetchQueue, WorkerMessageQueue
+
+pytestmark = pytest.mark.django_db
+
+@pytest.fixture()
+def mock_prefetch(monkeypatch):
+    """Replace the prefetch queue with a new one feeding a new (not started) main queue."""
+    target = WorkerMessageQueue()
+    res = PrefetchQueue(target, max_pending=1)
+    monkeypatch.setattr(views, 'prefetch_queue', res)
+    monkeypatch.setattr(views, 'q', target)
+    return res
+
+@pytest.fixture()
+def page():
+    """Base64 encoded image with its md5."""
+    buffer = io.BytesIO()
+    Image.new('RGB', (2, 2)).save(buffer, format='PNG')
+    b64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
+    return {'contents': b64, 'md5': hashlib.md5(b64.encode('utf-8')).hexdigest()}
+
+def post(client, name, **data):
+    """POST to the given view."""
+    url = reverse(f'ocr_translate:{name}')
+    return client.post(url, data=data, content_type='application/json')
+
+@pytest.mark.parametrize('name', ['prefetch', 'cancel_prefetch'])
+def test_prefetch_nonpost(client, name):
+    """Test prefetch views with non POST request."""
+    url = reverse(f'ocr_translate:{name}')
+    response = client.get(url)
+    assert response.status_code == 405
+
+@pytest.mark.parametrize('name', ['prefetch', 'cancel_prefetch'])
+@pytest.mark.parametrize('images', [None, [], [{'contents': 'test'}]])
+def test_prefetch_invalid_images(client, mock_loaded, mock_prefetch, name, images):
+    """Test prefetch views with missing/invalid list of images."""
+    response = post(client, name, images=images)
+    assert response.status_code == 400
+
+def test_prefetch_wrong_md5(client, mock_loaded, mock_prefetch, page):
+    """Test prefetch with a wrong md5."""
+    page['md5'] = 'wrong_md5'
+    response = post(client, 'prefetch', images=[page])
+    assert response.status_code == 400
+
+def test_prefetch_md5_only(client, monkeypatch, mock_loaded, mock_prefetch, page):
+    """Test prefetch without contents: only reports whether the results are available."""
+    def mock_ocrtsl_lazy(md5, **kwargs):
+        """Mock ocrtsl lazy pipeline."""
+        if md5 == 'missing':
+            raise ValueError('test')
+        return []
+    monkeypatch.setattr(views, 'ocr_tsl_pipeline_lazy', mock_ocrtsl_lazy)
+
+    response = post(client, 'prefetch', images=[{'md5': 'missing'}, {'md5': 'cached'}])
+
+    assert response.status_code == 200
+    assert [_['status'] for _ in response.json()['results']] == ['missing', 'done']
+    assert len(mock_prefetch) == 0
+
+def test_prefetch_queued(client, mock_loaded, mock_prefetch, page):
+    """Test prefetch of a new page -> queued once (deduplicated), then cancelled."""
+    for _ in range(2):
+        response = post(client, 'prefetch', images=[page])
+        assert response.status_code == 200
+        assert response.json()['results'][0] == {'md5': page['md5'], 'status': 'queued'}
+    assert len(mock_prefetch) == 1
+
+    response = post(client, 'cancel_prefetch', images=[{'md5': page['md5']}])
+    assert response.status_code == 200
+    assert response.json()['results'][0]['cancelled']
+    assert len(mock_prefetch) == 0
+
+    response = post(client, 'cancel_prefetch', images=[{'md5': page['md5']}])
+    assert not response.json()['results'][0]['cancelled']
+
+def test_prefetch_running(client, mock_loaded, mock_prefetch, page):
+    """Test prefetch of a page already in the main queue with the same id used by `run_ocrtsl` -> running."""
+    box_model = m.OCRBoxModel.get_loaded_model()
+    ocr_model = m.OCRModel.get_loaded_model()
+    tsl_model = m.TSLModel.get_loaded_model()
+    id_ = views._ocrtsl_id(  # pylint: disable=protected-access
+        page['md5'],
+        m.Language.get_loaded_model_src(), m.Language.get_loaded_model_dst(),
+        box_model, ocr_model, tsl_model,
+        *views._get_options({}, box_model, ocr_model, tsl_model),  # pylint: disable=protected-access
+        )
+    views.q.put(id_=id_, msg={}, handler=None)
+
+    response = post(client, 'prefetch', images=[page])
+
+    assert response.json()['results'][0]['status'] == 'running'
+    assert len(mock_prefetch) == 0
+
+def test_prefetch_full(client, mock_loaded, mock_prefetch, page):
+    """Test prefetch with the prefetch queue full -> 503."""
+    mock_prefetch.put('other', {}, None)
+    response = post(client, 'prefetch', images=[page])
+    assert response.status_code == 503
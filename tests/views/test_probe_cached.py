@@ -0,0 +1,113 @@
+###################################################################################
+# ocr_translate - a django app to perform OCR and translation of images.          #
+# Copyright (C) 2023-present Davide Grassano                                      #
+#                                                                                 #
+# This program is free software: you can redistribute it and/or modify            #
+# it under the terms of the GNU General Public License as published by            #
+# the Free Software Foundation, either version 3 of the License.                  #
+#                                                                                 #
+# This program is distributed in the hope that it will be useful,                 #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of                  #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                   #
+# GNU General Public License for more details.                                    #
+#                                                                                 #
+# You should have received a copy of the GNU General Public License               #
+# along with this program.  If not, see {http://www.gnu.org/licenses/}.           #
+#                                                                                 #
+# Home: https://github.com/Crivella/ocr_translate                                 #
+###################################################################################
+"""Test probe_cached serverside view."""
+# pylint: disable=redefined-outer-name,unused-argument
+
+import pytest
+from django.urls import reverse
+
+from ocr_translate import models as m
+from ocr_translate import views
+from ocr_translate.ocr_tsl import cached_lists as cl
+
+pytestmark = pytest.mark.django_db
+
+STAGES = ('image', 'box', 'ocr', 'tsl')
+
+def probe(client, md5s, options=None):
+    """Run a probe_cached request and return the stages of every md5."""
+    url = reverse('ocr_translate:probe_cached')
+    response = client.post(url, {'md5s': md5s, 'options': options or {}}, content_type='application/json')
+    assert response.status_code == 200
+    return [tuple(_[k] for k in STAGES) for _ in response.json()['results']]
+
+def test_probe_cached_unknown(client, mock_loaded):
+    """Test probe_cached with unknown images."""
+    assert probe(client, ['unknown1', 'unknown2']) == [(False,) * 4] * 2
+
+def test_probe_cached_unknown_no_queries(client, mock_loaded, django_assert_num_queries):
+    """Test that misses do not touch the database once the set of known images is loaded."""
+    cl.refresh_image_cache()
+    with django_assert_num_queries(0):
+        assert probe(client, ['unknown1', 'unknown2']) == [(False,) * 4] * 2
+
+def test_probe_cached_image_only(client, mock_loaded, image):
+    """Test probe_cached with an image without runs."""
+    assert probe(client, [image.md5]) == [(True, False, False, False)]
+
+def test_probe_cached_box_only(client, mock_loaded, bbox):
+    """Test probe_cached with an image with only box detection results."""
+    assert probe(client, [bbox.image.md5]) == [(True, True, False, False)]
+
+def test_probe_cached_ocr_only(client, mock_loaded, ocr_run):
+    """Test probe_cached with an image with box and OCR results, but no translations."""
+    assert probe(client, [ocr_run.bbox.image.md5]) == [(True, True, True, False)]
+
+def test_probe_cached_full(client, mock_loaded, ocr_run, tsl_run):
+    """Test probe_cached with an image with every stage available."""
+    assert probe(client, [ocr_run.bbox.image.md5]) == [(True,) * 4]
+
+def test_probe_cached_full_manual(client, mock_loaded, ocr_run, text, language, manual_model, option_dict):
+    """Test that a manual translation counts as a cached translation."""
+    m.TranslationRun.objects.create(
+        lang_src=language, lang_dst=language, text=text, model=manual_model, options=option_dict, result=text
+        )
+    assert probe(client, [ocr_run.bbox.image.md5]) == [(True,) * 4]
+
+def test_probe_cached_partial_ocr(client, mock_loaded, ocr_run, tsl_run, image, box_run):
+    """Test that the ocr stage is not available if any box lacks its OCR result."""
+    m.BBox.objects.create(image=image, l=5, b=6, r=7, t=8, from_ocr_merged=box_run)
+    assert probe(client, [image.md5]) == [(True, True, False, False)]
+
+def test_probe_cached_other_options(client, mock_loaded, ocr_run, tsl_run, box_model):
+    """Test that runs with different options are not reported as cached (and no option set is created)."""
+    num = m.OptionDict.objects.count()
+    assert probe(client, [ocr_run.bbox.image.md5], {box_model.name: {'x': 1}}) == [(True, False, False, False)]
+    assert m.OptionDict.objects.count() == num
+
+def test_probe_cached_new_image(client, mock_loaded):
+    """Test that images created/deleted after the set of known images is loaded are tracked."""
+    assert probe(client, ['new']) == [(False,) * 4]
+    img = m.Image.objects.create(md5='new')
+    assert probe(client, ['new']) == [(True, False, False, False)]
+    img.delete()
+    assert probe(client, ['new']) == [(False,) * 4]
+
+def test_probe_cached_result_cache(client, mock_loaded, image, django_assert_num_queries):
+    """Test that pages in the result cache are answered without touching the database."""
+    cl.refresh_image_cache()
+    key = views._result_key(  # pylint: disable=protected-access
+        image.md5, m.Language.LOADED_SRC, m.Language.LOADED_DST,
+        m.OCRBoxModel.LOADED_MODEL, m.OCRModel.LOADED_MODEL, m.TSLModel.LOADED_MODEL, {},
+        )
+    views.result_cache.put(key, [])
+    with django_assert_num_queries(0):
+        assert probe(client, [image.md5, 'unknown']) == [(True,) * 4, (False,) * 4]
+
+def test_probe_cached_mixed_order(client, mock_loaded, ocr_run, tsl_run, image):
+    """Test that results follow the order of the request (duplicates included)."""
+    res = probe(client, ['unknown', image.md5, 'unknown'])
+    assert res == [(False,) * 4, (True,) * 4, (False,) * 4]
+
+@pytest.mark.parametrize('md5s', [None, [], 'md5', [1]])
+def test_probe_cached_invalid(client, mock_loaded, md5s):
+    """Test probe_cached with invalid md5s."""
+    url = reverse('ocr_translate:probe_cached')
+    response = client.post(url, {'md5s': md5s}, content_type='application/json')
+    assert response.status_code == 400
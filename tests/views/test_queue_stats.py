@@ -0,0 +1,81 @@
+###################################################################################
+# ocr_translate - a django app to perform OCR and translation of images.          #
+# Copyright (C) 2023-present Davide Grassano                                      #
+#                                                                                 #
+# This program is free software: you can redistribute it and/or modify            #
+# it under the terms of the GNU General Public License as published by            #
+# the Free Software Foundation, either version 3 of the License.                  #
+#                                                                                 #
+# This program is distributed in the hope that it will be useful,                 #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of                  #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                   #
+# GNU General Public License for more details.                                    #
+#                                                                                 #
+# You should have received a copy of the GNU General Public License               #
+# along with this program.  If not, see {http://www.gnu.org/licenses/}.           #
+#                                                                                 #
+# Home: https://github.com/Crivella/ocr_translate                                 #
+###################################################################################
+"""Test get_queue_stats and set_queue_bounds serverside views."""
+# pylint: disable=redefined-outer-name
+
+import pytest
+from django.urls import reverse
+
+from ocr_translate import views
+from ocr_translate.messaging import WorkerMessageQueue
+
+
+@pytest.fixture()
+def mock_queues(monkeypatch):
+    """Replace the app queues with a new (not started) one."""
+    queues = {'main': WorkerMessageQueue(num_workers=1, max_workers=2)}
+    monkeypatch.setattr(views, 'QUEUES', queues)
+    return queues
+
+def test_get_queue_stats_nonget(client):
+    """Test get_queue_stats with non GET request."""
+    url = reverse('ocr_translate:get_queue_stats')
+    response = client.post(url)
+    assert response.status_code == 405
+
+def test_get_queue_stats(client):
+    """Test get_queue_stats."""
+    url = reverse('ocr_translate:get_queue_stats')
+    response = client.get(url)
+    assert response.status_code == 200
+    data = response.json()
+    assert set(data) == {'main', 'box', 'ocr', 'tsl'}
+    for stats in data.values():
+        assert stats['workers'] >= stats['min_workers']
+        assert 'depth' in stats
+        assert 'cache' in stats
+
+def test_set_queue_bounds_nonpost(client):
+    """Test set_queue_bounds with non POST request."""
+    url = reverse('ocr_translate:set_queue_bounds')
+    response = client.get(url)
+    assert response.status_code == 405
+
+def test_set_queue_bounds(client, mock_queues):
+    """Test set_queue_bounds rescales the pool to the new bounds."""
+    url = reverse('ocr_translate:set_queue_bounds')
+    data = {'queue': 'main', 'min_workers': 3, 'max_workers': 4}
+    response = client.post(url, data=data, content_type='application/json')
+    assert response.status_code == 200
+    assert response.json()['workers'] == 3
+    assert len(mock_queues['main'].workers) == 3
+    assert mock_queues['main'].max_workers == 4
+
+@pytest.mark.parametrize('data', [
+    {'queue': 'unknown', 'min_workers': 1},
+    {'queue': 'main', 'min_workers': 0},
+    {'queue': 'main', 'min_workers': 3, 'max_workers': 2},
+    {'queue': 'main', 'max_workers': 'a'},
+], ids=['unknown_queue', 'min_zero', 'max_lt_min', 'not_int'])
+def test_set_queue_bounds_invalid(client, mock_queues, data):
+    """Test set_queue_bounds with invalid data."""
+    url = reverse('ocr_translate:set_queue_bounds')
+    response = client.post(url, data=data, content_type='application/json')
+    assert response.status_code == 400
+    assert len(mock_queues['main'].workers) == 1
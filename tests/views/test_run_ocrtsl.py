@@ -22,11 +22,16 @@
 import base64
 import hashlib
 import io
+import json
 
 import pytest
 from django.urls import reverse
 
+from ocr_translate import models as m
+from ocr_translate import request_decorators as reqdec
 from ocr_translate import views
+from ocr_translate.messaging import (Message, QueueFullError,
+                                     WorkerMessageQueue, get_current_deadline)
 
 pytestmark = pytest.mark.django_db
 
@@ -104,6 +109,37 @@ def test_run_ocrtsl_post_wrong_md5(client, post_kwargs, mock_loaded):
     assert response.status_code == 400
     assert response.json()['error'] == 'md5 mismatch'
 
+@pytest.mark.parametrize(
+    'tile_options',
+    [{'tile_size': 64}, {'tile_size': 100, 'tile_overlap': 150}, {'tile_size': -1}],
+    ids=['equal', 'larger', 'negative_size']
+)
+def test_run_ocrtsl_post_invalid_tile_options(client, monkeypatch, post_kwargs, mock_loaded, box_model, tile_options):
+    """Test run_ocrtsl with a tile overlap not smaller than the tile size: rejected before queuing anything."""
+    def mock_put(*args, **kwargs):
+        raise AssertionError('Should not be queued')
+    monkeypatch.setattr(views, '_put_ocrtsl', mock_put)
+    post_kwargs['data']['options'] = {box_model.name: tile_options}
+    url = reverse('ocr_translate:run_ocrtsl')
+    response = client.post(url, **post_kwargs)
+
+    assert response.status_code == 400
+    assert 'tile_' in response.json()['error']
+
+def test_run_ocrtsl_post_wrong_md5_cached(client, post_kwargs, mock_loaded, image_md5):
+    """Test that a cached result is not served to a request whose contents do not match the md5."""
+    key = views._result_key(  # pylint: disable=protected-access
+        image_md5, m.Language.LOADED_SRC, m.Language.LOADED_DST,
+        m.OCRBoxModel.LOADED_MODEL, m.OCRModel.LOADED_MODEL, m.TSLModel.LOADED_MODEL, {},
+        )
+    views.result_cache.put(key, [{'ocr': 'cached', 'tsl': 'cached', 'box': (1,2,3,4)}])
+    post_kwargs['data']['contents'] = base64.b64encode(b'other').decode('utf-8')
+    url = reverse('ocr_translate:run_ocrtsl')
+    response = client.post(url, **post_kwargs)
+
+    assert response.status_code == 400
+    assert response.json()['error'] == 'md5 mismatch'
+
 def test_run_ocrtsl_post_valid_lazy_success(client, monkeypatch, post_kwargs, mock_loaded):
     """Test run_ocrtsl with POST request with valid data. No contents -> lazy + success"""
     post_kwargs['data'].pop('contents')
@@ -196,3 +232,286 @@ def test_run_ocrtsl_post_message_raise(client, monkeypatch, queues_no_reuse, moc
 
     assert isinstance(content, dict)
     assert content['error'] == exc_msg
+
+def test_run_ocrtsl_post_queue_full(client, monkeypatch, queues_no_reuse, mock_loaded, post_kwargs):
+    """Test run_ocrtsl with POST request rejected by the main queue -> 503 + Retry-After"""
+    def mock_put(*args, **kwargs):
+        """Mock a full queue."""
+        raise QueueFullError('Queue full', retry_after=4.2)
+    monkeypatch.setattr(views.q, 'put', mock_put)
+
+    url = reverse('ocr_translate:run_ocrtsl')
+    response = client.post(url, **post_kwargs)
+
+    assert response.status_code == 503
+    assert response['Retry-After'] == '5'
+    assert response.json()['retry_after'] == 5
+
+def test_run_ocrtsl_post_stage_queue_full(client, monkeypatch, queues_no_reuse, mock_loaded, post_kwargs):
+    """Test run_ocrtsl with POST request rejected by a stage queue inside the pipeline -> 503 + Retry-After"""
+    def mock_ocrtsl_work(*args, **kwargs):
+        """Mock ocrtsl work pipeline."""
+        raise QueueFullError('Queue full', retry_after=1)
+    monkeypatch.setattr(views, 'ocr_tsl_pipeline_work', mock_ocrtsl_work)
+
+    url = reverse('ocr_translate:run_ocrtsl')
+    response = client.post(url, **post_kwargs)
+
+    assert response.status_code == 503
+    assert response['Retry-After'] == '1'
+
+def test_run_ocrtsl_post_timeout(client, monkeypatch, queues_no_reuse, mock_loaded, post_kwargs):
+    """Test run_ocrtsl with POST request timing out -> 504 + message cancelled"""
+    msg = Message(id_=1, msg={}, handler=None)
+    def mock_response(*args, **kwargs):
+        """Mock a response timing out."""
+        raise TimeoutError('timeout')
+    def mock_put(*args, **kwargs):
+        """Mock put returning a message that never resolves."""
+        msg.retain()
+        return msg
+    monkeypatch.setattr(msg, 'response', mock_response)
+    monkeypatch.setattr(views.q, 'put', mock_put)
+
+    url = reverse('ocr_translate:run_ocrtsl')
+    response = client.post(url, **post_kwargs)
+
+    assert response.status_code == 504
+    assert msg.cancelled
+
+def test_run_ocrtsl_post_stage_timeout(client, monkeypatch, queues_no_reuse, mock_loaded, post_kwargs):
+    """Test run_ocrtsl with POST request timing out in a stage queue inside the pipeline -> 504"""
+    def mock_ocrtsl_work(*args, **kwargs):
+        """Mock ocrtsl work pipeline."""
+        raise TimeoutError('timeout')
+    monkeypatch.setattr(views, 'ocr_tsl_pipeline_work', mock_ocrtsl_work)
+
+    url = reverse('ocr_translate:run_ocrtsl')
+    response = client.post(url, **post_kwargs)
+
+    assert response.status_code == 504
+
+def test_run_ocrtsl_post_stream(client, monkeypatch, mock_loaded, post_kwargs):
+    """Test run_ocrtsl with POST request in streaming mode -> NDJSON items, consumed in the request deadline"""
+    def mock_ocrtsl_stream(*args, **kwargs):
+        """Mock ocrtsl stream pipeline."""
+        yield {'index': 0, 'ocr': None, 'tsl': None, 'box': (1,2,3,4)}
+        yield {'index': 0, 'ocr': 'test_ocr', 'tsl': get_current_deadline() is not None, 'box': (1,2,3,4)}
+    monkeypatch.setattr(views, 'ocr_tsl_pipeline_stream', mock_ocrtsl_stream)
+    post_kwargs['data']['stream'] = True
+
+    url = reverse('ocr_translate:run_ocrtsl')
+    response = client.post(url, **post_kwargs)
+
+    assert response.status_code == 200
+    assert response['Content-Type'] == 'application/x-ndjson'
+    lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+    assert [json.loads(_) for _ in lines] == [
+        {'index': 0, 'ocr': None, 'tsl': None, 'box': [1,2,3,4]},
+        {'index': 0, 'ocr': 'test_ocr', 'tsl': True, 'box': [1,2,3,4]},
+        ]
+
+def test_run_ocrtsl_post_stream_lazy(client, monkeypatch, mock_loaded, post_kwargs):
+    """Test run_ocrtsl with POST request in streaming mode without contents -> lazy results as NDJSON"""
+    post_kwargs['data'].pop('contents')
+    post_kwargs['data']['stream'] = True
+    def mock_ocrtsl_lazy(*args, **kwargs):
+        """Mock ocrtsl lazy pipeline."""
+        return [{'ocr': 'test_ocr', 'tsl': 'test_tsl', 'box': (1,2,3,4)}]
+    monkeypatch.setattr(views, 'ocr_tsl_pipeline_lazy', mock_ocrtsl_lazy)
+
+    url = reverse('ocr_translate:run_ocrtsl')
+    response = client.post(url, **post_kwargs)
+
+    assert response.status_code == 200
+    lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+    assert [json.loads(_) for _ in lines] == [{'index': 0, 'ocr': 'test_ocr', 'tsl': 'test_tsl', 'box': [1,2,3,4]}]
+
+def test_run_ocrtsl_post_stream_error(client, monkeypatch, mock_loaded, post_kwargs):
+    """Test run_ocrtsl with POST request in streaming mode failing after the first item -> final error line"""
+    def mock_ocrtsl_stream(*args, **kwargs):
+        """Mock ocrtsl stream pipeline."""
+        yield {'index': 0, 'ocr': None, 'tsl': None, 'box': (1,2,3,4)}
+        raise TimeoutError('timeout')
+    monkeypatch.setattr(views, 'ocr_tsl_pipeline_stream', mock_ocrtsl_stream)
+    post_kwargs['data']['stream'] = True
+
+    url = reverse('ocr_translate:run_ocrtsl')
+    response = client.post(url, **post_kwargs)
+
+    assert response.status_code == 200
+    lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+    assert len(lines) == 2
+    assert json.loads(lines[-1]) == {'error': 'timeout'}
+
+def test_run_ocrtsl_post_stream_queue_full(client, monkeypatch, mock_loaded, post_kwargs):
+    """Test run_ocrtsl with POST request in streaming mode rejected before the first item -> 503"""
+    def mock_ocrtsl_stream(*args, **kwargs):
+        """Mock ocrtsl stream pipeline."""
+        raise QueueFullError('Queue full', retry_after=1)
+        yield  # pylint: disable=unreachable
+    monkeypatch.setattr(views, 'ocr_tsl_pipeline_stream', mock_ocrtsl_stream)
+    post_kwargs['data']['stream'] = True
+
+    url = reverse('ocr_translate:run_ocrtsl')
+    response = client.post(url, **post_kwargs)
+
+    assert response.status_code == 503
+
+def test_run_ocrtsl_post_stream_holds_slot_and_lock(client, monkeypatch, mock_loaded, post_kwargs):
+    """Test that a streamed run holds a main queue slot and the plugin lock until the response is consumed"""
+    main = WorkerMessageQueue()
+    monkeypatch.setattr(views, 'q', main)
+    state = []
+    def mock_ocrtsl_stream(*args, **kwargs):
+        """Mock ocrtsl stream pipeline."""
+        yield {'index': 0, 'ocr': None, 'tsl': None, 'box': (1,2,3,4)}
+        state.append((main.msg_queue.inflight, reqdec.locks['block_plugin_changes'].locked()))
+        yield {'index': 0, 'ocr': 'test_ocr', 'tsl': 'test_tsl', 'box': (1,2,3,4)}
+    monkeypatch.setattr(views, 'ocr_tsl_pipeline_stream', mock_ocrtsl_stream)
+    post_kwargs['data']['stream'] = True
+
+    url = reverse('ocr_translate:run_ocrtsl')
+    response = client.post(url, **post_kwargs)
+    assert response.status_code == 200
+    assert main.msg_queue.inflight == 1
+    assert reqdec.locks['block_plugin_changes'].locked()
+
+    lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+    response.close()
+
+    assert len(lines) == 2
+    assert state == [(1, True)]
+    assert main.msg_queue.inflight == 0
+    assert not reqdec.locks['block_plugin_changes'].locked()
+
+def test_run_ocrtsl_post_stream_admission(client, monkeypatch, mock_loaded, post_kwargs):
+    """Test that streamed runs are rejected by the admission control of the main queue -> 503"""
+    main = WorkerMessageQueue(max_inflight=1, max_workers=2)
+    monkeypatch.setattr(views, 'q', main)
+    monkeypatch.setattr(views, 'ocr_tsl_pipeline_stream', None)
+    post_kwargs['data']['stream'] = True
+    release = main.reserve()
+
+    url = reverse('ocr_translate:run_ocrtsl')
+    response = client.post(url, **post_kwargs)
+
+    assert response.status_code == 503
+    release()
+    assert main.msg_queue.inflight == 0
+
+def test_run_ocrtsl_cached(client, monkeypatch, post_kwargs, mock_loaded, django_assert_num_queries):
+    """Test run_ocrtsl of an already served page -> result served from the cache without touching the database"""
+    calls = []
+    def mock_ocrtsl_lazy(*args, **kwargs):
+        """Mock ocrtsl lazy pipeline."""
+        calls.append(1)
+        return [{'ocr': 'test_ocr', 'tsl': 'test_tsl', 'box': (1,2,3,4)}]
+    monkeypatch.setattr(views, 'ocr_tsl_pipeline_lazy', mock_ocrtsl_lazy)
+    post_kwargs['data'].pop('contents')
+
+    url = reverse('ocr_translate:run_ocrtsl')
+    response = client.post(url, **post_kwargs)
+    assert response.status_code == 200
+    with django_assert_num_queries(0):
+        response = client.post(url, **post_kwargs)
+    assert response.status_code == 200
+    assert response.json()['result'][0]['tsl'] == 'test_tsl'
+    assert len(calls) == 1
+
+    post_kwargs['data']['stream'] = True
+    response = client.post(url, **post_kwargs)
+    lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+    assert [json.loads(_) for _ in lines] == [{'index': 0, 'ocr': 'test_ocr', 'tsl': 'test_tsl', 'box': [1,2,3,4]}]
+    assert len(calls) == 1
+
+def test_run_ocrtsl_cached_options(client, monkeypatch, post_kwargs, mock_loaded, ocr_model):
+    """Test run_ocrtsl with different options -> not served from the cache of the other options"""
+    calls = []
+    def mock_ocrtsl_lazy(*args, **kwargs):
+        """Mock ocrtsl lazy pipeline."""
+        calls.append(1)
+        return []
+    monkeypatch.setattr(views, 'ocr_tsl_pipeline_lazy', mock_ocrtsl_lazy)
+    post_kwargs['data'].pop('contents')
+
+    url = reverse('ocr_translate:run_ocrtsl')
+    client.post(url, **post_kwargs)
+    post_kwargs['data']['options'] = {ocr_model.name: {'test': 1}}
+    client.post(url, **post_kwargs)
+    client.post(url, **post_kwargs)
+
+    assert len(calls) == 2
+
+def test_run_ocrtsl_cached_force(client, monkeypatch, queues_no_reuse, post_kwargs, mock_loaded):
+    """Test run_ocrtsl with force -> cached result invalidated and pipeline run again"""
+    calls = []
+    def mock_ocrtsl_work(*args, **kwargs):
+        """Mock ocrtsl work pipeline."""
+        calls.append(1)
+        return [{'ocr': 'test_ocr', 'tsl': f'test_tsl_{len(calls)}', 'box': (1,2,3,4)}]
+    monkeypatch.setattr(views, 'ocr_tsl_pipeline_work', mock_ocrtsl_work)
+
+    url = reverse('ocr_translate:run_ocrtsl')
+    for _ in range(2):
+        response = client.post(url, **post_kwargs)
+        assert response.json()['result'][0]['tsl'] == 'test_tsl_1'
+
+    post_kwargs['data']['force'] = True
+    response = client.post(url, **post_kwargs)
+    assert response.json()['result'][0]['tsl'] == 'test_tsl_2'
+    assert len(calls) == 2
+
+def test_run_ocrtsl_reuse_similar(client, monkeypatch, post_kwargs, mock_loaded):
+    """Test run_ocrtsl with reuse_similar and a near-duplicate image -> results reused without running the pipeline"""
+    def mock_ocrtsl_similar(*args, **kwargs):
+        """Mock ocrtsl similar pipeline."""
+        return [{'ocr': 'test_ocr', 'tsl': 'test_tsl', 'box': (1,2,3,4)}]
+    monkeypatch.setattr(views, 'ocr_tsl_pipeline_similar', mock_ocrtsl_similar)
+    monkeypatch.setattr(views, '_put_ocrtsl', None)
+    post_kwargs['data']['reuse_similar'] = True
+
+    url = reverse('ocr_translate:run_ocrtsl')
+    response = client.post(url, **post_kwargs)
+
+    assert response.status_code == 200
+    assert response.json()['result'][0]['tsl'] == 'test_tsl'
+    # Approximate results are not served to later requests that did not opt in
+    assert not views.result_cache
+
+@pytest.mark.parametrize('reuse_similar, force', [(True, True), (False, False)], ids=['force', 'not_requested'])
+def test_run_ocrtsl_reuse_similar_skipped(
+        client, monkeypatch, queues_no_reuse, post_kwargs, mock_loaded, reuse_similar, force
+        ):
+    """Test run_ocrtsl without reuse_similar or with force -> near-duplicates are not looked up"""
+    def mock_ocrtsl_work(*args, **kwargs):
+        """Mock ocrtsl work pipeline."""
+        return [{'ocr': 'test_ocr', 'tsl': 'work', 'box': (1,2,3,4)}]
+    monkeypatch.setattr(views, 'ocr_tsl_pipeline_work', mock_ocrtsl_work)
+    monkeypatch.setattr(views, 'ocr_tsl_pipeline_similar', None)
+    post_kwargs['data']['reuse_similar'] = reuse_similar
+    post_kwargs['data']['force'] = force
+
+    url = reverse('ocr_translate:run_ocrtsl')
+    response = client.post(url, **post_kwargs)
+
+    assert response.status_code == 200
+    assert response.json()['result'][0]['tsl'] == 'work'
+
+def test_run_ocrtsl_reuse_similar_miss(client, monkeypatch, queues_no_reuse, post_kwargs, mock_loaded):
+    """Test run_ocrtsl with reuse_similar and no near-duplicate -> pipeline run"""
+    def mock_ocrtsl_similar(*args, **kwargs):
+        """Mock ocrtsl similar pipeline."""
+        raise ValueError('test')
+    def mock_ocrtsl_work(*args, **kwargs):
+        """Mock ocrtsl work pipeline."""
+        return [{'ocr': 'test_ocr', 'tsl': 'work', 'box': (1,2,3,4)}]
+    monkeypatch.setattr(views, 'ocr_tsl_pipeline_similar', mock_ocrtsl_similar)
+    monkeypatch.setattr(views, 'ocr_tsl_pipeline_work', mock_ocrtsl_work)
+    post_kwargs['data']['reuse_similar'] = True
+
+    url = reverse('ocr_translate:run_ocrtsl')
+    response = client.post(url, **post_kwargs)
+
+    assert response.status_code == 200
+    assert response.json()['result'][0]['tsl'] == 'work'
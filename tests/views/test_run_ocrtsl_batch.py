@@ -0,0 +1,213 @@
+###################################################################################
+# ocr_translate - a django app to perform OCR and translation of images.          #
+# Copyright (C) 2023-present Davide Grassano                                      #
+#                                                                                 #
+# This program is free software: you can redistribute it and/or modify            #
+# it under the terms of the GNU General Public License as published by            #
+# the Free Software Foundation, either version 3 of the License.                  #
+#                                                                                 #
+# This program is distributed in the hope that it will be useful,                 #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of                  #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                   #
+# GNU General Public License for more details.                                    #
+#                                                                                 #
+# You should have received a copy of the GNU General Public License               #
+# along with this program.  If not, see {http://www.gnu.org/licenses/}.           #
+#                                                                                 #
+# Home: https://github.com/Crivella/ocr_translate                                 #
+###################################################################################
+"""Test django serverside views.run_ocrtsl_batch."""
+# pylint: disable=redefined-outer-name
+
+import base64
+import hashlib
+import io
+import json
+import threading
+
+import pytest
+from django.urls import reverse
+from PIL import Image
+
+from ocr_translate import models as m
+from ocr_translate import views
+from ocr_translate.messaging import Message, QueueFullError
+
+pytestmark = pytest.mark.django_db
+
+@pytest.fixture()
+def pages():
+    """List of base64 encoded images with their md5."""
+    res = []
+    for i in range(1, 4):
+        buffer = io.BytesIO()
+        Image.new('RGB', (i, i)).save(buffer, format='PNG')
+        b64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
+        res.append({'contents': b64, 'md5': hashlib.md5(b64.encode('utf-8')).hexdigest()})
+    return res
+
+@pytest.fixture()
+def mock_work(monkeypatch):
+    """Mock the work pipeline returning the size of the image as the OCR result."""
+    def mock_ocrtsl_work(img, md5, **kwargs):
+        """Mock ocrtsl work pipeline."""
+        if img.size[0] == 2:
+            raise ValueError('test_error')
+        return [{'ocr': f'ocr_{img.size[0]}', 'tsl': 'tsl', 'box': (1,2,3,4)}]
+    monkeypatch.setattr(views, 'ocr_tsl_pipeline_work', mock_ocrtsl_work)
+
+def post(client, **data):
+    """POST to run_ocrtsl_batch."""
+    url = reverse('ocr_translate:run_ocrtsl_batch')
+    return client.post(url, data=data, content_type='application/json')
+
+def test_run_ocrtsl_batch_nonpost(client):
+    """Test run_ocrtsl_batch with non POST request."""
+    url = reverse('ocr_translate:run_ocrtsl_batch')
+    response = client.get(url)
+    assert response.status_code == 405
+
+@pytest.mark.parametrize('images', [None, [], 'test'])
+def test_run_ocrtsl_batch_invalid_images(client, mock_loaded, images):
+    """Test run_ocrtsl_batch with missing/invalid list of images."""
+    response = post(client, images=images)
+    assert response.status_code == 400
+
+def test_run_ocrtsl_batch_wrong_md5(client, mock_loaded, pages):
+    """Test run_ocrtsl_batch with a wrong md5 -> 400 and nothing queued."""
+    pages[1]['md5'] = 'wrong_md5'
+    response = post(client, images=pages)
+
+    assert response.status_code == 400
+    assert response.json()['error'] == 'Image 1: md5 mismatch'
+
+def test_run_ocrtsl_batch_nocontent_force(client, mock_loaded, pages):
+    """Test run_ocrtsl_batch forcing a page without contents."""
+    pages[0].pop('contents')
+    response = post(client, images=pages, force=True)
+
+    assert response.status_code == 400
+
+def test_run_ocrtsl_batch_success(client, monkeypatch, queues_no_reuse, mock_loaded, mock_work, pages):
+    """Test run_ocrtsl_batch aggregated results, in the order of the images, with per page errors and lazy pages."""
+    def mock_ocrtsl_lazy(md5, **kwargs):
+        """Mock ocrtsl lazy pipeline."""
+        return [{'ocr': 'lazy', 'tsl': 'lazy', 'box': (1,2,3,4)}]
+    monkeypatch.setattr(views, 'ocr_tsl_pipeline_lazy', mock_ocrtsl_lazy)
+    pages.append({'md5': pages[0]['md5']})
+
+    response = post(client, images=pages)
+
+    assert response.status_code == 200
+    results = response.json()['results']
+    assert [_['md5'] for _ in results] == [_['md5'] for _ in pages]
+    assert results[0]['result'][0]['ocr'] == 'ocr_1'
+    assert results[1]['error'] == 'test_error'
+    assert results[2]['result'][0]['ocr'] == 'ocr_3'
+    assert results[3]['result'][0]['ocr'] == 'lazy'
+
+def test_run_ocrtsl_batch_stream(client, queues_no_reuse, mock_loaded, mock_work, pages):
+    """Test run_ocrtsl_batch streaming one page per line."""
+    response = post(client, images=pages, stream=True)
+
+    assert response.status_code == 200
+    assert response['Content-Type'] == 'application/x-ndjson'
+    lines = [json.loads(_) for _ in b''.join(response.streaming_content).decode('utf-8').splitlines()]
+    assert sorted(_['index'] for _ in lines) == [0, 1, 2]
+    for line in lines:
+        assert line['md5'] == pages[line['index']]['md5']
+
+def page_key(md5):
+    """Result cache key of a page with the loaded models and no options."""
+    return views._result_key(  # pylint: disable=protected-access
+        md5, m.Language.LOADED_SRC, m.Language.LOADED_DST,
+        m.OCRBoxModel.LOADED_MODEL, m.OCRModel.LOADED_MODEL, m.TSLModel.LOADED_MODEL, {},
+        )
+
+def test_run_ocrtsl_batch_result_cache(client, monkeypatch, queues_no_reuse, mock_loaded, mock_work, pages):
+    """Test that run_ocrtsl_batch fills the result cache and serves cached pages without running them."""
+    response = post(client, images=pages)
+    assert response.status_code == 200
+    assert views.result_cache.get(page_key(pages[0]['md5']))[0]['ocr'] == 'ocr_1'
+    assert page_key(pages[1]['md5']) not in views.result_cache  # Errors are not cached
+
+    monkeypatch.setattr(views, '_decode_image', None)
+    monkeypatch.setattr(views, '_put_ocrtsl', None)
+    response = post(client, images=[pages[0], pages[2]])
+
+    assert response.status_code == 200
+    assert [_['result'][0]['ocr'] for _ in response.json()['results']] == ['ocr_1', 'ocr_3']
+
+def test_run_ocrtsl_batch_result_cache_md5_mismatch(client, mock_loaded, pages):
+    """Test that a cached page sent with contents not matching its md5 is rejected instead of served."""
+    views.result_cache.put(page_key(pages[0]['md5']), [{'ocr': 'cached', 'tsl': 'cached', 'box': (1,2,3,4)}])
+    page = {**pages[0], 'contents': pages[1]['contents']}
+    response = post(client, images=[page])
+
+    assert response.status_code == 400
+    assert response.json()['error'] == 'Image 0: md5 mismatch'
+
+def test_run_ocrtsl_batch_force_invalidates(client, queues_no_reuse, mock_loaded, mock_work, pages):
+    """Test that forced pages are re-run and replace their cached result."""
+    key = page_key(pages[0]['md5'])
+    views.result_cache.put(key, [{'ocr': 'stale', 'tsl': 'stale', 'box': (1,2,3,4)}])
+
+    response = post(client, images=[pages[0]], force=True)
+
+    assert response.status_code == 200
+    assert response.json()['results'][0]['result'][0]['ocr'] == 'ocr_1'
+    assert views.result_cache.get(key)[0]['ocr'] == 'ocr_1'
+
+def test_run_ocrtsl_batch_queued_together(client, monkeypatch, mock_loaded, pages):
+    """Test that every page is queued before waiting for any result."""
+    msgs = []
+    def mock_put(*args, **kwargs):
+        """Mock put returning messages resolved later."""
+        msg = Message(id_=len(msgs), msg={}, handler=None)
+        msgs.append(msg)
+        if len(msgs) == len(pages):
+            for i, _ in enumerate(msgs):
+                threading.Timer(0.05, _.set_response, args=([{'ocr': str(i)}],)).start()
+        return msg
+    monkeypatch.setattr(views.q, 'put', mock_put)
+
+    response = post(client, images=pages)
+
+    assert response.status_code == 200
+    assert [_['result'][0]['ocr'] for _ in response.json()['results']] == ['0', '1', '2']
+
+def test_run_ocrtsl_batch_queue_full(client, monkeypatch, mock_loaded, pages):
+    """Test run_ocrtsl_batch rejected by the main queue -> 503 and the pages already queued are released."""
+    msgs = []
+    def mock_put(*args, **kwargs):
+        """Mock a queue getting full after the first page."""
+        if msgs:
+            raise QueueFullError('Queue full', retry_after=1)
+        msg = Message(id_=1, msg={}, handler=None)
+        msg.retain()
+        msgs.append(msg)
+        return msg
+    monkeypatch.setattr(views.q, 'put', mock_put)
+
+    response = post(client, images=pages)
+
+    assert response.status_code == 503
+    assert msgs[0].cancelled
+
+def test_run_ocrtsl_batch_timeout(client, monkeypatch, mock_loaded, pages):
+    """Test run_ocrtsl_batch with pages timing out -> per page error and messages released."""
+    msgs = []
+    def mock_put(*args, **kwargs):
+        """Mock put returning messages that never resolve."""
+        msg = Message(id_=len(msgs), msg={}, handler=None)
+        msg.retain()
+        msgs.append(msg)
+        return msg
+    monkeypatch.setattr(views.q, 'put', mock_put)
+    monkeypatch.setattr(views, 'get_current_deadline', lambda: 0)
+
+    response = post(client, images=pages)
+
+    assert response.status_code == 200
+    assert all('error' in _ for _ in response.json()['results'])
+    assert all(_.cancelled for _ in msgs)
@@ -0,0 +1,171 @@
+###################################################################################
+# ocr_translate - a django app to perform OCR and translation of images.          #
+# Copyright (C) 2023-present Davide Grassano                                      #
+#                                                                                 #
+# This program is free software: you can redistribute it and/or modify            #
+# it under the terms of the GNU General Public License as published by            #
+# the Free Software Foundation, either version 3 of the License.                  #
+#                                                                                 #
+# This program is distributed in the hope that it will be useful,                 #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of                  #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                   #
+# GNU General Public License for more details.                                    #
+#                                                                                 #
+# You should have received a copy of the GNU General Public License               #
+# along with this program.  If not, see {http://www.gnu.org/licenses/}.           #
+#                                                                                 #
+# Home: https://github.com/Crivella/ocr_translate                                 #
+###################################################################################
+"""Test django serverside views.run_ocrtsl_binary."""
+# pylint: disable=redefined-outer-name
+
+import base64
+import hashlib
+import io
+import json
+
+import pytest
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.urls import reverse
+from PIL import Image
+
+from ocr_translate import transport, views
+from ocr_translate.result_cache import result_cache
+
+pytestmark = pytest.mark.django_db
+
+@pytest.fixture()
+def binary():
+    """PNG encoded image."""
+    buffer = io.BytesIO()
+    Image.new('RGB', (4, 3)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+@pytest.fixture()
+def mock_work(monkeypatch):
+    """Mock the work pipeline returning the size and the md5 of the image."""
+    calls = []
+    def mock_ocrtsl_work(img, md5, **kwargs):
+        """Mock ocrtsl work pipeline."""
+        calls.append(kwargs)
+        return [{'ocr': f'{img.size}', 'tsl': md5, 'box': (1,2,3,4)}]
+    monkeypatch.setattr(views, 'ocr_tsl_pipeline_work', mock_ocrtsl_work)
+    return calls
+
+def post(client, data, query: str = '', content_type='application/octet-stream', **headers):
+    """POST to run_ocrtsl_binary."""
+    url = reverse('ocr_translate:run_ocrtsl_binary') + query
+    if content_type is None:
+        return client.post(url, data=data, headers=headers)
+    return client.post(url, data=data, content_type=content_type, headers=headers)
+
+def test_run_ocrtsl_binary_nonpost(client):
+    """Test run_ocrtsl_binary with non POST request."""
+    response = client.get(reverse('ocr_translate:run_ocrtsl_binary'))
+    assert response.status_code == 405
+
+def test_run_ocrtsl_binary_default_digest(client, queues_no_reuse, mock_loaded, mock_work, binary):
+    """Test raw upload with the default digest: same id as the md5 of the base64 used by run_ocrtsl."""
+    md5 = hashlib.md5(base64.b64encode(binary)).hexdigest()
+    response = post(client, binary)
+
+    assert response.status_code == 200
+    assert response['X-Image-Digest'] == md5
+    assert response['X-Digest-Algorithm'] == 'md5-base64'
+    assert response.json()['result'] == [{'ocr': '(4, 3)', 'tsl': md5, 'box': [1,2,3,4]}]
+
+@pytest.mark.parametrize('algorithm, hasher', [
+    ('md5', hashlib.md5),
+    ('blake2b', lambda: hashlib.blake2b(digest_size=16)),
+])
+def test_run_ocrtsl_binary_digest(client, queues_no_reuse, mock_loaded, mock_work, binary, algorithm, hasher):
+    """Test raw upload with a digest negotiated by header."""
+    expected = hasher()
+    expected.update(binary)
+    response = post(client, binary, **{'X-Digest-Algorithm': algorithm})
+
+    assert response.status_code == 200
+    assert response['X-Image-Digest'] == expected.hexdigest()
+    assert response.json()['result'][0]['tsl'] == expected.hexdigest()
+
+def test_run_ocrtsl_binary_unsupported_digest(client, mock_loaded, binary):
+    """Test raw upload with an unknown digest algorithm -> 400 with the supported ones."""
+    response = post(client, binary, **{'X-Digest-Algorithm': 'sha0'})
+
+    assert response.status_code == 400
+    assert 'md5-base64' in response.json()['supported']
+
+def test_run_ocrtsl_binary_digest_mismatch(client, mock_loaded, binary):
+    """Test raw upload with a wrong client digest -> 400."""
+    response = post(client, binary, **{'X-Image-Digest': 'wrong'})
+
+    assert response.status_code == 400
+    assert response.json()['error'] == 'digest mismatch'
+
+@pytest.mark.parametrize('data', [b'', b'not an image'], ids=['empty', 'invalid'])
+def test_run_ocrtsl_binary_invalid(client, mock_loaded, data):
+    """Test raw upload without a valid image -> 400."""
+    response = post(client, data)
+    assert response.status_code == 400
+
+def test_run_ocrtsl_binary_cached(client, queues_no_reuse, mock_loaded, mock_work, binary):
+    """Test that a cached result is served from the client digest, and that force reruns the pipeline."""
+    md5 = hashlib.md5(base64.b64encode(binary)).hexdigest()
+    assert post(client, binary).status_code == 200
+
+    response = post(client, b'ignored', **{'X-Image-Digest': md5})
+    assert response.status_code == 200
+    assert response.json()['result'][0]['tsl'] == md5
+    assert response['X-Image-Digest'] == md5
+    assert response['X-Digest-Algorithm'] == 'md5-base64'
+    assert len(mock_work) == 1
+
+    response = post(client, binary, '?force=true', **{'X-Image-Digest': md5})
+    assert response.status_code == 200
+    assert len(mock_work) == 2
+    assert mock_work[-1]['force']
+    assert len(result_cache) == 1
+
+def test_run_ocrtsl_binary_multipart(client, queues_no_reuse, mock_loaded, mock_work, binary, ocr_model):
+    """Test multipart upload with the options as a JSON part."""
+    data = {
+        'image': SimpleUploadedFile('page.png', binary, content_type='image/png'),
+        'options': SimpleUploadedFile(
+            'options', json.dumps({ocr_model.name: {'test': 1}}).encode('utf-8'), content_type='application/json'
+            ),
+    }
+    response = post(client, data, content_type=None)
+
+    assert response.status_code == 200
+    assert mock_work[0]['options_ocr'].options == {'test': 1}
+
+def test_run_ocrtsl_binary_multipart_no_image(client, mock_loaded):
+    """Test multipart upload without the image part -> 400."""
+    response = post(client, {'options': '{}'}, content_type=None)
+    assert response.status_code == 400
+
+def test_run_ocrtsl_binary_options_unsupported(client, monkeypatch, mock_loaded, binary):
+    """Test multipart upload with options in a format that is not supported/installed -> 415."""
+    monkeypatch.delitem(transport.OPTIONS_DECODERS, 'application/cbor', raising=False)
+    data = {
+        'image': SimpleUploadedFile('page.png', binary, content_type='image/png'),
+        'options': SimpleUploadedFile('options', b'\xa0', content_type='application/cbor'),
+    }
+    response = post(client, data, content_type=None)
+
+    assert response.status_code == 415
+
+def test_run_ocrtsl_binary_stream(client, queues_no_reuse, monkeypatch, mock_loaded, binary):
+    """Test raw upload in streaming mode."""
+    def mock_ocrtsl_stream(*args, **kwargs):
+        """Mock ocrtsl stream pipeline."""
+        yield {'index': 0, 'ocr': 'test_ocr', 'tsl': 'test_tsl', 'box': (1,2,3,4)}
+    monkeypatch.setattr(views, 'ocr_tsl_pipeline_stream', mock_ocrtsl_stream)
+
+    response = post(client, binary, '?stream=1')
+
+    assert response.status_code == 200
+    assert response['Content-Type'] == 'application/x-ndjson'
+    assert 'X-Image-Digest' in response
+    lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+    assert [json.loads(_)['ocr'] for _ in lines] == ['test_ocr']
@@ -23,6 +23,7 @@ import pytest
 from django.urls import reverse
 
 from ocr_translate import models as m
+from ocr_translate.result_cache import result_cache
 
 pytestmark = pytest.mark.django_db
 
@@ -139,3 +140,19 @@ def test_set_manual_translation_post_success_exist(
     assert m.TranslationRun.objects.count() == 1
 
     assert response.status_code == 200
+
+def test_set_manual_translation_invalidates_cache(
+        client, post_kwargs, text,
+        manual_model, option_dict, language, mock_loaded_lang_only
+        ):
+    """Test set_manual_translation removing the cached results containing the text."""
+    result_cache.put(('page1',), [{'ocr': text.text, 'tsl': 'old', 'box': [1, 2, 3, 4]}])
+    result_cache.put(('page2',), [{'ocr': 'other', 'tsl': 'other', 'box': [1, 2, 3, 4]}])
+    post_kwargs['data']['text'] = text.text
+
+    url = reverse('ocr_translate:set_manual_translation')
+    response = client.post(url, **post_kwargs)
+
+    assert response.status_code == 200
+    assert ('page1',) not in result_cache
+    assert ('page2',) in result_cache